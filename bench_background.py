@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for raspicam.Background.
+
+Runs the previous (allocating) implementation and the in-place float32 and
+fixed-point uint16 engines over the same synthetic lores Y planes at the
+sizes produced by the given camera configs, and reports time per frame and
+how often the motion decisions agree.
+
+Tolerance: the previous implementation ends up with a float64 background
+(uint8 * python float promotes), the new float engine keeps float32, so a
+pixel can flip only when |bg - img| is within float32 rounding of
+diff_th.  The fixed-point engine rounds the background to 1/256 and alpha
+to a multiple of 1/256, so a pixel can flip when |bg - img| is within
+1/256 of diff_th.  Both show up as a small pixel-level mismatch count;
+frame-level decisions only differ when changed ratio sits right at area_th.
+
+    python3 bench_background.py exitcam.cfg feedercam.cfg
+"""
+import argparse, configparser, contextlib, io, time
+import numpy as np
+
+from raspicam import Background, stream_sizes
+
+
+class LegacyBackground:
+    """The update_bg() logic as it was before the in-place engine."""
+
+    def __init__(self, alpha, diff_th, area_th, w, h):
+        self.alpha       = alpha
+        self.diff_th     = diff_th
+        self.area_th     = area_th
+        self.total       = w * h
+        self.initialized = False
+
+    def update_bg(self, img):
+        if not self.initialized:
+            self.bg = img.astype(np.float32)
+            self.initialized = True
+            return False
+        diff    = np.abs(self.bg - img) > self.diff_th
+        changed = diff.sum() / self.total
+        self.bg = self.bg * self.alpha + img * (1 - self.alpha)
+        self.mask = diff
+        return changed >= self.area_th
+
+
+def synthetic_frames(w, h, n, seed=0):
+    """Static textured entrance with sensor noise, slow light drift and a few moving blobs."""
+    rng   = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:h, 0:w]
+    base  = (60 + 80 * xx / w + rng.normal(0, 8, (h, w))).astype(np.float32)
+    bees  = [(rng.uniform(0, w), rng.uniform(0, h), rng.uniform(-6, 6), rng.uniform(-3, 3))
+             for _ in range(4)]
+    frames = []
+    for i in range(n):
+        f = base + 10 * np.sin(i / 50) + rng.normal(0, 3, (h, w))
+        if (i // 40) % 2:                       # alternate idle and busy stretches
+            for bx, by, vx, vy in bees:
+                cx, cy = (bx + vx * i) % w, (by + vy * i) % h
+                f[((xx - cx) / 14) ** 2 + ((yy - cy) / 8) ** 2 < 1] = 25
+        frames.append(np.clip(f, 0, 255).astype(np.uint8))
+    return frames
+
+
+def time_engine(bg, frames):
+    decisions = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        for f in frames:
+            decisions.append(bg.update_bg(f))
+        dt = time.perf_counter() - t0
+    return dt / len(frames) * 1e3, decisions
+
+
+def pixel_mismatch(ref, bg, frames):
+    """Total number of pixel decisions that differ from `ref` over `frames`."""
+    mismatched = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for f in frames:
+            ref.update_bg(f)
+            bg.update_bg(f)
+            if ref.initialized and hasattr(ref, 'mask'):
+                mismatched += np.count_nonzero(ref.mask != bg.mask)
+    return mismatched
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument('configs', nargs='+', help='camera config files (exitcam.cfg, feedercam.cfg, ...)')
+    p.add_argument('--sensor-size', default='4608x2592',
+                   help='sensor mode size the configs are used with (default: IMX708 full res)')
+    p.add_argument('--frames', type=int, default=300)
+    args = p.parse_args()
+    sensor = tuple(int(v) for v in args.sensor_size.split('x'))
+
+    for path in args.configs:
+        cfg = configparser.ConfigParser()
+        cfg.read(path)
+        _, _, (w, h) = stream_sizes(cfg, sensor)
+        alpha   = float(cfg['Background']['alpha'])
+        diff_th = int(cfg['Background']['diff_threshold'])
+        area_th = float(cfg['Background']['area_threshold'])
+        frames  = synthetic_frames(w, h, args.frames)
+
+        print(f"{path}: lores {w}x{h}, {len(frames)} frames")
+        legacy_ms, legacy_dec = time_engine(LegacyBackground(alpha, diff_th, area_th, w, h), frames)
+        print(f"  legacy        {legacy_ms:7.3f} ms/frame")
+        for name, fixed in (('float32', False), ('fixed Q8.8', True)):
+            new = lambda: Background(alpha, diff_th, area_th, 0, w, h, fixed_point=fixed)
+            ms, dec = time_engine(new(), frames)
+            agree   = sum(a == b for a, b in zip(legacy_dec, dec))
+            px      = pixel_mismatch(LegacyBackground(alpha, diff_th, area_th, w, h), new(), frames)
+            print(f"  {name:<12}  {ms:7.3f} ms/frame  x{legacy_ms / ms:4.2f}   "
+                  f"frame decisions {agree}/{len(frames)} equal, "
+                  f"{px} of {w * h * (len(frames) - 1)} pixel decisions differ")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput benchmark for the server (server_stages.Server).
+
+Writes synthetic segments for `feeders` feeders into per-feeder "remote"
+directories, named like the cameras name them (<feeder>_<timestamp>.h264,
+with .times and, with --active, .motion sidecars), and runs them through
+the real server stages: transfer over a LocalTransport, decode workers,
+detection, tracking and the SQLite result and state stores.  The
+detector is a stub: each synthetic bee is a bright TAG x TAG square, and
+sampling every TAG-th pixel hits every tag exactly once, so a threshold
+finds them at almost no cost; `latency` (+ `per_mpix` per megapixel)
+secs of sleep per detector call stand in for the network.  --bees sets
+the detection density (tags per frame).
+
+Reported are the time per stage (decode in worker secs, in parallel to
+the rest), frames/sec, feeder-hours processed per hour and the peak
+resident memory of the server and of the decode workers.  Needs ffmpeg.
+
+    python3 bench_server.py --feeders 2 --videos 4 --latency 0.05 --bees 20
+    python3 bench_server.py --active 0.3 --workers 4 --batch 8 --keep /tmp/bench
+    # detector on the changed regions only (server_regions), vs whole frames above
+    python3 bench_server.py --regions --per-mpix 0.02
+"""
+import argparse, configparser, datetime, os, resource, shutil, subprocess, tempfile, time
+import numpy as np
+
+import frame_times
+import motion_index
+import server_pipeline
+from server_stages import Server, ResultKeys, STAGES, parse_video_name
+
+TAG  = 6
+KEYS = ResultKeys('Positions', 'Orientations', 'Saliencies', 'IDs')
+
+
+def synth_frames(n, size, bees, seed=0, step=8.0):
+    """`n` gray frames of `size` (w, h): noise plus `bees` random-walking TAG x TAG tags."""
+    w, h = size
+    rng  = np.random.default_rng(seed)
+    pos  = rng.uniform((0, 0), (h - TAG, w - TAG), (bees, 2))
+    base = rng.normal(40, 6, (h, w)).clip(0, 255).astype(np.uint8)
+    for _ in range(n):
+        pos += rng.normal(0, step, pos.shape)
+        np.clip(pos, (0, 0), (h - TAG, w - TAG), out=pos)
+        frame = base.copy()
+        for y, x in pos.astype(int):
+            frame[y:y + TAG, x:x + TAG] = 255
+        yield frame
+
+
+def write_segment(path, size, fps, frames, bees, active, seed):
+    """Encode a synthetic segment to `path` (.h264) with its timestamp and motion sidecars."""
+    w, h = size
+    enc  = subprocess.Popen(['ffmpeg', '-v', 'error', '-y', '-f', 'rawvideo', '-pix_fmt', 'gray', '-s', f'{w}x{h}',
+                             '-r', str(fps), '-i', '-', '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '18',
+                             '-pix_fmt', 'yuv420p', '-g', str(fps), '-f', 'h264', path], stdin=subprocess.PIPE)
+    for frame in synth_frames(frames, size, bees, seed):
+        enc.stdin.write(frame.tobytes())
+    enc.stdin.close()
+    if enc.wait():
+        raise RuntimeError(f"ffmpeg exited with status {enc.returncode}")
+
+    name   = os.path.basename(path)
+    start  = parse_video_name(name)[1].timestamp()
+    stamps = np.arange(frames, dtype=np.int64) * int(1e6 / fps)
+    frame_times.write(frame_times.sidecar_path(path), int(start * 1e6), stamps, fps)
+    if active < 1.0:
+        # one active stretch of `active` of the segment, in its middle
+        on      = np.zeros(frames, np.bool_)
+        first   = int(frames * (1 - active) / 2)
+        on[first:first + int(frames * active)] = True
+        records = np.zeros(frames, motion_index.RECORD)
+        records['frame'] = np.arange(frames)
+        records['ts']    = stamps
+        records['flags'] = on * motion_index.FLAG_MOTION
+        motion_index.write(motion_index.sidecar_path(path), records, fps)
+
+
+class StubDetector:
+    """
+    Stands in for the bb pipeline: pipeline([image]) -> results dict.  One
+    detection per synthetic tag, with a confident random id.
+    """
+
+    def __init__(self, latency=0.05, per_mpix=0.0, threshold=160, seed=0):
+        self.latency   = latency
+        self.per_mpix  = per_mpix
+        self.threshold = threshold
+        self.rng       = np.random.default_rng(seed)
+        self.calls     = 0
+
+    def __call__(self, images):
+        image = images[0]
+        self.calls += 1
+        time.sleep(self.latency + self.per_mpix * image.size / 1e6)
+        rows, cols = np.nonzero(image[::TAG, ::TAG] > self.threshold)
+        n   = len(rows)
+        pos = np.stack([rows, cols], axis=1).astype(np.float64) * TAG + TAG / 2
+        ids = np.where(self.rng.random((n, 12)) < 0.5, 0.05, 0.95)
+        return {KEYS.positions: pos, KEYS.orientations: np.zeros((n, 3)), KEYS.saliencies: np.ones((n, 1)),
+                KEYS.ids: ids}
+
+
+def make_config(root, feeders, args):
+    """server.cfg for the benchmark: everything under `root`, local transport."""
+    cfg = configparser.ConfigParser()
+    cfg['General'] = {
+        'videodir': os.path.join(root, 'Videos'), 'archive_dir': os.path.join(root, 'archived'),
+        'failed_dir': os.path.join(root, 'failed'),
+        'max_time_between_videos': '5', 'results': 'sqlite', 'results_db': os.path.join(root, 'results.db'),
+        'state_db': os.path.join(root, 'server_state.db'), 'max_distance': '50', 'fps': str(args.fps),
+        'frameskip': str(args.frameskip), 'last_event_id': '0', 'show_visualization': '0',
+        'minimum_confidence': '0.8', 'use_motion_index': '1', 'motion_margin': '10',
+        'decode_workers': str(args.workers), 'detect_batch': str(args.batch), 'frame_queue': str(args.queue),
+        'region_detection': '1' if args.regions else '0'}
+    cfg['Feeders'] = {
+        'feeder_ids': ','.join(feeders), 'feeder_addresses': ','.join(['localhost'] * len(feeders)),
+        'remotedir': os.path.join(root, 'remote', '{id}'), 'transport': 'local',
+        'transfer_workers': str(len(feeders))}
+    for d in ('videodir', 'archive_dir'):
+        os.makedirs(cfg['General'][d], exist_ok=True)
+    return cfg
+
+
+def peak_rss_mb(pid=None):
+    """Peak resident memory of process `pid` (default: this one) in MB, from /proc (Linux)."""
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument('--feeders', type=int, default=2)
+    p.add_argument('--videos', type=int, default=4, help='segments per feeder')
+    p.add_argument('--seconds', type=float, default=30, help='length of a segment')
+    p.add_argument('--fps', type=int, default=10)
+    p.add_argument('--size', default='1920x1080', help='frame size WxH')
+    p.add_argument('--bees', type=int, default=20, help='tags per frame (detection density)')
+    p.add_argument('--active', type=float, default=1.0, help='fraction of each segment with motion (< 1 writes .motion)')
+    p.add_argument('--latency', type=float, default=0.05, help='stub detector secs per call')
+    p.add_argument('--per-mpix', type=float, default=0.0, help='stub detector secs per megapixel')
+    p.add_argument('--frameskip', type=int, default=10)
+    p.add_argument('--workers', type=int, default=2, help='decode workers')
+    p.add_argument('--batch', type=int, default=4, help='frames per detector call')
+    p.add_argument('--queue', type=int, default=32, help='frame slots')
+    p.add_argument('--regions', action='store_true', help='detect only changed regions (region_detection = 1)')
+    p.add_argument('--keep', help='work directory to keep (default: a temporary one, removed)')
+    args = p.parse_args()
+
+    size    = tuple(int(v) for v in args.size.split('x'))
+    frames  = int(args.seconds * args.fps)
+    root    = args.keep or tempfile.mkdtemp(prefix='bench_server_')
+    feeders = [f'{i:02d}' for i in range(args.feeders)]
+    try:
+        cfg = make_config(root, feeders, args)
+        print(f"writing {args.feeders} x {args.videos} segments of {frames} frames at {size[0]}x{size[1]} ...")
+        t0 = datetime.datetime(2024, 6, 1, 12, 0, 0)
+        for n, feeder in enumerate(feeders):
+            remote = cfg['Feeders']['remotedir'].format(id=feeder)
+            os.makedirs(remote, exist_ok=True)
+            for v in range(args.videos):
+                start = t0 + datetime.timedelta(seconds=v * args.seconds)
+                write_segment(os.path.join(remote, f"{feeder}_{start:%Y-%m-%d-%H-%M-%S}.h264"), size, args.fps,
+                              frames, args.bees, args.active, seed=n * 1000 + v)
+
+        stub   = StubDetector(args.latency, args.per_mpix)
+        detect = lambda batch: server_pipeline.detect_mosaic(stub, batch, KEYS)
+        server = Server(cfg, KEYS, detect)
+        wall   = time.perf_counter()
+        fetched = server.pull_feeders()
+        files   = sorted((f for names in fetched.values() for f in names if parse_video_name(f)),
+                         key=lambda f: parse_video_name(f)[::-1])
+        server.process(files)
+        wall   = time.perf_counter() - wall
+        tracked, detected = server.framenum, server.frames_detected
+        events  = len(server.store.visits())
+        regions = server.regions.as_dict() if server.regions is not None else None
+        workers = max(peak_rss_mb(w.pid) for w in server.processor.workers)
+        server.close()
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    hours = len(files) * args.seconds / 3600
+    print(f"{len(files)} segments, {hours * 60:.1f} feeder-minutes, {tracked} kept frames, "
+          f"{detected} through the detector in {stub.calls} calls, {events} saved events")
+    print(f"wall {wall:.2f} s   {tracked / wall:.1f} frames/s   {detected / wall:.1f} detected frames/s   "
+          f"{hours / (wall / 3600):.1f} feeder-hours/hour")
+    for stage in STAGES:
+        t = server.stages[stage]
+        print(f"  {stage:<9} {t.total:8.2f} s  {t.total / wall * 100:5.1f}% of wall  "
+              f"{t.count:6d} calls  mean {t.as_dict()['mean'] * 1e3:8.2f} ms  max {t.max * 1e3:8.2f} ms")
+    if regions is not None:
+        print(f"regions: {regions['full']} full, {regions['cropped']} cropped, {regions['skipped']} skipped frames, "
+              f"detector saw {regions['pixel_share'] * 100:.1f}% of the frame pixels")
+    print(f"peak memory: server {peak_rss_mb():.0f} MB, largest decode worker {workers:.0f} MB "
+          f"(without its ffmpeg)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the detection-to-event assignment (tracker.py).
+
+Simulates a crowded feeder entrance: `bees` tags random-walk through a
+1920x1080 padded frame, some leave and are replaced every frame, and each
+frame's detections are the positions plus noise with some misses.  The
+previous greedy per-detection loop and tracker.associate() both track
+the same detections; reported are the time per frame and how often a
+detection was matched to the event of the bee it belongs to, and for the
+greedy loop how often two detections were matched to one event.
+
+    python3 bench_tracker.py --bees 10 50 200 1000
+"""
+import argparse, time
+import numpy as np
+
+import tracker
+
+W, H = 2020, 1180
+
+
+def crowd(bees, frames, step=12.0, noise=2.0, miss=0.05, turnover=0.02, seed=0):
+    """Per frame (detections (n, 2), true bee id per detection)."""
+    rng  = np.random.default_rng(seed)
+    pos  = rng.uniform((50, 50), (H - 50, W - 50), (bees, 2))
+    ids  = np.arange(bees)
+    nxt  = bees
+    out  = []
+    for _ in range(frames):
+        pos += rng.normal(0, step, pos.shape)
+        np.clip(pos, (50, 50), (H - 50, W - 50), out=pos)
+        gone = rng.random(bees) < turnover
+        pos[gone] = rng.uniform((50, 50), (H - 50, W - 50), (gone.sum(), 2))
+        ids[gone] = np.arange(nxt, nxt + gone.sum())
+        nxt += gone.sum()
+        seen = rng.random(bees) >= miss
+        out.append((pos[seen] + rng.normal(0, noise, (seen.sum(), 2)), ids[seen].copy()))
+    return out
+
+
+class Track:
+    def __init__(self, pos, bee):
+        self.pos = pos
+        self.bee = bee
+        self.age = 0
+
+    def distance(self, position):
+        return np.sqrt((self.pos[0] - position[0]) ** 2 + (self.pos[1] - position[1]) ** 2)
+
+
+def legacy_step(tracks, detections, max_distance):
+    """The server loop before tracker.py (events only): nearest event per detection."""
+    matched = []
+    for i in range(len(detections)):
+        distance, match = float('inf'), None
+        for t in tracks:
+            d = t.distance(detections[i])
+            if d < distance:
+                distance, match = d, t
+        matched.append(match if distance <= max_distance else None)
+    return matched
+
+
+def vector_step(tracks, detections, max_distance):
+    ev, _, _ = tracker.associate([t.pos for t in tracks], [], detections, max_distance)
+    matched  = [None] * len(detections)
+    for t, d in ev:
+        matched[d] = tracks[t]
+    return matched
+
+
+def run(step, frames, max_distance):
+    tracks, correct, total, doubles, elapsed = [], 0, 0, 0, 0.0
+    for detections, bees in frames:
+        t0       = time.perf_counter()
+        matched  = step(tracks, detections, max_distance)
+        elapsed += time.perf_counter() - t0
+        used     = [id(t) for t in matched if t is not None]
+        doubles += len(used) - len(set(used))
+        for i, t in enumerate(matched):
+            if t is None:
+                tracks.append(Track(detections[i], bees[i]))
+                continue
+            correct += t.bee == bees[i]
+            total   += 1
+            t.pos, t.bee, t.age = detections[i], bees[i], 0
+        for t in tracks:
+            t.age += 1
+        tracks = [t for t in tracks if t.age < 5]
+    return elapsed / len(frames) * 1e3, correct / max(total, 1), doubles
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument('--bees', type=int, nargs='+', default=[10, 50, 200, 1000])
+    p.add_argument('--frames', type=int, default=200)
+    p.add_argument('--max-distance', type=float, default=50)
+    args = p.parse_args()
+
+    for bees in args.bees:
+        frames = crowd(bees, args.frames)
+        print(f"{bees} bees, {args.frames} frames")
+        for name, step in (('greedy loop', legacy_step), ('tracker', vector_step)):
+            ms, acc, doubles = run(step, frames, args.max_distance)
+            print(f"  {name:<12} {ms:8.3f} ms/frame   correct matches {acc * 100:5.1f}%   "
+                  f"double assignments {doubles}")
+
+
+if __name__ == '__main__':
+    main()
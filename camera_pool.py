@@ -0,0 +1,109 @@
+"""
+Worker threads shared by the cameras of one raspicam.py process.
+
+Every camera registers two serial units of work: its analysis (frames
+queued in its FrameRing) and its Finaliser (closed segments).  A unit runs
+on one worker at a time, so the frame order of a camera and the
+single-writer counters in Metrics hold, while `workers` threads serve all
+cameras.  Analysis goes before finalisation, and with more than one
+worker at most workers - 1 of them finalise at once, so a finaliser that
+waits for its camera's motion index never blocks the analysis it is
+waiting for.  The FrameRings of all cameras use the pool's condition, so
+committing a frame wakes a worker directly.
+"""
+import threading, traceback
+
+ANALYSIS = 0
+FINALISE = 1
+
+
+class WorkerPool:
+    """
+    `workers` threads running registered units.  A unit has pending(),
+    called with `cond` held, and work(), which does a bounded amount of
+    work.  A unit whose work() raises lands in `failed` and is not run
+    again.
+    """
+
+    def __init__(self, workers=2):
+        self.cond       = threading.Condition()
+        self.workers    = max(1, workers)
+        self.units      = []        # [unit, kind, busy]
+        self.failed     = {}        # unit -> exception
+        self.finalising = 0
+        self.next       = 0         # round-robin start, so no camera starves the others
+        self.runs       = [0, 0]    # work() calls per kind
+        self.running    = True
+        self.threads    = [threading.Thread(target=self._worker, name=f'pool-{i}', daemon=True)
+                           for i in range(self.workers)]
+        for t in self.threads:
+            t.start()
+
+    def register(self, unit, kind):
+        with self.cond:
+            self.units.append([unit, kind, False])
+            self.cond.notify_all()
+
+    def unregister(self, unit):
+        with self.cond:
+            self.units = [entry for entry in self.units if entry[0] is not unit]
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def _pick(self):
+        n = len(self.units)
+        for kind in (ANALYSIS, FINALISE):
+            if kind == FINALISE and self.workers > 1 and self.finalising >= self.workers - 1:
+                continue
+            for i in range(n):
+                entry = self.units[(self.next + i) % n]
+                if entry[1] == kind and not entry[2] and entry[0] not in self.failed and entry[0].pending():
+                    self.next = (self.next + i + 1) % n
+                    return entry
+        return None
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                entry = None
+                while self.running and (entry := self._pick()) is None:
+                    self.cond.wait()
+                if entry is None:
+                    return
+                entry[2] = True
+                self.finalising += entry[1] == FINALISE
+            try:
+                entry[0].work()
+            except Exception as e:
+                traceback.print_exc()
+                with self.cond:
+                    self.failed[entry[0]] = e
+            finally:
+                with self.cond:
+                    entry[2]         = False
+                    self.finalising -= entry[1] == FINALISE
+                    self.runs[entry[1]] += 1
+                    self.cond.notify_all()
+
+    def wait_idle(self, unit, timeout=None):
+        """Block until `unit` has nothing pending and is not running (or failed); False on timeout."""
+        def idle():
+            entry = next((e for e in self.units if e[0] is unit), None)
+            return entry is None or unit in self.failed or not (entry[2] or unit.pending())
+        with self.cond:
+            return self.cond.wait_for(idle, timeout)
+
+    def stats(self):
+        with self.cond:
+            return {'workers': self.workers, 'busy': sum(e[2] for e in self.units),
+                    'analysis_runs': self.runs[ANALYSIS], 'finalise_runs': self.runs[FINALISE],
+                    'failed': len(self.failed)}
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join(timeout=5)
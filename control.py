@@ -0,0 +1,242 @@
+"""
+Control socket of a running raspicam.py camera.
+
+A Unix stream socket ([Control] socket in the camera config) that takes
+one JSON object per line and answers each with one JSON line, without
+touching the recording:
+
+    {"cmd": "status"}
+        metrics snapshot, current [Background] parameters and the
+        camera controls set so far
+    {"cmd": "set", "background": {"diff_threshold": 25, "area_threshold": 0.02}}
+        new [Background] parameters, applied by the analysis worker
+        before its next frame (see CameraPipeline.set_background)
+    {"cmd": "set", "controls": {"LensPosition": 12.5, "ExposureTime": 8000}}
+        picamera2 controls, effective a few frames later
+    {"cmd": "snapshot", "name": "snap.jpg"}
+        luma (Y plane) of the next main-stream frame, taken by the capture
+        thread from the request it already holds and written to `name` in
+        [Control] snapshot_dir (.npy, .pgm, or anything PIL can write);
+        names with a directory part are refused, and without a
+        snapshot_dir there are no snapshots
+
+Answers are {"ok": true, ...} or {"ok": false, "error": "..."}.  Changes
+are not written back to the config file.
+
+    python3 control.py ./control.sock status
+    python3 control.py ./control.sock set diff_threshold=25 area_threshold=0.02
+    python3 control.py ./control.sock controls LensPosition=12.5
+    python3 control.py ./control.sock snapshot snap.jpg
+"""
+import json, os, queue, socket, socketserver, threading
+import numpy as np
+
+
+class Grab:
+    """A main-stream frame asked for by the control socket, filled in by the capture thread."""
+
+    def __init__(self):
+        self.done  = threading.Event()
+        self.frame = None
+        self.meta  = None
+
+    def fill(self, frame, meta):
+        self.frame, self.meta = frame, meta
+        self.done.set()
+
+
+class Camera:
+    """
+    The live-camera side of the socket: set_controls() and grab() on a
+    started Picamera2.  capture_lores() hands the queued grabs the main
+    stream of the request it is processing, so no frame is taken away
+    from the lores analysis.
+    """
+
+    def __init__(self, picam2, controls, main_size):
+        self.picam2    = picam2
+        self.controls  = dict(controls)     # as set at start plus later updates
+        self.main_size = main_size
+        self.grabs     = queue.SimpleQueue()
+
+    def set_controls(self, controls):
+        unknown = sorted(set(controls) - set(self.picam2.camera_controls))
+        if unknown:
+            raise ValueError(f"unknown controls {', '.join(unknown)}")
+        controls = {k: tuple(v) if isinstance(v, list) else v for k, v in controls.items()}
+        self.picam2.set_controls(controls)
+        self.controls.update(controls)
+
+    def grab(self, timeout=2.0):
+        """(Y plane, metadata) of the next main-stream frame."""
+        g = Grab()
+        self.grabs.put(g)
+        if not g.done.wait(timeout):
+            raise TimeoutError("no frame from the capture thread")
+        return g.frame, g.meta
+
+
+def save_gray(path, img):
+    """Write a uint8 luma image as .npy, .pgm or (via PIL) any other image format."""
+    if path.endswith('.npy'):
+        np.save(path, img)
+    elif path.endswith('.pgm'):
+        with open(path, 'wb') as f:
+            f.write(b'P5\n%d %d\n255\n' % (img.shape[1], img.shape[0]))
+            f.write(np.ascontiguousarray(img).tobytes())
+    else:
+        from PIL import Image
+        Image.fromarray(img).save(path)
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                reply = dict(ok=True, **self.server.control.handle(json.loads(line)))
+            except Exception as e:
+                reply = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(_jsonable(reply)).encode() + b'\n')
+            self.wfile.flush()
+
+
+class ControlServer:
+    """
+    Serves the control socket at `path` for one CameraPipeline on a daemon
+    thread.  `camera` is a Camera, or None where there is no live camera
+    (replays): then only status and background updates are available.
+    Snapshots are written to `snapshot_dir` only, None turns them off.
+    """
+
+    def __init__(self, path, pipeline, camera=None, snapshot_dir=None):
+        self.path         = path
+        self.pipeline     = pipeline
+        self.camera       = camera
+        self.snapshot_dir = snapshot_dir
+        if os.path.exists(path):
+            os.remove(path)                 # left over by a process that did not shut down
+        self.server         = socketserver.ThreadingUnixStreamServer(path, _Handler)
+        self.server.control = self
+        self.server.daemon_threads = True
+        os.chmod(path, 0o660)
+        self.thread = threading.Thread(target=self.server.serve_forever, name=f'control-{pipeline.feeder}',
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print(f"[control] listening on {self.path}")
+
+    def handle(self, req):
+        cmd = req.get('cmd')
+        if cmd == 'status':
+            return {'status': self.pipeline.snapshot(update=False), 'background': self.pipeline.background_params(),
+                    'controls': self.camera.controls if self.camera else None}
+        if cmd == 'set':
+            out = {}
+            if 'background' in req:
+                out['background'] = self.pipeline.set_background(req['background'])
+            if 'controls' in req:
+                self._camera().set_controls(req['controls'])
+                out['controls'] = self.camera.controls
+            if not out:
+                raise ValueError("set needs 'background' and/or 'controls'")
+            return out
+        if cmd == 'snapshot':
+            path        = self._snapshot_path(req.get('name', ''))
+            frame, meta = self._camera().grab()
+            save_gray(path, frame)
+            return {'path': path, 'size': [frame.shape[1], frame.shape[0]], 'metadata': meta}
+        raise ValueError(f"unknown cmd {cmd!r} (status, set, snapshot)")
+
+    def _snapshot_path(self, name):
+        if self.snapshot_dir is None:
+            raise RuntimeError("snapshots are off, set [Control] snapshot_dir")
+        if not name or os.path.basename(name) != name or name in ('.', '..'):
+            raise ValueError(f"snapshot name {name!r} is not a plain file name")
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        return os.path.join(self.snapshot_dir, name)
+
+    def _camera(self):
+        if self.camera is None:
+            raise RuntimeError("no live camera in this process")
+        return self.camera
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def make_control(cfg, pipeline, camera=None):
+    """Started ControlServer from [Control] socket and snapshot_dir of a camera config, None if no socket is set."""
+    path      = cfg.get('Control', 'socket', fallback='').strip()
+    snapshots = cfg.get('Control', 'snapshot_dir', fallback='').strip()
+    if not path:
+        return None
+    server = ControlServer(path, pipeline, camera, snapshots or None)
+    server.start()
+    return server
+
+
+def _value(text):
+    """Command-line value: JSON (numbers, lists, true/false) or else a plain string."""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def request(path, req, timeout=10):
+    """Send one request to the socket at `path`, return the decoded answer."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(json.dumps(req).encode() + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = s.recv(1 << 16)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description="Talk to the control socket of a running raspicam.py")
+    p.add_argument('socket', help='[Control] socket path of the camera')
+    p.add_argument('cmd', choices=['status', 'set', 'controls', 'snapshot'])
+    p.add_argument('args', nargs='*', help='key=value pairs (set, controls) or the file name in snapshot_dir (snapshot)')
+    args = p.parse_args()
+
+    if args.cmd == 'snapshot':
+        if len(args.args) != 1:
+            p.error("snapshot needs a file name")
+        req = {'cmd': 'snapshot', 'name': args.args[0]}
+    elif args.cmd == 'status':
+        req = {'cmd': 'status'}
+    else:
+        pairs = dict(a.split('=', 1) for a in args.args)
+        req   = {'cmd': 'set', 'background' if args.cmd == 'set' else 'controls':
+                 {k: _value(v) for k, v in pairs.items()}}
+    reply = request(args.socket, req)
+    print(json.dumps(reply, indent=2))
+    raise SystemExit(0 if reply.get('ok') else 1)
@@ -0,0 +1,53 @@
+FULL = 'full'
+IDLE = 'idle'
+
+
+class DutyCycle:
+    """
+    Decides which lores frames the analysis worker runs through Background.
+
+    In FULL mode every frame is analysed.  After `idle_after` secs without
+    motion (and Background no longer active) it switches to IDLE and only
+    analyses one frame every `idle_interval` secs, so motion is noticed at
+    most idle_interval secs late; the first motion switches back to FULL
+    at once.  idle_after = 0 keeps it in FULL mode.  Times are frame times
+    in secs; time_in holds the secs spent in each mode.
+    """
+
+    def __init__(self, idle_after=0, idle_interval=0.5):
+        self.idle_after    = idle_after
+        self.idle_interval = idle_interval
+        self.mode          = FULL
+        self.since         = None       # frame time the time_in accounting got to
+        self.last_motion   = None
+        self.next_due      = 0.0
+        self.time_in       = {FULL: 0.0, IDLE: 0.0}
+        self.switches      = 0
+        self.skipped       = 0
+
+    def want(self, now):
+        """True if the frame at `now` is to be analysed."""
+        if self.since is not None and now > self.since:
+            self.time_in[self.mode] += now - self.since
+        self.since = now
+        if self.mode == FULL or now >= self.next_due:
+            self.next_due = now + self.idle_interval
+            return True
+        self.skipped += 1
+        return False
+
+    def update(self, now, motion, active):
+        """Feed back the result of an analysed frame."""
+        if self.last_motion is None or motion or active:
+            self.last_motion = now
+            if self.mode == IDLE:
+                self.mode      = FULL
+                self.switches += 1
+        elif self.mode == FULL and self.idle_after > 0 and now - self.last_motion >= self.idle_after:
+            self.mode      = IDLE
+            self.switches += 1
+            self.next_due  = now + self.idle_interval
+
+    def as_dict(self):
+        return {'mode': self.mode, 'seconds': dict(self.time_in), 'switches': self.switches,
+                'skipped': self.skipped}
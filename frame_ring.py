@@ -0,0 +1,79 @@
+import threading, time, numpy as np
+from collections import deque
+
+
+class FrameRing:
+    """
+    Fixed-size ring of preallocated lores Y-plane slots shared by one
+    producer (capture thread) and one consumer (analysis worker).
+
+    The producer writes straight into a slot returned by acquire() and
+    hands it over with commit(); the consumer gets a view on that slot
+    from get() and gives it back with release().  Nothing is allocated per
+    frame.  When the consumer falls behind, the oldest queued frame is
+    overwritten and counted in `dropped`.  `cond` lets the rings of
+    several cameras share one condition with their consumers (see
+    camera_pool).
+    """
+
+    def __init__(self, size, w, h, cond=None):
+        self.slots    = np.empty((size, h, w), np.uint8)
+        self.stamps   = np.zeros(size, np.float64)   # time.monotonic() at commit
+        self.meta     = [None] * size
+        self.free     = deque(range(size))
+        self.queued   = deque()
+        self.cond     = cond or threading.Condition()
+        self.closed   = False
+        self.captured = 0
+        self.dropped  = 0
+
+    def acquire(self, wait=False):
+        """
+        Slot index for the producer to write into.  If the ring is full the
+        oldest queued frame is dropped, or with wait=True the producer blocks
+        until the consumer frees a slot (replay, where nothing may be lost).
+        """
+        with self.cond:
+            if wait:
+                self.cond.wait_for(lambda: self.free)
+            if self.free:
+                return self.free.popleft()
+            self.dropped += 1
+            return self.queued.popleft()
+
+    def commit(self, idx, meta=None):
+        """Queue slot `idx` for the consumer."""
+        with self.cond:
+            self.stamps[idx] = time.monotonic()
+            self.meta[idx]   = meta
+            self.queued.append(idx)
+            self.captured   += 1
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Oldest queued frame as (idx, y_plane view, commit stamp, meta), or
+        None on timeout / after close().  Call release(idx) when done.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.queued or self.closed, timeout):
+                return None
+            if not self.queued:
+                return None
+            idx = self.queued.popleft()
+            return idx, self.slots[idx], self.stamps[idx], self.meta[idx]
+
+    def release(self, idx):
+        with self.cond:
+            self.meta[idx] = None
+            self.free.append(idx)
+            self.cond.notify_all()
+
+    def depth(self):
+        with self.cond:
+            return len(self.queued)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
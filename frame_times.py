@@ -0,0 +1,49 @@
+"""
+Per-frame timestamps written by raspicam.py next to each segment
+(<segment>.h264 -> <segment>.times) and read by raspicam_server.py to give
+every decoded frame its exact time.
+
+File layout (little endian): 16 byte header b'BBFT', uint16 version,
+uint16 fps, int64 `start` (unix time of the first frame in microseconds),
+then one uint32 per encoded frame in file order: its sensor timestamp in
+microseconds after the first frame.  Frame n of the video was taken at
+start + offsets[n] microseconds; lost frames show up as gaps in the
+offsets instead of shifting the times of the frames after them.
+"""
+import os
+import numpy as np
+
+MAGIC   = b'BBFT'
+VERSION = 1
+HEADER  = np.dtype([('magic', 'S4'), ('version', '<u2'), ('fps', '<u2'), ('start', '<i8')])
+SUFFIX  = '.times'
+
+
+def sidecar_path(video_path):
+    return os.path.splitext(video_path)[0] + SUFFIX
+
+
+def write(path, start_us, stamps, fps):
+    """Write sensor timestamps `stamps` (us) of a segment whose first frame is at unix time start_us, atomically."""
+    stamps = np.asarray(stamps, np.int64)
+    tmp    = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(np.array((MAGIC, VERSION, fps, start_us), HEADER).tobytes())
+        f.write((stamps - stamps[0] if len(stamps) else stamps).astype('<u4').tobytes())
+    os.replace(tmp, path)
+
+
+def read(path):
+    """(fps, start in unix us, uint32 offsets in us) from a sidecar file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    head = np.frombuffer(data, HEADER, count=1)[0]
+    if head['magic'] != MAGIC or head['version'] != VERSION:
+        raise ValueError(f"{path}: not a version {VERSION} timestamp file")
+    return int(head['fps']), int(head['start']), np.frombuffer(data, '<u4', offset=HEADER.itemsize)
+
+
+def unix_times(path):
+    """(fps, unix time in secs of every frame of the video) from a sidecar file."""
+    fps, start, offsets = read(path)
+    return fps, (start + offsets.astype(np.int64)) / 1e6
@@ -0,0 +1,179 @@
+"""
+Event-driven discovery of new videos in the server's videodir.
+
+A watcher thread learns about new files from inotify (IN_MOVED_TO for
+files renamed into place, like FeederTransfer does, and IN_CLOSE_WRITE
+for files written in place) and additionally rescans the directory every
+`poll_interval` seconds, which is the only source when inotify is not
+available.  A file found by a rescan is complete once its size has not
+changed for `settle` seconds.  Complete videos wait in per-feeder queues
+ordered by recording time; get() blocks until there are any and returns
+them in that order, holding back a feeder's videos recorded after one of
+its files that is still settling.
+"""
+import ctypes, heapq, os, select, struct, threading, time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_Q_OVERFLOW  = 0x00004000
+EVENT          = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal inotify watch on one directory via libc; raises OSError where unavailable."""
+
+    def __init__(self, path, mask=IN_MOVED_TO | IN_CLOSE_WRITE):
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify not available")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0 or libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            raise OSError(ctypes.get_errno(), "inotify setup failed")
+
+    def read(self, timeout):
+        """Names of files with events within `timeout` seconds; None if events were lost."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        names, pos = [], 0
+        while pos < len(data):
+            _, mask, _, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            names.append(os.fsdecode(data[pos:pos + length].rstrip(b'\0')))
+            pos += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Ingest(threading.Thread):
+    """
+    Queue of complete videos in `videodir`.  parse(name) returns
+    (feeder_id, recording time) or None for files that are not videos.
+    Call done(name) once a video is processed and moved away.
+    """
+
+    def __init__(self, videodir, parse, settle=2.0, poll_interval=10.0, use_inotify=True):
+        super().__init__(daemon=True)
+        self.videodir      = videodir
+        self.parse         = parse
+        self.settle        = settle
+        self.poll_interval = poll_interval
+        self.cond          = threading.Condition()
+        self.queues        = {}     # feeder -> heap of (time, name)
+        self.known         = set()  # queued or being processed
+        self.sizes         = {}     # name -> (size, monotonic time the size was first seen)
+        self.settling      = {}     # feeder -> earliest recording time of its files still settling
+        self.running       = True
+        self.inotify       = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify(videodir)
+            except OSError as e:
+                print("ingest: no inotify (%s), polling every %.0f s" % (e, poll_interval))
+
+    def _add(self, name):
+        info = self.parse(name)
+        if info is None or name in self.known:
+            return
+        with self.cond:
+            self.known.add(name)
+            self.sizes.pop(name, None)
+            heapq.heappush(self.queues.setdefault(info[0], []), (info[1], name))
+            self.cond.notify_all()
+
+    def _rescan(self):
+        now, seen = time.monotonic(), set()
+        for entry in os.scandir(self.videodir):
+            name = entry.name
+            if name in self.known or not entry.is_file() or self.parse(name) is None:
+                continue
+            seen.add(name)
+            size = entry.stat().st_size
+            if self.sizes.get(name, (None,))[0] != size:
+                self.sizes[name] = (size, now)
+            elif now - self.sizes[name][1] >= self.settle:
+                self._add(name)
+        for name in set(self.sizes) - seen:
+            del self.sizes[name]
+        settling = {}
+        for name in self.sizes:
+            feeder, recorded = self.parse(name)
+            settling[feeder] = min(recorded, settling.get(feeder, recorded))
+        with self.cond:
+            self.settling = settling
+            self.cond.notify_all()
+
+    def run(self):
+        next_scan = 0.0
+        while self.running:
+            if time.monotonic() >= next_scan:
+                self._rescan()
+                # while files are settling, look again soon
+                next_scan = time.monotonic() + (min(self.settle, self.poll_interval) if self.sizes else self.poll_interval)
+            wait = max(0.0, next_scan - time.monotonic())
+            if self.inotify is None:
+                time.sleep(min(wait, 1.0))
+                continue
+            names = self.inotify.read(min(wait, 1.0))
+            if names is None:
+                next_scan = 0.0
+                continue
+            for name in names:
+                if os.path.isfile(os.path.join(self.videodir, name)):
+                    self._add(name)
+
+    def get(self, timeout=None):
+        """
+        Block up to `timeout` seconds for queued videos; returns all of them
+        as names, each feeder's videos in recording order ([] on timeout).
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self._ready() or not self.running, timeout)
+            names = []
+            for feeder, n in self._ready().items():
+                names += [heapq.heappop(self.queues[feeder])[1] for _ in range(n)]
+            return names
+
+    def _ready(self):
+        """{feeder: number of queued videos that can be handed out}, in feeder order."""
+        ready = {}
+        for feeder in sorted(self.queues):
+            heap, cutoff = self.queues[feeder], self.settling.get(feeder)
+            n = len(heap) if cutoff is None else sum(1 for recorded, _ in heap if recorded < cutoff)
+            if n:
+                ready[feeder] = n
+        return ready
+
+    def done(self, name):
+        with self.cond:
+            self.known.discard(name)
+
+    def backlog(self):
+        """{feeder: (videos, bytes, seconds since the oldest one was recorded)} of videos waiting or in processing."""
+        out, now = {}, time.time()
+        with self.cond:
+            names = list(self.known)
+        for name in names:
+            feeder, recorded = self.parse(name)
+            try:
+                size = os.path.getsize(os.path.join(self.videodir, name))
+            except OSError:
+                continue
+            n, total, oldest = out.get(feeder, (0, 0, 0.0))
+            out[feeder] = (n + 1, total + size, max(oldest, now - recorded.timestamp()))
+        return out
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.join(timeout=5)
+        if self.inotify is not None:
+            self.inotify.close()
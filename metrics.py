@@ -0,0 +1,167 @@
+import json, os, time
+from bisect import bisect_left
+
+# upper bounds of the changed-ratio histogram buckets (last one catches everything)
+RATIO_BUCKETS = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1.0)
+
+
+class StageTimer:
+    """count / sum / max of one pipeline stage, in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max   = 0.0
+
+    def add(self, dt):
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+
+    def as_dict(self):
+        mean = self.total / self.count if self.count else 0.0
+        return {'count': self.count, 'sum': self.total, 'mean': mean, 'max': self.max}
+
+
+class Metrics:
+    """
+    Hot-path counters for one camera.
+
+    Every counter has a single writer thread (capture, analysis or
+    finaliser), so updates are plain attribute increments.  The main thread
+    reads them at a low rate and writes a status file with write(): JSON,
+    or the Prometheus textfile format when the path ends in '.prom'.
+    Capture/drop counts come from the FrameRing, encoded/lost frames from
+    the SegmentOutput passed to snapshot().
+    """
+
+    def __init__(self, camera):
+        self.camera   = camera
+        self.started  = time.time()
+        # latency: ring commit -> segmentation decision done
+        self.stages   = {'capture_wait': StageTimer(), 'motion': StageTimer(),
+                         'latency': StageTimer(), 'finalise': StageTimer()}
+        self.analysed = 0
+        self.late     = 0
+        self.saved    = 0
+        self.deleted  = 0
+        self.ratio_counts = [0] * len(RATIO_BUCKETS)
+        self.ratio_sum    = 0.0
+        self._last        = None        # (monotonic, captured, analysed) at the previous snapshot
+
+    def observe_ratio(self, changed):
+        self.ratio_counts[min(bisect_left(RATIO_BUCKETS, changed), len(RATIO_BUCKETS) - 1)] += 1
+        self.ratio_sum += changed
+
+    def snapshot(self, ring, output, duty=None, storage=None, update=True):
+        """
+        Status dict; fps are over the time since the previous snapshot.
+        update=False leaves that window alone (readers other than the main thread).
+        """
+        now = time.monotonic()
+        captured, analysed = ring.captured, self.analysed
+        fps = {'capture': 0.0, 'analysis': 0.0}
+        last = self._last
+        if last is not None and now > last[0]:
+            dt  = now - last[0]
+            fps = {'capture':  (captured - last[1]) / dt,
+                   'analysis': (analysed - last[2]) / dt}
+        if update:
+            self._last = (now, captured, analysed)
+        return {
+            'camera':   self.camera,
+            'time':     time.time(),
+            'uptime':   time.time() - self.started,
+            'fps':      fps,
+            'frames':   {'captured': captured, 'analysed': analysed, 'dropped': ring.dropped,
+                         'late': self.late, 'queued': ring.depth(),
+                         'encoded': output.frames, 'lost': output.lost},
+            'segments': {'saved': self.saved, 'deleted': self.deleted,
+                         'boundaries': output.boundaries, 'lost_at_boundaries': output.boundary_lost},
+            'stages':   {name: t.as_dict() for name, t in self.stages.items()},
+            'changed_ratio': {'buckets': dict(zip(map(str, RATIO_BUCKETS), self.ratio_counts)),
+                              'sum': self.ratio_sum, 'count': sum(self.ratio_counts)},
+            'duty':     duty.as_dict() if duty is not None else None,
+            'storage':  storage.as_dict() if storage is not None else None,
+        }
+
+    def write(self, path, snap):
+        """Atomically replace `path` with `snap` as JSON or Prometheus text."""
+        text = to_prometheus(snap) if path.endswith('.prom') else json.dumps(snap, indent=1)
+        tmp  = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+
+def summary(snap):
+    """One status line for the journal."""
+    fr, sg = snap['frames'], snap['segments']
+    return (f"[stats] fps={snap['fps']['analysis']:.1f} captured={fr['captured']} analysed={fr['analysed']} "
+            f"dropped={fr['dropped']} late={fr['late']} queued={fr['queued']} "
+            f"encoded={fr['encoded']} lost={fr['lost']} saved={sg['saved']} deleted={sg['deleted']} "
+            f"lost_at_boundaries={sg['lost_at_boundaries']}"
+            + (f" duty={snap['duty']['mode']} skipped={snap['duty']['skipped']}" if snap.get('duty') else "")
+            + (f" stored={snap['storage']['segments']} uploaded={snap['storage']['uploaded']} "
+               f"evicted={snap['storage']['evicted']}" + (" FULL" if snap['storage']['full'] else "")
+               if snap.get('storage') else "")
+            + (f" health={snap['health']}" if snap.get('health', 'ok') != 'ok' else ""))
+
+
+def to_prometheus(snap):
+    cam   = f'camera="{snap["camera"]}"'
+    lines = ['# TYPE raspicam_frames_total counter']
+    lines += [f'raspicam_frames_total{{{cam},kind="{k}"}} {v}'
+              for k, v in snap['frames'].items() if k != 'queued']
+    lines += ['# TYPE raspicam_frames_queued gauge',
+              f'raspicam_frames_queued{{{cam}}} {snap["frames"]["queued"]}',
+              '# TYPE raspicam_fps gauge']
+    lines += [f'raspicam_fps{{{cam},stage="{k}"}} {v:.3f}' for k, v in snap['fps'].items()]
+    lines += ['# TYPE raspicam_segments_total counter']
+    lines += [f'raspicam_segments_total{{{cam},kind="{k}"}} {v}' for k, v in snap['segments'].items()]
+    lines += ['# TYPE raspicam_stage_seconds summary']
+    for name, t in snap['stages'].items():
+        lines += [f'raspicam_stage_seconds_sum{{{cam},stage="{name}"}} {t["sum"]:.6f}',
+                  f'raspicam_stage_seconds_count{{{cam},stage="{name}"}} {t["count"]}']
+    lines += ['# TYPE raspicam_stage_seconds_max gauge']
+    lines += [f'raspicam_stage_seconds_max{{{cam},stage="{name}"}} {t["max"]:.6f}'
+              for name, t in snap['stages'].items()]
+    hist, total = snap['changed_ratio'], 0
+    lines += ['# TYPE raspicam_changed_ratio histogram']
+    for le, n in hist['buckets'].items():
+        total += n
+        lines.append(f'raspicam_changed_ratio_bucket{{{cam},le="{le}"}} {total}')
+    lines += [f'raspicam_changed_ratio_bucket{{{cam},le="+Inf"}} {total}',
+              f'raspicam_changed_ratio_sum{{{cam}}} {hist["sum"]:.6f}',
+              f'raspicam_changed_ratio_count{{{cam}}} {hist["count"]}',
+              '# TYPE raspicam_uptime_seconds gauge',
+              f'raspicam_uptime_seconds{{{cam}}} {snap["uptime"]:.0f}']
+    if 'health' in snap:
+        lines += ['# TYPE raspicam_camera_health gauge']
+        lines += [f'raspicam_camera_health{{{cam},state="{state}"}} {int(snap["health"] == state)}'
+                  for state in ('ok', 'stalled', 'failed')]
+    duty = snap.get('duty')
+    if duty:
+        lines += ['# TYPE raspicam_duty_seconds_total counter']
+        lines += [f'raspicam_duty_seconds_total{{{cam},mode="{k}"}} {v:.1f}' for k, v in duty['seconds'].items()]
+        lines += ['# TYPE raspicam_duty_idle gauge',
+                  f'raspicam_duty_idle{{{cam}}} {int(duty["mode"] == "idle")}',
+                  '# TYPE raspicam_duty_switches_total counter',
+                  f'raspicam_duty_switches_total{{{cam}}} {duty["switches"]}',
+                  '# TYPE raspicam_duty_skipped_total counter',
+                  f'raspicam_duty_skipped_total{{{cam}}} {duty["skipped"]}']
+    st = snap.get('storage')
+    if st:
+        lines += ['# TYPE raspicam_storage_bytes gauge',
+                  f'raspicam_storage_bytes{{{cam},kind="used"}} {st["bytes"]}',
+                  f'raspicam_storage_bytes{{{cam},kind="quota"}} {st["quota"]}',
+                  f'raspicam_storage_bytes{{{cam},kind="free"}} {st["free"]}',
+                  '# TYPE raspicam_storage_segments gauge',
+                  f'raspicam_storage_segments{{{cam}}} {st["segments"]}',
+                  '# TYPE raspicam_storage_full gauge',
+                  f'raspicam_storage_full{{{cam}}} {int(st["full"])}',
+                  '# TYPE raspicam_storage_total counter']
+        lines += [f'raspicam_storage_total{{{cam},kind="{k}"}} {st[k]}'
+                  for k in ('uploaded', 'uploaded_bytes', 'upload_errors', 'evicted', 'refused_frames')]
+    return '\n'.join(lines) + '\n'
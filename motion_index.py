@@ -0,0 +1,115 @@
+"""
+Per-frame motion index written by raspicam.py next to each segment
+(<segment>.h264 -> <segment>.motion) and read by raspicam_server.py to
+skip frames without activity.
+
+File layout (little endian): 8 byte header b'BBMI', uint16 version,
+uint16 fps, then one RECORD per analysed frame.  `frame` is the position
+of the frame in the segment file (looked up in the encoder timestamps of
+the frames written, so frames the encoder dropped neither shift it nor
+get a record), `ts` the encoder timestamp in microseconds, `ratio` the changed
+ratio reported by Background and `flags` FLAG_MOTION | FLAG_ACTIVE |
+FLAG_SKIPPED.  Frames without a record (dropped before analysis) are
+unknown.  Frames the idle duty cycle left out (FLAG_SKIPPED) were not
+analysed; they count as without motion, so readers should use a margin
+of at least idle_interval secs around motion.
+"""
+import os, threading
+from collections import deque
+import numpy as np
+
+MAGIC       = b'BBMI'
+VERSION     = 1
+HEADER      = np.dtype([('magic', 'S4'), ('version', '<u2'), ('fps', '<u2')])
+RECORD      = np.dtype([('frame', '<u4'), ('ts', '<i8'), ('ratio', '<f4'), ('flags', 'u1')])
+FLAG_MOTION  = 1    # this frame had motion (Background.update_bg returned True)
+FLAG_ACTIVE  = 2    # motion within the last `delay` secs (Background.is_active())
+FLAG_SKIPPED = 4    # not analysed, the camera was idle (duty_cycle.DutyCycle)
+SUFFIX      = '.motion'
+
+
+def sidecar_path(video_path):
+    return os.path.splitext(video_path)[0] + SUFFIX
+
+
+class MotionLog:
+    """
+    Rolling per-frame motion records of one camera.  The analysis thread
+    add()s a record per lores frame; the finaliser cut()s the records of a
+    closed segment by timestamp, after waiting for analysis to catch up.
+
+    Records are keyed by sensor time (SensorTimestamp in us), segments by
+    encoder timestamps, which picamera2 counts from the first encoded
+    frame.  `epoch` returns the sensor time of encoder timestamp 0 (None
+    until the encoder saw a frame); without it both clocks are the same.
+    """
+
+    def __init__(self, maxlen, epoch=None):
+        self.records = deque(maxlen=maxlen)     # (ts_us, ratio, flags)
+        self.last_ts = None
+        self.epoch   = epoch
+        self.cond    = threading.Condition()
+
+    def add(self, ts_us, ratio, motion, active, skipped=False):
+        with self.cond:
+            self.records.append((ts_us, ratio, FLAG_MOTION * bool(motion) | FLAG_ACTIVE * bool(active)
+                                 | FLAG_SKIPPED * bool(skipped)))
+            self.last_ts = ts_us
+            self.cond.notify_all()
+
+    def cut(self, stamps, frame_us, timeout=2.0):
+        """RECORD array for the frames of a segment whose encoder timestamps, in file order, are `stamps`."""
+        offset = self.epoch() if self.epoch is not None else 0
+        if offset is None or not stamps:
+            return np.zeros(0, RECORD)
+        stamps = np.asarray(stamps, np.int64)
+        lo, hi = stamps[0] + offset - frame_us / 2, stamps[-1] + offset + frame_us / 2
+        with self.cond:
+            self.cond.wait_for(lambda: self.last_ts is not None and self.last_ts >= stamps[-1] + offset, timeout)
+            rows = [r for r in self.records if lo <= r[0] <= hi]
+        ts   = np.array([r[0] for r in rows], np.int64).reshape(-1) - offset
+        # the written frame within half a frame of each record; frames the encoder dropped have none
+        pos  = np.minimum(np.searchsorted(stamps, ts - frame_us / 2), len(stamps) - 1)
+        keep = np.abs(stamps[pos] - ts) < frame_us / 2
+        rows = [r for r, k in zip(rows, keep) if k]
+        out          = np.zeros(len(rows), RECORD)
+        out['frame'] = pos[keep]
+        out['ts']    = ts[keep]
+        out['ratio'] = [r[1] for r in rows]
+        out['flags'] = [r[2] for r in rows]
+        return out
+
+
+def write(path, records, fps):
+    """Write `records` to `path` atomically."""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(np.array((MAGIC, VERSION, fps), HEADER).tobytes())
+        f.write(records.astype(RECORD, copy=False).tobytes())
+    os.replace(tmp, path)
+
+
+def read(path):
+    """(fps, RECORD array) from a sidecar file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    head = np.frombuffer(data, HEADER, count=1)[0]
+    if head['magic'] != MAGIC or head['version'] != VERSION:
+        raise ValueError(f"{path}: not a version {VERSION} motion index")
+    return int(head['fps']), np.frombuffer(data, RECORD, offset=HEADER.itemsize)
+
+
+def activity_mask(records, n_frames=None, margin=0, flags=FLAG_MOTION):
+    """
+    Boolean per frame number: True where a frame within `margin` frames has
+    any of `flags`, or has no record at all (unknown frames are kept).
+    """
+    n     = int(records['frame'].max()) + 1 if len(records) else 0
+    n     = max(n, n_frames or 0)
+    known = np.zeros(n, np.bool_)
+    hit   = np.zeros(n, np.bool_)
+    known[records['frame']] = True
+    hit[records['frame'][(records['flags'] & flags) != 0]] = True
+    if margin and n:
+        hit = np.convolve(hit, np.ones(2 * margin + 1), mode='same') > 0
+    return hit | ~known
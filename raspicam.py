@@ -1,70 +1,480 @@
-import time, datetime, configparser, os, shutil, numpy as np
-from gpiozero import LED
-from picamera2 import Picamera2
-from picamera2.encoders import H264Encoder
-from picamera2.outputs import FileOutput
+import time, datetime, configparser, os, shutil, subprocess, threading, queue, numpy as np
+from collections import deque
+
+import camera_pool
+import control
+from duty_cycle import DutyCycle
+from frame_ring import FrameRing
+import frame_times
+import motion_index
+from metrics import Metrics, summary
+from motion_index import MotionLog
+from segment_output import SegmentOutput
+from storage import make_storage
+
+# Q8.8 fixed point: background values and alpha are stored scaled by 256
+FP_SHIFT = 8
+FP_ONE   = 1 << FP_SHIFT
+
+WHOLE_FRAME = np.s_[:, :]
+
+
+def _fractions(value):
+    """tile_threshold: one number, a list, or comma-separated text."""
+    return [float(v) for v in (value.split(',') if isinstance(value, str) else
+                               value if isinstance(value, (list, tuple)) else [value])]
+
+
+# parameters that can be changed at runtime (control socket): name -> (conversion, test, valid range)
+PARAMS = {
+    'alpha':          (float,      lambda v: 0 <= v < 1,                 "in [0, 1)"),
+    'diff_threshold': (int,        lambda v: 0 <= v < 255,               "in [0, 255)"),
+    'area_threshold': (float,      lambda v: 0 < v <= 1,                 "in (0, 1]"),
+    'delay':          (float,      lambda v: v >= 0,                     ">= 0"),
+    'tile_threshold': (_fractions, lambda v: all(0 < x <= 1 for x in v), "in (0, 1] (each value)"),
+    'min_tiles':      (int,        lambda v: v >= 1,                     ">= 1"),
+    'idle_after':     (float,      lambda v: v >= 0,                     ">= 0"),
+    'idle_interval':  (float,      lambda v: v >= 0,                     ">= 0"),
+}
+
+
+def check_param(key, value):
+    """`value` converted as PARAMS says; ValueError if it is out of range."""
+    convert, valid, allowed = PARAMS[key]
+    value = convert(value)
+    if not valid(value):
+        raise ValueError(f"{key} must be {allowed}")
+    return value
 
 
 class Background:
-    def __init__(self, alpha, diff_th, area_th, delay, w, h):
+    """
+    Exponential running-average background on the lores Y plane.
+
+    All per-frame work happens in buffers allocated once in __init__, so
+    update_bg() does not create any frame-sized temporaries.  With
+    fixed_point=True the average is kept as uint16 Q8.8 and blended with
+    integer arithmetic; alpha is then quantised to 1/256 and a pixel
+    decision can only differ from the float model when |bg - img| lies
+    within 1/256 of diff_th (see bench_background.py).
+    """
+
+    def __init__(self, alpha, diff_th, area_th, delay, w, h, fixed_point=False, verbose=False):
         self.alpha       = alpha
         self.diff_th     = diff_th      # per-pixel |bg – img| > diff_th
         self.area_th     = area_th      # fraction of pixels above that
         self.delay       = delay
         self.total       = w * h
+        self.fixed_point = fixed_point
+        self.verbose     = verbose      # print the changed ratio of every frame
+        self.changed     = 0.0          # changed ratio of the last frame
         self.initialized = False
         self.last_active = time.time()
 
-    def update_bg(self, img):
+        # preallocated work buffers, shape matches the (h, w) Y plane
+        self.mask = np.empty((h, w), np.bool_)
+        if fixed_point:
+            self.bg     = np.empty((h, w), np.uint16)
+            self._work  = np.empty((h, w), np.int32)
+            self._blend = np.empty((h, w), np.int32)
+        else:
+            self.bg    = np.empty((h, w), np.float32)
+            self._work = np.empty((h, w), np.float32)
+        self._derive()
+
+    def _derive(self):
+        """Constants derived from alpha and diff_th for the blend and the threshold."""
+        if self.fixed_point:
+            a = int(round(self.alpha * FP_ONE))
+            self._a_fp  = np.int32(a)
+            self._b_fp  = np.int32((FP_ONE - a) << FP_SHIFT)   # (1-alpha) * img<<8
+            self._th_fp = self.diff_th * FP_ONE
+        else:
+            self._a = np.float32(self.alpha)
+            self._b = np.float32(1 - self.alpha)
+
+    def params(self):
+        """The [Background] parameters set_params() can change, by their config names."""
+        return {'alpha': self.alpha, 'diff_threshold': self.diff_th, 'area_threshold': self.area_th,
+                'delay': self.delay}
+
+    def check_params(self, params):
+        """Validated and converted copy of `params` for set_params(); ValueError if one is bad."""
+        unknown = sorted(set(params) - set(self.params()))
+        if unknown:
+            raise ValueError(f"cannot change {', '.join(unknown)} (only {', '.join(self.params())})")
+        return {key: check_param(key, value) for key, value in params.items()}
+
+    def set_params(self, params):
+        """Apply check_params() output; called between frames by the analysis worker."""
+        self.alpha   = params.get('alpha', self.alpha)
+        self.diff_th = params.get('diff_threshold', self.diff_th)
+        self.area_th = params.get('area_threshold', self.area_th)
+        self.delay   = params.get('delay', self.delay)
+        self._derive()
+
+    def _diff_mask(self, img, sl=WHOLE_FRAME):
+        """Fill self.mask[sl] with |bg - img| > diff_th, in place."""
+        work, bg, img, mask = self._work[sl], self.bg[sl], img[sl], self.mask[sl]
+        if self.fixed_point:
+            np.copyto(work, img)
+            np.left_shift(work, FP_SHIFT, out=work)
+            np.subtract(work, bg, out=work)
+            np.abs(work, out=work)
+            np.greater(work, self._th_fp, out=mask)
+        else:
+            np.subtract(bg, img, out=work)
+            np.abs(work, out=work)
+            np.greater(work, self.diff_th, out=mask)
+        return mask
+
+    def _blend_in(self, img, sl=WHOLE_FRAME):
+        """bg[sl] = bg[sl] * alpha + img[sl] * (1 - alpha), in place."""
+        work, bg, img = self._work[sl], self.bg[sl], img[sl]
+        if self.fixed_point:
+            blend = self._blend[sl]
+            np.multiply(bg, self._a_fp, out=work)
+            np.multiply(img, self._b_fp, out=blend)
+            np.add(work, blend, out=work)
+            np.add(work, FP_ONE >> 1, out=work)             # round to nearest
+            np.right_shift(work, FP_SHIFT, out=work)
+            np.copyto(bg, work, casting='unsafe')
+        else:
+            np.multiply(bg, self._a, out=bg)
+            np.multiply(img, self._b, out=work)
+            np.add(bg, work, out=bg)
+
+    def _init_bg(self, img):
+        np.copyto(self.bg, img)
+        if self.fixed_point:
+            np.left_shift(self.bg, FP_SHIFT, out=self.bg)
+        self.initialized = True
+        print("[BG INIT] waiting for next frame…")
+
+    def update_bg(self, img, now=None):
         """
         Blend in a new lo-res frame, compute changed-pixel fraction,
         return True if changed >= area_th (frame motion).
+        `now` is the frame time (default: time.time()), replay passes its own.
         """
         if not self.initialized:
-            self.bg = img.astype(np.float32)
-            self.initialized = True
-            print("[BG INIT] waiting for next frame…")
+            self._init_bg(img)
             return False
 
-        diff    = np.abs(self.bg - img) > self.diff_th
-        changed = diff.sum() / self.total
-        print(f"Changed ratio: {changed:.4f}   (diff_th={self.diff_th}, area_th={self.area_th:.4f})")
-        self.bg = self.bg * self.alpha + img * (1 - self.alpha)
+        changed = self.changed = np.count_nonzero(self._diff_mask(img)) / self.total
+        if self.verbose:
+            print(f"Changed ratio: {changed:.4f}   (diff_th={self.diff_th}, area_th={self.area_th:.4f})")
+        self._blend_in(img)
 
         if changed >= self.area_th:
-            self.last_active = time.time()
+            self.last_active = time.time() if now is None else now
             return True
         return False
 
-    def is_active(self):
+    def is_active(self, now=None):
         """Still active if motion within last `delay` secs."""
-        return (time.time() - self.last_active) < self.delay
+        return ((time.time() if now is None else now) - self.last_active) < self.delay
 
 
-def run_camera(cfg_path):
-    cfg = configparser.ConfigParser()
-    cfg.read(cfg_path)
-
-    # Background params
-    alpha   = float(cfg['Background']['alpha'])
-    diff_th = int(cfg['Background']['diff_threshold'])
-    area_th = float(cfg['Background']['area_threshold'])
-    delay   = int(cfg['Background']['delay'])
-    scale   = float(cfg['Background']['scale_factor'])
-
-    # Recording params
-    fr      = int(cfg['Recording']['framerate'])
-    vid_len = int(cfg['Recording']['video_length'])
-    vid_dir = cfg['Recording']['video_dir']
-    feeder  = cfg['General']['feeder_id']
+class TiledBackground(Background):
+    """
+    Background with ROI-masked, tiled motion scoring.
 
-    # Picamera2 setup
-    picam2   = Picamera2()
-    cam_mode = int(cfg['Recording']['sensor_mode'])
-    mode     = picam2.sensor_modes[cam_mode]
-    sw, sh   = mode['size']
-    zx, zy   = float(cfg['Recording']['zoom_x']), float(cfg['Recording']['zoom_y'])
-    zw, zh   = float(cfg['Recording']['zoom_w']), float(cfg['Recording']['zoom_h'])
+    The lores frame is split into a cols x rows grid; only tiles that touch
+    the ROI mask are scored and blended.  A tile fires when the fraction of
+    its ROI pixels with |bg - img| > diff_th reaches its own threshold, and
+    the frame counts as motion once `min_tiles` tiles fired.  Tiles are
+    scored in order of recent activity, and scoring stops as soon as
+    `min_tiles` have fired; the background of the ROI bounding box is
+    still blended every frame.  `changed` is the largest tile ratio scored,
+    `tile_counts` the changed pixels per tile (-1: not scored this frame).
+    """
+
+    def __init__(self, alpha, diff_th, delay, w, h, grid, tile_th, min_tiles, roi=None,
+                 fixed_point=False, verbose=False):
+        super().__init__(alpha, diff_th, 1.0, delay, w, h, fixed_point=fixed_point, verbose=verbose)
+        cols, rows     = grid
+        self.min_tiles = min_tiles
+        roi            = np.ones((h, w), np.bool_) if roi is None else roi
+        xs = np.linspace(0, w, cols + 1).astype(int)
+        ys = np.linspace(0, h, rows + 1).astype(int)
+
+        # per tile: slice, ROI pixel count, threshold in pixels, ROI mask view if partial
+        self.tiles   = []
+        self.tile_th = list(tile_th)
+        tile_th      = np.broadcast_to(np.asarray(tile_th, np.float64), (rows * cols,))
+        for r in range(rows):
+            for c in range(cols):
+                sl = np.s_[ys[r]:ys[r + 1], xs[c]:xs[c + 1]]
+                n  = int(np.count_nonzero(roi[sl]))
+                if n == 0:
+                    continue
+                partial = roi[sl] if n < roi[sl].size else None
+                self.tiles.append((r * cols + c, sl, n, max(1, int(np.ceil(tile_th[r * cols + c] * n))), partial))
+        # one blend over the bounding box of the ROI tiles is cheaper than one per tile
+        r0, r1 = min(t[1][0].start for t in self.tiles), max(t[1][0].stop for t in self.tiles)
+        c0, c1 = min(t[1][1].start for t in self.tiles), max(t[1][1].stop for t in self.tiles)
+        self.blend_sl    = np.s_[r0:r1, c0:c1]
+        self.tile_counts = np.full(rows * cols, -1, np.int64)
+        self.heat        = np.zeros(len(self.tiles))      # decaying fire count, sets the scoring order
+        self.order       = list(range(len(self.tiles)))
+
+    def params(self):
+        params = super().params()
+        del params['area_threshold']
+        return dict(params, tile_threshold=self.tile_th, min_tiles=self.min_tiles)
+
+    def check_params(self, params):
+        out = super().check_params(params)
+        n   = len(out.get('tile_threshold', [0]))
+        if n not in (1, len(self.tile_counts)):
+            raise ValueError(f"tile_threshold needs 1 or {len(self.tile_counts)} values, got {n}")
+        return out
+
+    def set_params(self, params):
+        super().set_params(params)
+        self.min_tiles = params.get('min_tiles', self.min_tiles)
+        if 'tile_threshold' in params:
+            self.tile_th = params['tile_threshold']
+            tile_th      = np.broadcast_to(np.asarray(self.tile_th, np.float64), self.tile_counts.shape)
+            self.tiles   = [(tile, sl, n, max(1, int(np.ceil(tile_th[tile] * n))), partial)
+                            for tile, sl, n, _, partial in self.tiles]
+
+    def update_bg(self, img, now=None):
+        """
+        Score ROI tiles until `min_tiles` fired, blend all ROI tiles,
+        return True if the frame has motion.
+        """
+        if not self.initialized:
+            self._init_bg(img)
+            return False
+
+        fired, best = 0, 0.0
+        self.tile_counts.fill(-1)
+        self.heat *= 0.9
+        for i in self.order:
+            tile, sl, n, th, partial = self.tiles[i]
+            mask = self._diff_mask(img, sl)
+            if partial is not None:
+                np.logical_and(mask, partial, out=mask)
+            count = np.count_nonzero(mask)
+            self.tile_counts[tile] = count
+            best = max(best, count / n)
+            if count >= th:
+                fired += 1
+                self.heat[i] += 1
+                if fired >= self.min_tiles:
+                    break
+        self.order.sort(key=lambda i: -self.heat[i])
+        self.changed = best
+        if self.verbose:
+            print(f"Tiles fired: {fired}/{self.min_tiles}   max tile ratio {best:.4f}")
+
+        self._blend_in(img, self.blend_sl)
+
+        if fired >= self.min_tiles:
+            self.last_active = time.time() if now is None else now
+            return True
+        return False
+
+
+def load_roi(cfg, w, h):
+    """
+    ROI mask for the lores frame from [Background]: roi_mask (a .npy or
+    image file, non-zero = inside, resized to the lores size) and/or roi
+    (x0,y0,x1,y1 fractions of the frame, several separated by ';').
+    None if neither is set.
+    """
+    sec = cfg['Background']
+    if not sec.get('roi_mask') and not sec.get('roi'):
+        return None
+    roi = np.zeros((h, w), np.bool_)
+    if sec.get('roi_mask'):
+        path = sec['roi_mask']
+        if path.endswith('.npy'):
+            m = np.load(path)
+        else:
+            import cv2
+            m = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if m.shape != (h, w):
+            import cv2
+            m = cv2.resize(m.astype(np.uint8), (w, h), interpolation=cv2.INTER_NEAREST)
+        roi |= m > 0
+    for rect in filter(None, sec.get('roi', '').split(';')):
+        x0, y0, x1, y1 = (float(v) for v in rect.split(','))
+        roi[int(y0 * h):int(np.ceil(y1 * h)), int(x0 * w):int(np.ceil(x1 * w))] = True
+    return roi
+
+
+def make_background(cfg, w, h, verbose=False):
+    """Background for [Background] detector = global (default) or tiled."""
+    sec     = cfg['Background']
+    alpha   = float(sec['alpha'])
+    diff_th = int(sec['diff_threshold'])
+    delay   = int(sec['delay'])
+    fixed   = sec.getboolean('fixed_point', fallback=False)
+    if sec.get('detector', 'global') == 'tiled':
+        grid    = tuple(int(v) for v in sec.get('tiles', '8x4').split('x'))
+        tile_th = [float(v) for v in sec.get('tile_threshold', '0.05').split(',')]
+        if len(tile_th) not in (1, grid[0] * grid[1]):
+            raise ValueError(f"tile_threshold needs 1 or {grid[0] * grid[1]} values, got {len(tile_th)}")
+        return TiledBackground(alpha, diff_th, delay, w, h, grid, tile_th,
+                               sec.getint('min_tiles', fallback=1), load_roi(cfg, w, h),
+                               fixed_point=fixed, verbose=verbose)
+    return Background(alpha, diff_th, float(sec['area_threshold']), delay, w, h,
+                      fixed_point=fixed, verbose=verbose)
+
+
+class Finaliser(threading.Thread):
+    """
+    Moves finished segments to out_dir (motion) or deletes them, off the
+    analysis thread.  Kept segments get their sidecars written to out_dir
+    before the video is moved there: the per-frame timestamps and, with a
+    MotionLog, the motion index.  With `container` ('mp4' or 'mkv') the
+    raw H.264 is remuxed into that container without re-encoding, so the
+    server can seek in it; if ffmpeg fails the .h264 is kept.  With a
+    camera_pool.WorkerPool the jobs run on the pool instead of this thread.
+    """
+
+    def __init__(self, out_dir, metrics, motion_log=None, fr=None, storage=None, container=None, pool=None):
+        super().__init__(name='finaliser', daemon=True)
+        self.out_dir    = out_dir
+        self.metrics    = metrics
+        self.motion_log = motion_log
+        self.fr         = fr
+        self.storage    = storage
+        self.container  = container
+        self.pool       = pool
+        self.jobs       = queue.Queue() if pool is None else deque()
+
+    def submit(self, filename, keep, span=None, times=None):
+        if self.pool is None:
+            self.jobs.put((filename, keep, span, times))
+            return
+        with self.pool.cond:
+            self.jobs.append((filename, keep, span, times))
+            self.pool.cond.notify_all()
+
+    # --- camera_pool unit ---------------------------------------------------
+
+    def start(self):
+        if self.pool is None:
+            super().start()
+        else:
+            self.pool.register(self, camera_pool.FINALISE)
+
+    def pending(self):
+        return bool(self.jobs)
+
+    def work(self):
+        with self.pool.cond:
+            job = self.jobs.popleft()
+        self.finalise(*job)
+
+    def write_index(self, dest, times):
+        if self.motion_log is None or times is None or not times[1] or None in times[1]:
+            return
+        records = self.motion_log.cut(times[1], 1e6 / self.fr)
+        motion_index.write(motion_index.sidecar_path(dest), records, self.fr)
+
+    def write_times(self, dest, times):
+        if times is None or times[0] is None or not times[1] or None in times[1]:
+            return
+        start, stamps = times
+        frame_times.write(frame_times.sidecar_path(dest), int(start.timestamp() * 1e6), stamps, self.fr)
+
+    def remux(self, filename):
+        """`filename` remuxed into self.container next to it; None (keep the .h264) if that fails."""
+        out = os.path.splitext(filename)[0] + '.' + self.container
+        cmd = ['ffmpeg', '-v', 'error', '-nostdin', '-y', '-framerate', str(self.fr), '-i', filename, '-c', 'copy']
+        if self.container == 'mp4':
+            cmd += ['-movflags', '+faststart']
+        try:
+            subprocess.run(cmd + [out], check=True, capture_output=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            detail = e.stderr.decode(errors='replace').strip() if getattr(e, 'stderr', None) else e
+            print(f"[finaliser] remux of {filename} failed, keeping the .h264: {detail}")
+            if os.path.exists(out):
+                os.remove(out)
+            return None
+        os.remove(filename)
+        return out
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.wait_idle(self)
+            self.pool.unregister(self)
+            return
+        self.jobs.put(None)
+        self.join()
+
+    def run(self):
+        while (job := self.jobs.get()) is not None:
+            self.finalise(*job)
+
+    def finalise(self, filename, keep, span, times):
+        t0 = time.perf_counter()
+        try:
+            if keep:
+                if self.container:
+                    filename = self.remux(filename) or filename
+                dest = os.path.join(self.out_dir, os.path.basename(filename))
+                self.write_index(dest, times)
+                self.write_times(dest, times)
+                shutil.move(filename, dest)
+                self.metrics.saved += 1
+                if self.storage is not None:
+                    self.storage.add(dest)
+                print(f"— saved   (motion): {dest}")
+            else:
+                os.remove(filename)
+                self.metrics.deleted += 1
+                print(f"— deleted (no motion): {filename}")
+        except OSError as e:
+            print(f"[finaliser] {filename}: {e}")
+        self.metrics.stages['finalise'].add(time.perf_counter() - t0)
+
+
+def capture_lores(picam2, cam_lock, ring, stop, metrics, camera=None):
+    """
+    Capture thread: copy each lores Y plane straight from the camera buffer
+    into the ring.  Snapshots queued on `camera` (control.Camera) get the
+    main-stream Y plane of the same request.
+    """
+    from picamera2 import MappedArray
+
+    h, w = ring.slots.shape[1:]
+    wait = metrics.stages['capture_wait']
+    while not stop.is_set():
+        with cam_lock:
+            t0  = time.perf_counter()
+            req = picam2.capture_request()
+            wait.add(time.perf_counter() - t0)
+            try:
+                idx = ring.acquire()
+                with MappedArray(req, 'lores') as m:
+                    np.copyto(ring.slots[idx], m.array[:h, :w])
+                meta = req.get_metadata()
+                if camera is not None and not camera.grabs.empty():
+                    mw, mh = camera.main_size
+                    with MappedArray(req, 'main') as m:
+                        frame = m.array[:mh, :mw].copy()
+                    while not camera.grabs.empty():
+                        camera.grabs.get().fill(frame, meta)
+            finally:
+                req.release()
+        ring.commit(idx, meta)
+
+
+def stream_sizes(cfg, sensor_size):
+    """
+    Crop, main-stream and lores-stream sizes for a sensor mode of
+    `sensor_size`, following the zoom/scale settings in `cfg`.
+    Returns (cam_w, cam_h), (out_w, out_h), (bg_w, bg_h).
+    """
+    sw, sh = sensor_size
+    zw, zh = float(cfg['Recording']['zoom_w']), float(cfg['Recording']['zoom_h'])
+    scale  = float(cfg['Background']['scale_factor'])
 
     # Compute crop sizes
     cam_w  = round(sw * zw / 32) * 32
@@ -79,19 +489,332 @@ def run_camera(cfg_path):
         out_w = int(out_h * aspect)
 
     # Low-res buffer size
-    bg_w     = round((cam_w * scale) / 32) * 32
-    bg_h     = round((cam_h * scale) / 16) * 16
-    frame_us = int(1e6 / fr)
+    bg_w = round((cam_w * scale) / 32) * 32
+    bg_h = round((cam_h * scale) / 16) * 16
+    return (cam_w, cam_h), (out_w, out_h), (bg_w, bg_h)
 
-    bg = Background(alpha, diff_th, area_th, delay, bg_w, bg_h)
 
-    # Directory layout
-    # tmp directory as sibling to Videos (parent of vid_dir)
-    parent = os.path.dirname(os.path.abspath(vid_dir))
-    tmp_dir = os.path.join(parent, 'tmp')
-    out_dir = os.path.join(vid_dir, feeder)
-    os.makedirs(tmp_dir, exist_ok=True)
-    os.makedirs(out_dir, exist_ok=True)
+class CameraPipeline:
+    """
+    Everything between a lores frame source and the segment files of one
+    camera: FrameRing, Background, SegmentOutput, Finaliser, Metrics, LEDs.
+
+    A frame source is a callable source(ring, stop, metrics) run on the
+    capture thread (capture_lores on the Pi, replay.ReplaySource off it);
+    the encoder (H264Encoder or replay.FakeEncoder) writes into `output`.
+    Ring entries whose meta carries a 'time' key are analysed on that
+    clock instead of time.time(), so replays can run faster than real time.
+    With a camera_pool.WorkerPool (several cameras in one process) analysis
+    and finalisation run on the pool instead of threads of their own.
+    """
+
+    def __init__(self, cfg, lores_size, leds, vid_dir=None, wallclock=datetime.datetime.now, pool=None):
+        bg_w, bg_h = lores_size
+        self.pool  = pool
+
+        # Metrics: status file written every `interval` secs, per-frame printing only on request
+        self.status_file  = cfg.get('Metrics', 'status_file', fallback=None)
+        self.status_every = cfg.getfloat('Metrics', 'interval', fallback=10)
+        self.stats_every  = cfg['Recording'].getfloat('stats_interval', fallback=60)
+        self.debug_frames = cfg.getboolean('Metrics', 'debug_frames', fallback=False)
+        # health: 'stalled' once no frame was captured for stall_after secs
+        self.stall_after  = cfg.getfloat('Metrics', 'stall_after', fallback=5)
+        self.last_status  = self.last_report = time.monotonic()
+        self.seen         = (0, time.monotonic())     # (ring.captured, monotonic time it last changed)
+
+        # Recording params
+        fr           = int(cfg['Recording']['framerate'])
+        vid_len      = int(cfg['Recording']['video_length'])
+        vid_dir      = vid_dir or cfg['Recording']['video_dir']
+        self.feeder  = cfg['General']['feeder_id']
+        self.fr      = fr
+
+        self.bg      = make_background(cfg, bg_w, bg_h, verbose=self.debug_frames)
+        self.metrics = Metrics(self.feeder)
+        # idle_after secs without motion: analyse one lores frame every idle_interval secs
+        self.duty    = DutyCycle(cfg['Background'].getfloat('idle_after', fallback=0),
+                                 cfg['Background'].getfloat('idle_interval', fallback=0.5))
+
+        # Directory layout
+        # tmp directory as sibling to Videos (parent of vid_dir)
+        parent       = os.path.dirname(os.path.abspath(vid_dir))
+        self.tmp_dir = os.path.join(parent, 'tmp')
+        self.out_dir = os.path.join(vid_dir, self.feeder)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(self.out_dir, exist_ok=True)
+
+        # record_mode = continuous: every segment is encoded to tmp_dir, kept or deleted at its end
+        # record_mode = motion:     encoded frames stay in RAM, only motion (plus pre_roll secs
+        #                           before and `delay` secs after) is written, in video_length pieces
+        # Either way the encoder runs untouched, SegmentOutput cuts every fr * video_length
+        # encoded frames.
+        self.gated     = cfg['Recording'].get('record_mode', fallback='continuous') == 'motion'
+        pre_roll       = cfg['Recording'].getfloat('pre_roll', fallback=5)
+        motion_log     = None
+        if cfg['Recording'].getboolean('motion_index', fallback=True):
+            motion_log = MotionLog(int((pre_roll + vid_len + 10) * fr))
+        self.motion_log = motion_log
+        # [Storage]: disk quota, eviction by motion score and upload of saved segments
+        self.storage    = make_storage(cfg, self.out_dir)
+        # container = mp4 / mkv: kept segments are remuxed (no re-encode) into a seekable container
+        container       = cfg['Recording'].get('container', fallback='').strip().lower() or None
+        if container not in (None, 'mp4', 'mkv'):
+            raise ValueError(f"[Recording] container must be mp4, mkv or empty, not {container!r}")
+        self.finaliser  = Finaliser(self.out_dir, self.metrics, motion_log, fr, self.storage, container, pool)
+        self.output    = SegmentOutput(int((pre_roll + 1) * fr) if self.gated else 1, self.finaliser.submit,
+                                       split_every=fr * vid_len, frame_us=int(1e6 / fr), now=wallclock)
+
+        # Capture thread -> FrameRing -> analysis worker -> Finaliser
+        self.ring       = FrameRing(cfg['Recording'].getint('ring_size', fallback=8), bg_w, bg_h,
+                                    pool.cond if pool is not None else None)
+        self.late_after = cfg['Recording'].getfloat('late_frames', fallback=2) / fr
+        self.stop       = threading.Event()
+        self.threads    = []
+        self.led_green, self.led_yellow = leds
+        # [Background] changes from the control socket, applied by the analysis worker between frames
+        self.bg_updates = queue.SimpleQueue()
+        self.control    = None
+
+    def use_encoder(self, encoder):
+        """Put the motion log on `encoder`'s clock (timestamps relative to its first frame)."""
+        if self.motion_log is not None:
+            self.motion_log.epoch = lambda: encoder.firsttimestamp
+
+    def new_filename(self, start=None):
+        start = start or datetime.datetime.now()
+        return os.path.join(self.tmp_dir, f"{self.feeder}_{start:%Y-%m-%d-%H-%M-%S}.h264")
+
+    def start(self, source=None):
+        """Start the finaliser, the analysis worker and (if given) a capture thread running `source`."""
+        if not self.gated:
+            self.output.open(self.new_filename)
+        self.threads = []
+        if self.pool is None:
+            self.threads.append(threading.Thread(target=self.analyse, name='analysis', daemon=True))
+        if source is not None:
+            self.threads.append(threading.Thread(target=source, args=(self.ring, self.stop, self.metrics),
+                                                 name=f'capture-{self.feeder}', daemon=True))
+        self.finaliser.start()
+        if self.storage is not None:
+            self.storage.start()
+        if self.pool is not None:
+            self.pool.register(self, camera_pool.ANALYSIS)
+        for t in self.threads:
+            t.start()
+
+    def analyse(self):
+        """Analysis worker: consume the ring until it is closed and drained."""
+        while True:
+            item = self.ring.get(timeout=1)
+            if item is None:
+                if self.ring.closed:
+                    return
+                continue
+            self.analyse_frame(item)
+
+    # --- camera_pool unit: a few queued frames per turn, in order -----------
+
+    def pending(self):
+        return bool(self.ring.queued)
+
+    def work(self, batch=4):
+        for _ in range(batch):
+            item = self.ring.get(timeout=0)
+            if item is None:
+                return
+            self.analyse_frame(item)
+
+    def background_params(self):
+        return dict(self.bg.params(), idle_after=self.duty.idle_after, idle_interval=self.duty.idle_interval)
+
+    def set_background(self, params):
+        """
+        Validate new [Background] parameters (Background.params() plus
+        idle_after / idle_interval) and queue them for the analysis worker;
+        raises ValueError and changes nothing if one is bad.  Returns the
+        converted values.
+        """
+        params  = dict(params)
+        duty    = {key: check_param(key, params.pop(key)) for key in ('idle_after', 'idle_interval') if key in params}
+        checked = dict(self.bg.check_params(params), **duty)
+        self.bg_updates.put(checked)
+        return checked
+
+    def _apply_updates(self):
+        while not self.bg_updates.empty():
+            params = self.bg_updates.get()
+            self.bg.set_params(params)
+            self.duty.idle_after    = params.get('idle_after', self.duty.idle_after)
+            self.duty.idle_interval = params.get('idle_interval', self.duty.idle_interval)
+            print(f"[{self.feeder}] background: {params}")
+
+    def analyse_frame(self, item):
+        metrics = self.metrics
+        if not self.bg_updates.empty():
+            self._apply_updates()
+        idx, y_plane, stamp, meta = item
+        now = meta.get('time') if isinstance(meta, dict) else None
+        if not self.duty.want(time.time() if now is None else now):
+            self.ring.release(idx)
+            self.skip(meta)
+            return
+        try:
+            if time.monotonic() - stamp > self.late_after:
+                metrics.late += 1
+
+            # Background update
+            t0 = time.perf_counter()
+            frame_motion = self.bg.update_bg(y_plane, now)
+            metrics.stages['motion'].add(time.perf_counter() - t0)
+        finally:
+            self.ring.release(idx)
+        active = self.step(frame_motion, now)
+        self.duty.update(time.time() if now is None else now, frame_motion, active)
+        if self.motion_log is not None and isinstance(meta, dict) and 'SensorTimestamp' in meta:
+            self.motion_log.add(meta['SensorTimestamp'] // 1000, self.bg.changed, frame_motion, active)
+        metrics.analysed += 1
+        metrics.observe_ratio(self.bg.changed)
+        metrics.stages['latency'].add(time.monotonic() - stamp)
+
+    def skip(self, meta):
+        """A frame left out by the duty cycle: idle, so logged without motion and not active."""
+        if self.motion_log is not None and isinstance(meta, dict) and 'SensorTimestamp' in meta:
+            self.motion_log.add(meta['SensorTimestamp'] // 1000, 0.0, False, False, skipped=True)
+        self.led_green.toggle()
+
+    def step(self, frame_motion, now=None):
+        """Segmentation decision and LEDs for one analysed frame; returns bg.is_active()."""
+        bg, output = self.bg, self.output
+        active     = bg.is_active(now)
+        # storage backpressure: nothing left to evict, keep no new segments until there is space
+        full       = self.storage is not None and self.storage.full.is_set()
+        if full and frame_motion:
+            self.storage.refused_frames += 1
+        if self.gated:
+            if output.is_open():
+                if not active:                    # post-roll of `delay` secs is over
+                    output.close()
+            elif frame_motion and not full:
+                output.open(self.new_filename, keep=True)
+            if self.debug_frames:
+                print(f"frame_motion={frame_motion}, recording={output.is_open()}")
+        else:
+            if (frame_motion or active) and not full:
+                output.mark_keep()
+            if self.debug_frames:
+                print(f"frame_motion={frame_motion}, segment_active={frame_motion or active}")
+
+        # LEDs
+        self.led_green.toggle()
+        self.led_yellow.value = active
+        return active
+
+    def alive(self):
+        """False once the capture or analysis thread (or this camera's pool work) died."""
+        if self.pool is not None and (self in self.pool.failed or self.finaliser in self.pool.failed):
+            return False
+        return all(t.is_alive() for t in self.threads)
+
+    def health(self, update=True):
+        """
+        'ok', 'stalled' (no frame captured for stall_after secs) or 'failed'
+        (a thread died).  update=False does not move the stall clock.
+        """
+        if not self.alive() and not self.stop.is_set():
+            return 'failed'
+        now, captured = time.monotonic(), self.ring.captured
+        if captured != self.seen[0]:
+            if not update:
+                return 'ok'
+            self.seen = (captured, now)
+        return 'stalled' if now - self.seen[1] > self.stall_after and not self.stop.is_set() else 'ok'
+
+    def report(self):
+        """Write the status file / print the summary when due; called about once a second."""
+        now = time.monotonic()
+        if self.status_file and now - self.last_status >= self.status_every:
+            self.metrics.write(self.status_file, self.snapshot())
+            self.last_status = now
+        if now - self.last_report >= self.stats_every:
+            print(summary(self.snapshot()))
+            self.last_report = now
+
+    def supervise(self):
+        """Main thread: write status/summary until a worker dies or stop is set."""
+        while self.alive() and not self.stop.is_set():
+            self.stop.wait(1)
+            self.report()
+        if not self.stop.is_set():
+            raise RuntimeError("capture/analysis thread died, see traceback above")
+
+    def shutdown(self, stop_encoder):
+        """Stop the source, drain the ring, stop the encoder (closing the open segment), finalise."""
+        self.stop.set()
+        if self.control is not None:
+            self.control.close()
+        self.ring.close()
+        for t in self.threads:
+            t.join(timeout=5)
+        if self.pool is not None:
+            self.pool.wait_idle(self, timeout=10)
+            self.pool.unregister(self)
+        stop_encoder()
+        self.finaliser.close()
+        if self.storage is not None:
+            self.storage.close()
+        print(summary(self.snapshot()))
+
+    def snapshot(self, update=True):
+        """Metrics snapshot plus health; update=False for readers off the main thread (control socket)."""
+        snap           = self.metrics.snapshot(self.ring, self.output, self.duty, self.storage, update)
+        snap['health'] = self.health(update)
+        return snap
+
+
+class NoLED:
+    """LED stand-in for cameras configured without LEDs."""
+    value = False
+
+    def toggle(self):
+        pass
+
+
+def make_leds(cfgs):
+    """
+    (green, yellow) per camera config from [General] leds = <green pin>,<yellow pin>
+    (default 16,20; empty: none).  Cameras naming the same pins share one
+    gpiozero LED, so several cameras in a process do not claim a pin twice.
+    """
+    from gpiozero import LED
+
+    by_pin, out = {}, []
+    for cfg in cfgs:
+        pins = cfg['General'].get('leds', fallback='16,20').strip()
+        if not pins:
+            out.append((NoLED(), NoLED()))
+            continue
+        out.append(tuple(by_pin.setdefault(pin, LED(pin)) for pin in map(int, pins.split(','))))
+    return out
+
+
+def start_camera(cfg, leds, camera_num=0, pool=None):
+    """Configure and start camera `camera_num` for `cfg`; returns (pipeline, stop_encoder)."""
+    from picamera2 import Picamera2
+    from picamera2.encoders import H264Encoder
+
+    fr = int(cfg['Recording']['framerate'])
+
+    # Picamera2 setup
+    picam2   = Picamera2(camera_num)
+    cam_mode = int(cfg['Recording']['sensor_mode'])
+    mode     = picam2.sensor_modes[cam_mode]
+    sw, sh   = mode['size']
+    zx, zy   = float(cfg['Recording']['zoom_x']), float(cfg['Recording']['zoom_y'])
+
+    (cam_w, cam_h), (out_w, out_h), (bg_w, bg_h) = stream_sizes(cfg, (sw, sh))
+    frame_us = int(1e6 / fr)
+
+    pipeline = CameraPipeline(cfg, (bg_w, bg_h), leds=leds, pool=pool)
 
     # Video configuration
     video_config = picam2.create_video_configuration(
@@ -125,73 +848,103 @@ def run_camera(cfg_path):
     picam2.start()
     time.sleep(2)
 
-    # Prepare first segment
-    def new_filename(dir_):
-        return os.path.join(dir_, f"{feeder}_{datetime.datetime.now():%Y-%m-%d-%H-%M-%S}.h264")
-
-    target_frames = fr * vid_len
-    frame_counter = 0
-    segment_motion = False
-
-    filename = new_filename(tmp_dir)
-    encoder  = H264Encoder(
+    encoder = H264Encoder(
         bitrate             = cfg['Recording'].getint('bitrate', fallback=-1) or 8_000_000,
         framerate           = fr,
         repeat              = True,
-        enable_sps_framerate= True
+        enable_sps_framerate= True,
+        # a keyframe every second: segments are split on keyframes and the
+        # pre-roll can start close to its target
+        iperiod             = fr
     )
-    picam2.start_recording(encoder, FileOutput(filename))
+    pipeline.use_encoder(encoder)
+    picam2.start_recording(encoder, pipeline.output)
 
-    led_green  = LED(16)
-    led_yellow = LED(20)
+    cam_lock = threading.Lock()
+    camera   = control.Camera(picam2, controls, (out_w, out_h))
 
-    # Main loop
-    while True:
-        job = picam2.capture_buffer('lores', wait=False)
-        if job is None:
-            time.sleep(0.01)
-            continue
-        buf     = picam2.wait(job)
-        arr     = np.frombuffer(buf, np.uint8)
-        y_plane = arr[:bg_w*bg_h].reshape((bg_h, bg_w))
-
-        # Background update
-        frame_motion = bg.update_bg(y_plane)
-        if frame_motion or bg.is_active():
-            segment_motion = True
-        print(f"frame_motion={frame_motion}, segment_active={segment_motion}")
-
-        # Frame count split
-        frame_counter += 1
-        if frame_counter >= target_frames:
+    def stop_encoder():
+        with cam_lock:
             picam2.stop_recording()
-            if segment_motion:
-                dest = os.path.join(out_dir, os.path.basename(filename))
-                shutil.move(filename, dest)
-                print(f"— saved   (motion): {dest}")
-            else:
-                os.remove(filename)
-                print(f"— deleted (no motion): {filename}")
 
-            # Reset for next segment
-            filename = new_filename(tmp_dir)
-            encoder  = H264Encoder(
-                bitrate             = cfg['Recording'].getint('bitrate', fallback=-1) or 8_000_000,
-                framerate           = fr,
-                repeat              = True,
-                enable_sps_framerate= True
-            )
-            picam2.start_recording(encoder, FileOutput(filename))
-            frame_counter  = 0
-            segment_motion = False
+    pipeline.start(lambda ring, stop, metrics: capture_lores(picam2, cam_lock, ring, stop, metrics, camera))
+    pipeline.control = control.make_control(cfg, pipeline, camera)
+    return pipeline, stop_encoder
+
+
+def supervise_cameras(cameras, stop):
+    """
+    Main thread of a multi-camera process: per-camera status and health
+    until `stop` is set.  A failed camera is shut down while the others
+    keep recording; raises once every camera has failed.
+    """
+    failed, health = set(), {}
+    while not stop.is_set():
+        stop.wait(1)
+        for i, (pipeline, stop_encoder) in enumerate(cameras):
+            if i in failed:
+                continue
+            state = pipeline.health()
+            if state != health.get(i, 'ok'):
+                print(f"[{pipeline.feeder}] health: {state}")
+            health[i] = state
+            if state == 'failed':
+                failed.add(i)
+                pipeline.shutdown(stop_encoder)
+                continue
+            pipeline.report()
+        if len(failed) == len(cameras):
+            raise RuntimeError("all cameras failed, see tracebacks above")
 
-        # LEDs
-        led_green.toggle()
-        led_yellow.value = bg.is_active()
 
+def run_cameras(cfg_paths, workers=2):
+    """
+    One process for the cameras of `cfg_paths`: its own Picamera2, encoder
+    and capture thread per camera ([Recording] camera = CSI port, default
+    the position in cfg_paths).  A single camera runs as before.  With
+    several cameras, analysis and finalisation share a WorkerPool of
+    `workers` threads.
+    """
+    cfgs = []
+    for path in cfg_paths:
+        cfg = configparser.ConfigParser()
+        cfg.read(path)
+        cfgs.append(cfg)
+    # cameras of one process sharing a status file or control socket: one per camera,
+    # <name>_<feeder_id><ext>
+    for section, key in (('Metrics', 'status_file'), ('Control', 'socket')):
+        paths = [cfg.get(section, key, fallback='') for cfg in cfgs]
+        for cfg, path in zip(cfgs, paths):
+            if path and paths.count(path) > 1:
+                root, ext = os.path.splitext(path)
+                cfg[section][key] = f"{root}_{cfg['General']['feeder_id']}{ext}"
+
+    leds    = make_leds(cfgs)
+    pool    = camera_pool.WorkerPool(workers) if len(cfgs) > 1 else None
+    cameras = []
+    try:
+        for i, cfg in enumerate(cfgs):
+            cameras.append(start_camera(cfg, leds[i], cfg['Recording'].getint('camera', fallback=i), pool))
+        if pool is None:
+            cameras[0][0].supervise()
+        else:
+            supervise_cameras(cameras, threading.Event())
+    finally:
+        for pipeline, stop_encoder in cameras:
+            if not pipeline.stop.is_set():
+                pipeline.shutdown(stop_encoder)
+        if pool is not None:
+            pool.close()
+
+
+def run_camera(cfg_path):
+    run_cameras([cfg_path])
 
 if __name__ == '__main__':
     import argparse
     p = argparse.ArgumentParser()
-    p.add_argument('config_path', default='feedercam.cfg')
-    run_camera(p.parse_args().config_path)
\ No newline at end of file
+    p.add_argument('config_path', nargs='+', help='camera config(s); several run in one process, one camera each')
+    p.add_argument('--workers', type=int, default=2,
+                   help='analysis/finalisation threads shared by several cameras')
+    args = p.parse_args()
+    run_cameras(args.config_path, args.workers)
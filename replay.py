@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Hardware-free replay of the raspicam motion/segmentation loop.
+
+Feeds recorded lores frames through the same CameraPipeline as the Pi
+(FrameRing, Background, SegmentOutput, Finaliser), with a fake encoder
+and fake LEDs, on the frame clock instead of the wall clock.
+
+    # segmentation decisions for a recorded clip, with trial thresholds
+    python3 replay.py run feedercam.cfg --input clip.mp4 --diff-threshold 15
+    # analysis throughput / latency at the configured lores sizes
+    python3 replay.py bench exitcam.cfg feedercam.cfg [--input dump.y]
+    # both cameras at once on one shared worker pool, like raspicam.py with two configs
+    python3 replay.py bench exitcam.cfg feedercam.cfg --shared 2
+
+Inputs: .npy arrays of shape (n, h, w), raw Y-plane dumps (.y/.gray,
+consecutive h*w planes), raw YUV420 dumps (.yuv), or any video OpenCV
+can read (converted to gray and resized to the lores size).
+"""
+import argparse, configparser, datetime, os, shutil, tempfile, time
+import numpy as np
+
+from camera_pool import WorkerPool
+from raspicam import CameraPipeline, stream_sizes
+from segment_output import Output
+
+
+class FakeLED:
+    """gpiozero.LED stand-in."""
+
+    def __init__(self):
+        self.value   = False
+        self.toggles = 0
+
+    def toggle(self):
+        self.value    = not self.value
+        self.toggles += 1
+
+
+class FakeEncoder:
+    """
+    H264Encoder stand-in: emits one `packet_size` byte packet per frame into
+    `output`, with a keyframe every `iperiod` frames and frame-clock
+    timestamps, like the real encoder does with repeat=True, iperiod=fr.
+    Like picamera2's encoders it only takes a picamera2 Output and stamps
+    frames relative to the first one (firsttimestamp, in us).
+    """
+
+    def __init__(self, output, fr, iperiod=None, packet_size=4096):
+        if not isinstance(output, Output):
+            raise RuntimeError("Must pass Output")
+        self.output  = output
+        self.iperiod = iperiod or fr
+        self.packet  = bytes(packet_size)
+        self.count   = 0
+        self.t       = time.time()
+        self.firsttimestamp = None
+
+    def start(self):
+        self.firsttimestamp = None
+        self.output.start()
+
+    def encode(self, t):
+        self.t = t
+        ts     = int(t * 1e6)
+        if self.firsttimestamp is None:
+            self.firsttimestamp = ts
+        self.output.outputframe(self.packet, self.count % self.iperiod == 0, ts - self.firsttimestamp)
+        self.count += 1
+
+    def stop(self):
+        self.output.stop()
+
+    def now(self):
+        """Wall clock of the last encoded frame, used to name segments."""
+        return datetime.datetime.fromtimestamp(self.t)
+
+
+class ReplaySource:
+    """
+    Frame source for CameraPipeline.start(): pushes `frames` into the ring
+    and the matching packets into `encoder`, timestamped at `fr` from
+    `start`.  Without `realtime` it runs as fast as the analysis worker
+    keeps up and never drops a frame.
+    """
+
+    def __init__(self, frames, fr, encoder, start=None, realtime=False):
+        self.frames   = frames
+        self.fr       = fr
+        self.encoder  = encoder
+        self.start    = time.time() if start is None else start
+        self.realtime = realtime
+        self.count    = 0
+
+    def __call__(self, ring, stop, metrics):
+        h, w = ring.slots.shape[1:]
+        t0   = time.monotonic()
+        for i, y_plane in enumerate(self.frames):
+            if stop.is_set():
+                break
+            if y_plane.shape != (h, w):
+                raise ValueError(f"frame {i} is {y_plane.shape[1]}x{y_plane.shape[0]}, lores is {w}x{h}")
+            if self.realtime:
+                time.sleep(max(0.0, t0 + i / self.fr - time.monotonic()))
+            t = self.start + i / self.fr
+            self.encoder.encode(t)
+            idx = ring.acquire(wait=not self.realtime)
+            np.copyto(ring.slots[idx], y_plane)
+            ring.commit(idx, {'time': t, 'SensorTimestamp': int(t * 1e6) * 1000})
+            self.count += 1
+
+
+def read_frames(path, w, h):
+    """Yield (h, w) uint8 Y planes from `path`, see module docstring for formats."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        yield from np.load(path, mmap_mode='r')
+    elif ext in ('.y', '.gray', '.yuv'):
+        plane = w * h * 3 // 2 if ext == '.yuv' else w * h
+        raw   = np.memmap(path, np.uint8, 'r')
+        n     = raw.size // plane
+        for i in range(n):
+            yield raw[i * plane:i * plane + w * h].reshape(h, w)
+    else:
+        import cv2
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            raise SystemExit(f"cannot open {path}")
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            yield cv2.resize(gray, (w, h), interpolation=cv2.INTER_AREA)
+        cap.release()
+
+
+def fake_camera(cfg, frames, lores_size, vid_dir, realtime=False, pool=None):
+    """(CameraPipeline, FakeEncoder, ReplaySource) for `frames`, with fake LEDs."""
+    fr       = int(cfg['Recording']['framerate'])
+    leds     = (FakeLED(), FakeLED())
+    encoder  = None
+    pipeline = CameraPipeline(cfg, lores_size, leds, vid_dir=vid_dir, wallclock=lambda: encoder.now(), pool=pool)
+    encoder  = FakeEncoder(pipeline.output, fr)
+    pipeline.use_encoder(encoder)
+    return pipeline, encoder, ReplaySource(frames, fr, encoder, realtime=realtime)
+
+
+def replay(cfg, frames, lores_size, vid_dir, realtime=False):
+    """Run `frames` through a CameraPipeline; returns (pipeline, source, wall seconds)."""
+    pipeline, encoder, source = fake_camera(cfg, frames, lores_size, vid_dir, realtime)
+
+    t0 = time.perf_counter()
+    encoder.start()
+    pipeline.start()
+    source(pipeline.ring, pipeline.stop, pipeline.metrics)
+    pipeline.shutdown(encoder.stop)
+    return pipeline, source, time.perf_counter() - t0
+
+
+def replay_shared(runs, vid_dir, workers, realtime=False):
+    """
+    Run several cameras at once, each (cfg, frames, lores_size) on its own
+    capture thread, with analysis and finalisation on one WorkerPool of
+    `workers` threads; returns ([(pipeline, source)], pool stats, wall seconds).
+    """
+    pool    = WorkerPool(workers)
+    cameras = [fake_camera(cfg, frames, size, vid_dir, realtime, pool) for cfg, frames, size in runs]
+    t0      = time.perf_counter()
+    for pipeline, encoder, source in cameras:
+        encoder.start()
+        pipeline.start(source)
+    for pipeline, encoder, source in cameras:
+        for t in pipeline.threads:
+            t.join()
+        if pipeline in pool.failed:
+            raise RuntimeError(f"{pipeline.feeder}: analysis failed, see traceback above")
+    for pipeline, encoder, source in cameras:
+        pipeline.shutdown(encoder.stop)
+    wall = time.perf_counter() - t0
+    pool.close()
+    return [(pipeline, source) for pipeline, _, source in cameras], pool.stats(), wall
+
+
+def load_cfg(path, args):
+    cfg = configparser.ConfigParser()
+    cfg.read(path)
+    if args.diff_threshold is not None:
+        cfg['Background']['diff_threshold'] = str(args.diff_threshold)
+    if args.area_threshold is not None:
+        cfg['Background']['area_threshold'] = str(args.area_threshold)
+    if not cfg.has_section('Metrics'):
+        cfg.add_section('Metrics')
+    cfg['Metrics']['status_file'] = ''
+    return cfg
+
+
+def report(path, lores_size, pipeline, source, wall):
+    snap   = pipeline.snapshot()
+    stages = snap['stages']
+    w, h   = lores_size
+    print(f"{path}: lores {w}x{h}, {source.count} frames in {wall:.2f} s "
+          f"-> {source.count / wall:.1f} frames/s")
+    print(f"  motion analysis  mean {stages['motion']['mean'] * 1e3:7.3f} ms   max {stages['motion']['max'] * 1e3:7.3f} ms")
+    print(f"  frame latency    mean {stages['latency']['mean'] * 1e3:7.3f} ms   max {stages['latency']['max'] * 1e3:7.3f} ms")
+    print(f"  segments saved {snap['segments']['saved']}  deleted {snap['segments']['deleted']}  "
+          f"dropped frames {snap['frames']['dropped']}  late {snap['frames']['late']}")
+    duty = snap['duty']
+    print(f"  duty cycle       full {duty['seconds']['full']:.1f} s  idle {duty['seconds']['idle']:.1f} s  "
+          f"switches {duty['switches']}  skipped frames {duty['skipped']}")
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument('mode', choices=('run', 'bench'))
+    p.add_argument('configs', nargs='+', help='camera config file(s)')
+    p.add_argument('--input', help='recorded frames (default for bench: synthetic frames)')
+    p.add_argument('--frames', type=int, default=600, help='number of synthetic frames for bench')
+    p.add_argument('--sensor-size', default='4608x2592',
+                   help='sensor mode size the configs are used with (default: IMX708 full res)')
+    p.add_argument('--diff-threshold', type=int, help='override [Background] diff_threshold')
+    p.add_argument('--area-threshold', type=float, help='override [Background] area_threshold')
+    p.add_argument('--realtime', action='store_true', help='pace frames at the configured framerate')
+    p.add_argument('--out', help='keep segments in this video_dir instead of a temporary one')
+    p.add_argument('--shared', type=int, metavar='WORKERS',
+                   help='run all configs at once on a pool of WORKERS analysis/finalisation threads')
+    args = p.parse_args()
+    sensor = tuple(int(v) for v in args.sensor_size.split('x'))
+
+    if args.mode == 'run' and not args.input:
+        p.error('run needs --input')
+
+    runs = []
+    for path in args.configs:
+        cfg = load_cfg(path, args)
+        _, _, (w, h) = stream_sizes(cfg, sensor)
+        if args.input:
+            frames = read_frames(args.input, w, h)
+        else:
+            from bench_background import synthetic_frames
+            frames = synthetic_frames(w, h, args.frames)
+        runs.append((path, cfg, frames, (w, h)))
+
+    if args.shared:
+        work = args.out or tempfile.mkdtemp(prefix='replay_')
+        try:
+            cameras, stats, wall = replay_shared([r[1:] for r in runs], os.path.join(work, 'Videos'),
+                                                 args.shared, args.realtime)
+            total = sum(source.count for _, source in cameras)
+            print(f"{len(cameras)} cameras on {args.shared} shared workers: {total} frames in {wall:.2f} s "
+                  f"-> {total / wall:.1f} frames/s  ({stats['analysis_runs']} analysis / "
+                  f"{stats['finalise_runs']} finalise turns)")
+            for (path, _, _, size), (pipeline, source) in zip(runs, cameras):
+                report(path, size, pipeline, source, wall)
+                print(f"  health {pipeline.health()}")
+        finally:
+            if not args.out:
+                shutil.rmtree(work, ignore_errors=True)
+        return
+
+    for path, cfg, frames, (w, h) in runs:
+        work = args.out or tempfile.mkdtemp(prefix='replay_')
+        try:
+            pipeline, source, wall = replay(cfg, frames, (w, h), os.path.join(work, 'Videos'), args.realtime)
+            report(path, (w, h), pipeline, source, wall)
+            if args.out:
+                print(f"  segments in {pipeline.out_dir}")
+        finally:
+            if not args.out:
+                shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
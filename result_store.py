@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Result storage for raspicam_server.py.
+
+Saved events are collected per video and written as one batch when the
+video is finished (see server_state for how batches line up with the
+tracker checkpoints).  The default backend is an SQLite database with one
+typed row per event, indexed by bee id, feeder and time, and the event
+crops packed into append-only chunk files.  The CSV backend writes the
+previous detections.csv rows and one PNG per event.
+
+Bee ids are integers with bit i = element i of the decoded id (little
+endian, like bb_binary's binary_id_to_int); bits where the votes of an
+event are tied are set in `uncertain` and 0 in bee_id.
+
+    # all visits of bee 1234 at feeder 00 since May 1st
+    python3 result_store.py results.db --bee 1234 --feeder 00 --since 2024-05-01
+    # crop of one event as PNG, or everything as the old csv format
+    python3 result_store.py results.db --crop 4711 --out 4711.png
+    python3 result_store.py results.db --export-csv detections.csv
+"""
+import argparse, csv, glob, os, sqlite3, zlib
+from collections import namedtuple
+from datetime import datetime
+import numpy as np
+
+# one saved event; ids are the rounded ids of the history as bit masks (bit i = element i)
+EventRecord = namedtuple('EventRecord', 'event_id feeder_id consensus ids n_bits first_detection '
+                                        'last_detection detections image')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    event_id        INTEGER PRIMARY KEY,
+    feeder_id       TEXT    NOT NULL,
+    bee_id          INTEGER NOT NULL,
+    uncertain       INTEGER NOT NULL,   -- bits of bee_id without a majority
+    n_bits          INTEGER NOT NULL,
+    first_detection REAL    NOT NULL,   -- unix time
+    last_detection  REAL    NOT NULL,
+    detections      INTEGER NOT NULL,
+    ids             BLOB,               -- uint32 little endian bit masks of the id history
+    crop_chunk      INTEGER,
+    crop_offset     INTEGER,
+    crop_length     INTEGER,
+    crop_h          INTEGER,
+    crop_w          INTEGER,
+    batch           INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_bee    ON events (bee_id, first_detection);
+CREATE INDEX IF NOT EXISTS events_feeder ON events (feeder_id, first_detection);
+CREATE INDEX IF NOT EXISTS events_time   ON events (first_detection);
+CREATE INDEX IF NOT EXISTS events_batch  ON events (batch);
+"""
+
+
+def consensus_bits(consensus):
+    """(bee_id, uncertain mask) from a consensus id of 0.0 / 0.5 / 1.0 values."""
+    bee_id = uncertain = 0
+    for bit, value in enumerate(consensus):
+        if value == 0.5:
+            uncertain |= 1 << bit
+        elif value > 0.5:
+            bee_id |= 1 << bit
+    return bee_id, uncertain
+
+
+def mask_to_list(mask, n_bits):
+    return [float(mask >> bit & 1) for bit in range(n_bits)]
+
+
+def _timestamp(t):
+    return t.timestamp() if isinstance(t, datetime) else float(t)
+
+
+class ResultStore:
+    """
+    SQLite events table plus chunked crop files in `crops_dir`.  add()
+    collects records, commit() writes the crops, fsyncs them and inserts
+    all rows in one transaction; it returns the batch number, the marker
+    truncate() rolls back to.
+    """
+
+    def __init__(self, path, crops_dir=None, chunk_bytes=64 << 20):
+        self.name        = 'sqlite:' + os.path.abspath(path)
+        self.db          = sqlite3.connect(path)
+        self.crops_dir   = crops_dir or os.path.splitext(path)[0] + '_crops'
+        self.chunk_bytes = chunk_bytes
+        self.pending     = []
+        self.db.executescript(SCHEMA)
+        os.makedirs(self.crops_dir, exist_ok=True)
+        chunks           = sorted(glob.glob(os.path.join(self.crops_dir, 'chunk_*.bin')))
+        self.chunk       = int(chunks[-1][-10:-4]) if chunks else 0
+        self.batch       = self.db.execute("SELECT COALESCE(MAX(batch), 0) FROM events").fetchone()[0]
+
+    def _chunk_path(self, chunk):
+        return os.path.join(self.crops_dir, f"chunk_{chunk:06d}.bin")
+
+    def add(self, records):
+        self.pending.extend(records)
+
+    def _write_crops(self):
+        """Append the pending crops to the current chunk; (chunk, offset, length, h, w) per record."""
+        places, f = [], None
+        try:
+            for rec in self.pending:
+                if rec.image is None:
+                    places.append((None,) * 5)
+                    continue
+                if f is None or f.tell() >= self.chunk_bytes:
+                    if f is not None:
+                        f.flush()
+                        os.fsync(f.fileno())
+                        f.close()
+                        self.chunk += 1
+                    f = open(self._chunk_path(self.chunk), 'ab')
+                data = zlib.compress(np.ascontiguousarray(rec.image, np.uint8).tobytes(), 1)
+                places.append((self.chunk, f.tell(), len(data)) + rec.image.shape[:2])
+                f.write(data)
+        finally:
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+        return places
+
+    def commit(self):
+        if self.pending:
+            self.batch += 1
+            rows = []
+            for rec, place in zip(self.pending, self._write_crops()):
+                bee_id, uncertain = consensus_bits(rec.consensus)
+                rows.append((rec.event_id, rec.feeder_id, bee_id, uncertain, rec.n_bits,
+                             _timestamp(rec.first_detection), _timestamp(rec.last_detection), rec.detections,
+                             np.asarray(rec.ids, '<u4').tobytes()) + place + (self.batch,))
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO events VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+            self.pending = []
+        return self.batch
+
+    def marker(self):
+        """Marker of the results committed so far."""
+        return self.batch
+
+    def truncate(self, marker):
+        """Drop rows of batches after `marker` (their crops stay as unreferenced bytes in the chunks)."""
+        if marker is not None and marker >= 0:
+            with self.db:
+                self.db.execute("DELETE FROM events WHERE batch > ?", (marker,))
+            self.batch = max(marker, self.db.execute("SELECT COALESCE(MAX(batch), 0) FROM events").fetchone()[0])
+
+    def visits(self, bee_id=None, feeder_id=None, start=None, end=None, include_uncertain=False):
+        """
+        Events as dicts, oldest first, filtered by bee id, feeder and a
+        [start, end) range of first detection (datetimes or unix times).
+        Events with tied bits only match a bee id with include_uncertain.
+        """
+        where, args = [], []
+        if bee_id is not None:
+            where.append("(bee_id = ? AND uncertain = 0)" if not include_uncertain
+                         else "(bee_id = (? & ~uncertain))")
+            args.append(bee_id)
+        if feeder_id is not None:
+            where.append("feeder_id = ?")
+            args.append(feeder_id)
+        if start is not None:
+            where.append("first_detection >= ?")
+            args.append(_timestamp(start))
+        if end is not None:
+            where.append("first_detection < ?")
+            args.append(_timestamp(end))
+        sql = ("SELECT event_id, feeder_id, bee_id, uncertain, n_bits, first_detection, last_detection, detections "
+               "FROM events" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY first_detection")
+        cols = ('event_id', 'feeder_id', 'bee_id', 'uncertain', 'n_bits', 'first_detection', 'last_detection',
+                'detections')
+        return [dict(zip(cols, row)) for row in self.db.execute(sql, args)]
+
+    def ids(self, event_id):
+        """Rounded id history of an event as lists of 0.0/1.0."""
+        blob, n_bits = self.db.execute("SELECT ids, n_bits FROM events WHERE event_id=?", (event_id,)).fetchone()
+        return [mask_to_list(int(m), n_bits) for m in np.frombuffer(blob, '<u4')]
+
+    def crop(self, event_id):
+        """The saved image crop of an event, or None."""
+        row = self.db.execute("SELECT crop_chunk, crop_offset, crop_length, crop_h, crop_w FROM events "
+                              "WHERE event_id=?", (event_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        chunk, offset, length, h, w = row
+        with open(self._chunk_path(chunk), 'rb') as f:
+            f.seek(offset)
+            return np.frombuffer(zlib.decompress(f.read(length)), np.uint8).reshape(h, w)
+
+    def export_csv(self, path):
+        """Write all events in the detections.csv row format."""
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            for v in self.visits():
+                consensus = [0.5 if v['uncertain'] >> b & 1 else float(v['bee_id'] >> b & 1) for b in range(v['n_bits'])]
+                writer.writerow([v['event_id'], v['feeder_id'], consensus, self.ids(v['event_id']),
+                                 datetime.fromtimestamp(v['first_detection']),
+                                 datetime.fromtimestamp(v['last_detection']), v['detections']])
+
+    def close(self):
+        self.db.close()
+
+
+class CSVResults:
+    """The previous output: one csv row per event and ./images/<event_id>.png; the marker is the file size."""
+
+    def __init__(self, path, images_dir='./images'):
+        self.name       = 'csv:' + os.path.abspath(path)
+        self.file       = open(path, 'a')
+        self.writer     = csv.writer(self.file)
+        self.images_dir = images_dir
+        self.pending    = []
+
+    def add(self, records):
+        self.pending.extend(records)
+
+    def commit(self):
+        for rec in self.pending:
+            self.writer.writerow([rec.event_id, rec.feeder_id, rec.consensus,
+                                  [mask_to_list(m, rec.n_bits) for m in rec.ids],
+                                  rec.first_detection, rec.last_detection, rec.detections])
+            if rec.image is not None:
+                import cv2
+                cv2.imwrite(os.path.join(self.images_dir, str(rec.event_id) + ".png"), rec.image)
+        self.pending = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.marker()
+
+    def marker(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def truncate(self, marker):
+        if marker is not None and 0 <= marker < os.fstat(self.file.fileno()).st_size:
+            self.file.flush()
+            os.truncate(self.file.name, marker)
+
+    def close(self):
+        self.file.close()
+
+
+def open_results(general):
+    """Result backend from the [General] section of server.cfg."""
+    if general.get('results', 'sqlite') == 'csv':
+        return CSVResults(general['csvfile'])
+    return ResultStore(general.get('results_db', './results.db'), general.get('crops_dir'))
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument('db', help='results database (results_db in server.cfg)')
+    p.add_argument('--bee', type=int, help='bee id')
+    p.add_argument('--feeder', help='feeder id')
+    p.add_argument('--since', type=datetime.fromisoformat, help='first detection at or after (ISO date/time)')
+    p.add_argument('--until', type=datetime.fromisoformat, help='first detection before (ISO date/time)')
+    p.add_argument('--uncertain', action='store_true', help='also match events with tied id bits')
+    p.add_argument('--crop', type=int, help='write the crop of this event id to --out')
+    p.add_argument('--out', help='output file for --crop')
+    p.add_argument('--export-csv', help='write all events to this csv file')
+    args = p.parse_args()
+
+    store = ResultStore(args.db)
+    if args.crop is not None:
+        import cv2
+        cv2.imwrite(args.out or f"{args.crop}.png", store.crop(args.crop))
+    elif args.export_csv:
+        store.export_csv(args.export_csv)
+    else:
+        for v in store.visits(args.bee, args.feeder, args.since, args.until, args.uncertain):
+            print(f"{v['event_id']:>8} feeder {v['feeder_id']:<4} bee {v['bee_id']:>5} "
+                  f"{datetime.fromtimestamp(v['first_detection'])} - {datetime.fromtimestamp(v['last_detection'])} "
+                  f"{v['detections']:>4} detections" + (" (uncertain bits)" if v['uncertain'] else ""))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
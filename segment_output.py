@@ -0,0 +1,179 @@
+import datetime, threading
+from collections import deque
+
+try:
+    from picamera2.outputs import Output
+except ImportError:                         # replays and tests run without picamera2
+    class Output:
+        """Stand-in for picamera2.outputs.Output with the attributes its encoders use."""
+
+        def __init__(self, pts=None):
+            self.recording        = False
+            self.ptsoutput        = pts
+            self.needs_add_stream = False
+
+        def start(self):
+            self.recording = True
+
+        def stop(self):
+            self.recording = False
+
+
+class SegmentOutput(Output):
+    """
+    Encoder output (a picamera2 Output) that writes H264 into segment
+    files on a running encoder.
+
+    The last `preroll` encoded frames are always kept in a bounded
+    in-memory ring.  open() starts a segment with those buffered frames,
+    beginning at their first keyframe; close() ends it.  While a segment
+    is open the output switches to a new file on the first keyframe after
+    `split_every` encoded frames, so segments are cut frame-accurately
+    without restarting the encoder.  Requests are applied on the encoder
+    thread inside outputframe(), so the caller never touches the file;
+    closed segments are handed to on_closed(filename, keep, span, times),
+    with span the (first, last) encoder timestamps in the file and times
+    (start, stamps): the wall-clock time of the first frame and the encoder
+    timestamp of every frame written.
+
+    Segment names come from make_name(start), with `start` the wall-clock
+    time (as given by now()) of the first frame written to that file.  `keep` is True for
+    segments opened with keep=True or marked with mark_keep().
+
+    Encoded frame timestamps are checked against `frame_us`: frames
+    missing from the stream are counted in `lost`, those missing across
+    a segment switch also in `boundary_lost`.
+    """
+
+    def __init__(self, preroll, on_closed, split_every=None, frame_us=None, now=datetime.datetime.now):
+        super().__init__()
+        self.ring        = deque(maxlen=max(preroll, 1))   # (frame, keyframe, timestamp_us)
+        self.on_closed   = on_closed
+        self.now         = now
+        self.split_every = split_every
+        self.frame_us    = frame_us
+        self.lock        = threading.Lock()
+        self.file        = None
+        self.filename    = None
+        self.make_name   = None
+        self.want        = None          # pending ('open', make_name, keep) or ('close',)
+        self.keep        = False
+        self.keep_next   = False
+        self.written     = 0             # frames in the current file
+        self.span        = [None, None]  # first / last timestamp in the current file
+        self.file_start  = None          # wall-clock time of the first frame in the current file
+        self.stamps      = []            # timestamps of the frames in the current file
+
+        self.last_ts       = None
+        self.frames        = 0
+        self.lost          = 0
+        self.boundaries    = 0
+        self.boundary_lost = 0
+
+    # --- called by the encoder -------------------------------------------
+
+    def stop(self):
+        super().stop()
+        with self.lock:
+            self.want = None
+            self._close()
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+        if audio:
+            return
+        frame = bytes(frame)
+        with self.lock:
+            missing = self._count_missing(timestamp)
+            if self.file is not None:
+                self.written += missing          # keep cuts on the nominal frame grid
+            self.ring.append((frame, keyframe, timestamp))
+            want, self.want = self.want, None
+            if want is not None and want[0] == 'open':
+                self._open_from_ring(want, timestamp)
+            elif want is not None and want[0] == 'close':
+                self._close()
+            elif self.file is not None and keyframe and self.split_every and self.written >= self.split_every:
+                self._close()
+                self._open(self.make_name, self.now(), self.keep_next)
+                self.boundaries    += 1
+                self.boundary_lost += missing
+                self._write(frame, timestamp)
+            else:
+                self._write(frame, timestamp)
+
+    # --- called by the analysis thread -----------------------------------
+
+    def open(self, make_name, keep=False):
+        """Start a segment (pre-roll included) at the next encoded frame."""
+        with self.lock:
+            if self.file is None:
+                self.want = ('open', make_name, keep)
+
+    def close(self):
+        """End the running segment at the next encoded frame."""
+        with self.lock:
+            if self.file is not None or self.want is not None:
+                self.want = ('close',)
+
+    def mark_keep(self):
+        """Flag the running segment to be kept."""
+        with self.lock:
+            self.keep = True
+
+    def is_open(self):
+        with self.lock:
+            return self.file is not None or (self.want is not None and self.want[0] == 'open')
+
+    # --- internals, lock held --------------------------------------------
+
+    def _count_missing(self, timestamp):
+        missing = 0
+        if timestamp is not None and self.last_ts is not None and self.frame_us:
+            missing = max(round((timestamp - self.last_ts) / self.frame_us) - 1, 0)
+        self.last_ts  = timestamp
+        self.frames  += 1
+        self.lost    += missing
+        return missing
+
+    def _open(self, make_name, start, keep):
+        self.make_name  = make_name
+        self.keep_next  = keep           # split-off pieces inherit the keep flag of open()
+        self.keep       = keep
+        self.written    = 0
+        self.span       = [None, None]
+        self.file_start = start
+        self.stamps     = []
+        self.filename   = make_name(start)
+        self.file       = open(self.filename, 'wb')
+
+    def _open_from_ring(self, want, now_us):
+        _, make_name, keep = want
+        frames = list(self.ring)
+        first  = next((i for i, (_, key, _) in enumerate(frames) if key), None)
+        if first is None:                       # no keyframe buffered yet, try again next frame
+            self.want = want
+            return
+        ts    = frames[first][2]
+        start = self.now()
+        if ts is not None and now_us is not None:
+            start -= datetime.timedelta(microseconds=now_us - ts)
+        self._open(make_name, start, keep)
+        for frame, _, ts in frames[first:]:
+            self._write(frame, ts)
+
+    def _write(self, frame, timestamp):
+        if self.file is not None:
+            self.file.write(frame)
+            self.written += 1
+            if self.span[0] is None:
+                self.span[0] = timestamp
+            self.span[1] = timestamp
+            self.stamps.append(timestamp)
+
+    def _close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        filename, keep = self.filename, self.keep
+        self.file, self.filename, self.keep = None, None, False
+        self.on_closed(filename, keep, tuple(self.span), (self.file_start, self.stamps))
@@ -0,0 +1,409 @@
+"""
+Staged video processing for raspicam_server.py.
+
+Decode workers (separate processes) read the videos, keep every
+(frameskip+1)-th frame, pad it for the detector and leave out frames the
+camera saw no activity around.  The main process pulls decoded frames of
+all videos in flight from one bounded queue, runs them through the
+detector in batches and hands the results to the tracker strictly in
+order per feeder: frames of a video in frame order, videos of a feeder in
+the order they were submitted.  Videos are handed out as workers become
+free, to the feeder with the fewest videos in flight, so the workers
+decode different feeders at once and a single busy feeder gets all of
+them.  Frames of a video still waiting behind an earlier one of its
+feeder are copied out of their shared slots, so they never starve that
+earlier video.  A video counts as in flight until it is delivered, so at
+most workers - 1 videos wait like that.
+
+Videos in an indexed container (.mp4/.mkv remuxed by the camera) are not
+decoded through their inactive stretches: each stretch of activity is
+read by its own ffmpeg run that seeks to it.
+"""
+import multiprocessing, queue, subprocess, time
+from collections import deque
+import numpy as np
+
+BORDER   = 50     # zero padding around each frame, so bees at the border are detected
+SEEK_GAP = 5.0    # inactive secs worth a seek; shorter gaps are decoded through
+SEEKABLE = ('.mp4', '.mkv')
+SEAM     = 256    # zero rows between stacked frames, wider than the detector's receptive field
+POLL     = 1.0    # secs between checks for dead decode workers while waiting for frames
+
+
+def pad_into(gray, padded, border=BORDER):
+    """Write `gray` into the interior of the preallocated `padded` and zero its border."""
+    padded[:border] = 0
+    padded[-border:] = 0
+    padded[:, :border] = 0
+    padded[:, -border:] = 0
+    np.copyto(padded[border:-border, border:-border], gray)
+    return padded
+
+
+def pad_frame(gray, border=BORDER):
+    return pad_into(gray, np.empty((gray.shape[0] + 2 * border, gray.shape[1] + 2 * border), np.uint8), border)
+
+
+def probe_size(path):
+    """(width, height) of the first video stream of `path`."""
+    out = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+                          'stream=width,height', '-of', 'csv=p=0', path],
+                         check=True, capture_output=True, text=True).stdout
+    w, h = out.split()[0].split(',')[:2]
+    return int(w), int(h)
+
+
+class FrameReader:
+    """
+    Kept frames of one video as gray8 from an ffmpeg subprocess.  The select
+    filter drops the frames between the kept ones inside ffmpeg, before any
+    pixel format conversion or pipe traffic, and frames are read into one
+    reused buffer: every (frameskip+1)-th frame starting at `frameskip`,
+    the frames the original server loop analysed.  With `start` (and the
+    container's `fps`) ffmpeg seeks to frame `start` first; `count` limits
+    the number of kept frames read.  `seconds` is the time spent waiting
+    for frames.
+    """
+
+    def __init__(self, path, frameskip, start=0, fps=None, count=None, size=None):
+        self.w, self.h = size or probe_size(path)
+        self.step      = frameskip + 1
+        self.first     = start + (frameskip - start) % self.step     # first kept frame at or after start
+        self.frame     = np.empty((self.h, self.w), np.uint8)
+        self.count     = 0
+        self.seconds   = 0.0
+        seek           = ['-ss', f"{(start - 0.5) / fps:.6f}"] if start else []
+        limit          = ['-frames:v', str(count)] if count is not None else []
+        select         = f"select=eq(mod(n\\,{self.step})\\,{self.first - start})"
+        self.proc      = subprocess.Popen(['ffmpeg', '-v', 'error', '-nostdin'] + seek + ['-i', path, '-vf', select,
+                                           '-vsync', '0'] + limit + ['-f', 'rawvideo', '-pix_fmt', 'gray', '-'],
+                                          stdout=subprocess.PIPE)
+
+    def read(self):
+        """Frame number of the next kept frame, now in self.frame; None at the end of the video."""
+        t0 = time.perf_counter()
+        n  = self.proc.stdout.readinto(memoryview(self.frame).cast('B'))
+        self.seconds += time.perf_counter() - t0
+        if n < self.frame.nbytes:
+            return None
+        self.count += 1
+        return (self.count - 1) * self.step + self.first
+
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.wait() not in (0, -13):        # killed by SIGPIPE when closed early
+            raise RuntimeError(f"ffmpeg exited with status {self.proc.returncode}")
+
+
+class FrameSlots:
+    """
+    Fixed pool of padded frame buffers in shared memory, allocated before
+    the decode workers are forked.  A worker takes a free slot, the decoded
+    frame is padded straight into it and only the slot index travels
+    through the frame queue; the main process releases the slot once the
+    frame is tracked.  The pool bounds the frames in flight.
+    """
+
+    def __init__(self, ctx, n, max_size, border=BORDER):
+        w, h        = max_size
+        self.stride = (h + 2 * border) * (w + 2 * border)
+        self.buf    = ctx.RawArray('B', n * self.stride)
+        self.free   = ctx.Queue()
+        for idx in range(n):
+            self.free.put(idx)
+
+    def fits(self, shape):
+        return shape[0] * shape[1] <= self.stride
+
+    def acquire(self):
+        return self.free.get()
+
+    def release(self, idx):
+        self.free.put(idx)
+
+    def view(self, idx, shape):
+        return np.frombuffer(self.buf, np.uint8, shape[0] * shape[1], idx * self.stride).reshape(shape)
+
+
+def active_runs(activity, step, offset, n_frames=None, min_gap=0):
+    """
+    (first frame, number of kept frames or None for 'to the end') of the
+    stretches of kept frames to decode: active ones, joined across gaps of
+    fewer than `min_gap` frames, plus the frames past the end of the mask
+    unless `n_frames` says there are none.
+    """
+    kept  = np.arange(offset, len(activity), step)
+    on    = np.flatnonzero(activity[kept])
+    runs  = []
+    if len(on):
+        cuts = np.flatnonzero(np.diff(on) * step > min_gap) + 1
+        runs = [[int(kept[g[0]]), int(g[-1] - g[0] + 1)] for g in np.split(on, cuts)]
+    if n_frames is None or n_frames > len(activity):
+        tail = len(activity) + (offset - len(activity)) % step
+        if runs and tail - (runs[-1][0] + (runs[-1][1] - 1) * step) <= min_gap:
+            runs[-1][1] = None
+        else:
+            runs.append([tail, None])
+    return [tuple(r) for r in runs]
+
+
+def _put_frame(key, frame_idx, frame, shape, out_q, slots):
+    if slots.fits(shape):
+        idx = slots.acquire()
+        pad_into(frame, slots.view(idx, shape))
+        out_q.put(('frame', key, frame_idx, (idx, shape)))
+    else:
+        out_q.put(('frame', key, frame_idx, pad_frame(frame)))
+
+
+def decode_video(key, path, frameskip, activity, out_q, slots, seek=None):
+    """
+    Put ('frame', key, frame_idx, payload) for every kept frame of `path`
+    on `out_q`.  payload is None where `activity` says there is nothing to
+    detect, else a (slot, shape) in `slots`, or the padded frame itself if
+    it does not fit a slot.  `seek` is (fps, number of frames or None) for
+    a video in an indexed container: only its active stretches are decoded.
+    Returns the secs spent decoding.
+    """
+    if activity is not None and seek is not None and path.lower().endswith(SEEKABLE):
+        return _decode_seeking(key, path, frameskip, activity, out_q, slots, *seek)
+    reader = FrameReader(path, frameskip)
+    shape  = (reader.h + 2 * BORDER, reader.w + 2 * BORDER)
+    try:
+        for frame_idx in iter(reader.read, None):
+            if activity is not None and frame_idx < len(activity) and not activity[frame_idx]:
+                out_q.put(('frame', key, frame_idx, None))
+            else:
+                _put_frame(key, frame_idx, reader.frame, shape, out_q, slots)
+    finally:
+        reader.close()
+    return reader.seconds
+
+
+def _decode_seeking(key, path, frameskip, activity, out_q, slots, fps, n_frames):
+    step, size = frameskip + 1, probe_size(path)
+    shape      = (size[1] + 2 * BORDER, size[0] + 2 * BORDER)
+    end        = min(len(activity), n_frames) if n_frames is not None else len(activity)
+    pos        = frameskip          # next kept frame not put on out_q yet
+    seconds    = 0.0
+    for first, count in active_runs(activity, step, frameskip, n_frames, SEEK_GAP * fps):
+        for frame_idx in range(pos, first, step):
+            out_q.put(('frame', key, frame_idx, None))
+        pos    = first
+        reader = FrameReader(path, frameskip, first, fps, count, size)
+        try:
+            for frame_idx in iter(reader.read, None):
+                if frame_idx < len(activity) and not activity[frame_idx]:
+                    out_q.put(('frame', key, frame_idx, None))
+                else:
+                    _put_frame(key, frame_idx, reader.frame, shape, out_q, slots)
+                pos = frame_idx + step
+        finally:
+            reader.close()
+            seconds += reader.seconds
+        if count is None:
+            return seconds
+    for frame_idx in range(pos, end, step):
+        out_q.put(('frame', key, frame_idx, None))
+    return seconds
+
+
+def _decode_worker(index, current, jobs, out_q, slots):
+    for job_id, *job in iter(jobs.get, None):
+        current[index] = job_id
+        key, error, seconds = job[0], None, 0.0
+        try:
+            seconds = decode_video(*job[:4], out_q, slots, *job[4:])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        out_q.put(('end', key, error, seconds))
+
+
+def detect_mosaic(pipeline, frames, keys, seam=SEAM):
+    """
+    Run the bb `pipeline` once per group of equally sized frames, stacked
+    into one tall image with `seam` zero rows between them (so the
+    detector never sees across two frames), and split the detections back
+    per frame by their row; detections in a seam are dropped.  `keys` are
+    the result keys holding one row per detection, positions first; other
+    keys are passed through.  Returns one results dict per frame.
+    """
+    positions_key = keys[0]
+    out, groups   = [None] * len(frames), {}
+    for i, frame in enumerate(frames):
+        groups.setdefault(frame.shape, []).append(i)
+    for shape, idx in groups.items():
+        if len(idx) == 1:
+            out[idx[0]] = pipeline([frames[idx[0]]])
+            continue
+        h, stride = shape[0], shape[0] + seam
+        mosaic    = np.zeros((stride * len(idx) - seam,) + shape[1:], frames[idx[0]].dtype)
+        for n, i in enumerate(idx):
+            mosaic[n * stride:n * stride + h] = frames[i]
+        results = pipeline([mosaic])
+        pos     = np.asarray(results[positions_key], np.float64).reshape(-1, 2)
+        which   = (pos[:, 0] // stride).astype(np.intp)
+        inside  = pos[:, 0] - which * stride < h
+        for n, i in enumerate(idx):
+            sel    = inside & (which == n)
+            out[i] = dict(results)
+            for k in keys:
+                out[i][k] = np.asarray(results[k])[sel]
+            out[i][positions_key] = pos[sel] - (n * stride, 0)
+    return out
+
+
+class StagedProcessor:
+    """
+    Decode worker processes plus the batching/ordering loop in run().
+
+    Create it before the detector is loaded: workers are forked, and the
+    forked children should not inherit an initialised GPU context.
+    `queue_size` frame slots of up to `max_size` (w, h) bound the decoded
+    frames waiting for the detector and the tracker, and the message queue
+    holds at most 4 * queue_size messages.  decode_seconds sums the
+    decoding time the workers reported for finished videos.  A video whose
+    worker died ends with an error instead of stalling run().
+    """
+
+    def __init__(self, workers=2, batch=4, queue_size=32, max_size=(1920, 1088)):
+        ctx          = multiprocessing.get_context('fork')
+        self.batch   = max(1, batch)
+        self.jobs    = ctx.Queue()
+        self.out_q   = ctx.Queue(4 * max(queue_size, batch))
+        self.slots   = FrameSlots(ctx, max(queue_size, batch), max_size)
+        self.current = ctx.Array('q', [-1] * max(1, workers), lock=False)   # job each worker took last
+        self.decode_seconds = 0.0
+        self.workers = [ctx.Process(target=_decode_worker, args=(i, self.current, self.jobs, self.out_q, self.slots),
+                                    daemon=True) for i in range(max(1, workers))]
+        for w in self.workers:
+            w.start()
+
+    @staticmethod
+    def _detectable(msg):
+        return msg[0] == 'frame' and msg[3] is not None
+
+    def _next_batch(self, keys, ended):
+        """Wait for one message, then take whatever else is ready up to `batch` frames."""
+        while True:
+            try:
+                msgs = [self.out_q.get(timeout=POLL)]
+                break
+            except queue.Empty:
+                dead = self._dead(keys, ended)
+                if dead:
+                    return dead
+        frames = self._detectable(msgs[0])
+        while frames < self.batch:
+            try:
+                msg = self.out_q.get_nowait()
+            except queue.Empty:
+                break
+            msgs.append(msg)
+            frames += self._detectable(msg)
+        return msgs
+
+    def _dead(self, keys, ended):
+        """
+        'end' messages with an error for the unfinished videos of dead
+        workers, for all unfinished videos once no worker is left.  `keys`
+        are the videos by job id, `ended` the keys that ended already.
+        """
+        msgs, left = [], [key for key in keys if key not in ended]
+        for index, worker in enumerate(self.workers):
+            key = keys[self.current[index]] if self.current[index] >= 0 else None
+            if not worker.is_alive() and key in left:
+                msgs.append(('end', key, f"decode worker {worker.pid} exited with code {worker.exitcode}", 0.0))
+                left.remove(key)
+        if not any(w.is_alive() for w in self.workers):
+            msgs += [('end', key, "no decode worker left", 0.0) for key in left]
+        return msgs
+
+    def run(self, videos, detect, empty, on_frame, on_done, frameskip):
+        """
+        Process `videos`, a list of (feeder, key, path, activity mask or None,
+        seek index or None; see decode_video), in that order per feeder.
+        detect(frames, keys) returns one results dict per frame (keys: the
+        video of each frame), `empty` stands in for frames left out by the
+        activity mask.
+        on_frame(key, frame_idx, frame, results) and on_done(key, error) are
+        called in strict per-feeder order; `frame` lives in a shared slot that
+        is reused after on_frame returns, so copy what has to be kept.
+        """
+        order, pending, feeder_of, keys = {}, {}, {}, []     # keys: video of each job id
+        self.current[:] = [-1] * len(self.workers)
+        for video in videos:
+            feeder, key = video[:2]
+            order.setdefault(feeder, deque()).append(key)
+            pending.setdefault(feeder, deque()).append(video)
+            feeder_of[key] = feeder
+        self._submit(order, pending, keys, frameskip)
+
+        ready, ended, over = {key: deque() for key in feeder_of}, {}, set()   # over: every key that ended
+        while any(order.values()):
+            msgs  = [self._resolve(m) for m in self._next_batch(keys, over)]
+            todo  = [m for m in msgs if self._detectable(m)]
+            found = iter(detect([m[3][0] for m in todo], [m[1] for m in todo]) if todo else ())
+            for kind, key, value, frame in msgs:
+                if kind == 'end':
+                    ended[key] = value
+                    over.add(key)
+                    self.decode_seconds += frame
+                elif frame is None:
+                    ready[key].append((value, None, empty, None))
+                else:
+                    if frame[1] is not None and order[feeder_of[key]][0] != key:
+                        # waits for an earlier video of its feeder: give the slot back, so that video never starves
+                        copy = frame[0].copy()
+                        self.slots.release(frame[1])
+                        frame = (copy, None)
+                    ready[key].append((value, frame[0], next(found), frame[1]))
+            for feeder in {feeder_of[m[1]] for m in msgs}:
+                self._deliver(order[feeder], ready, ended, on_frame, on_done)
+            self._submit(order, pending, keys, frameskip)
+
+    def _submit(self, order, pending, keys, frameskip):
+        """
+        Hand videos of `pending` to the workers until there are as many in
+        flight (submitted, not delivered yet; the rest of `order`) as
+        workers, each to the feeder with the fewest in flight.
+        """
+        running = {feeder: len(order[feeder]) - len(pending[feeder]) for feeder in order}
+        while sum(running.values()) < len(self.workers):
+            feeders = [feeder for feeder in pending if pending[feeder]]
+            if not feeders:
+                return
+            feeder = min(feeders, key=running.get)
+            _, key, path, activity, seek = pending[feeder].popleft()
+            self.jobs.put((len(keys), key, path, frameskip, activity, seek))
+            keys.append(key)
+            running[feeder] += 1
+
+    def _resolve(self, msg):
+        """Replace a (slot, shape) payload by (frame view, slot); other frames get slot None."""
+        kind, key, value, payload = msg
+        if kind != 'frame' or payload is None:
+            return msg
+        if isinstance(payload, tuple):
+            return kind, key, value, (self.slots.view(*payload), payload[0])
+        return kind, key, value, (payload, None)
+
+    def _deliver(self, keys, ready, ended, on_frame, on_done):
+        while keys:
+            key = keys[0]
+            while ready[key]:
+                frame_idx, frame, results, slot = ready[key].popleft()
+                on_frame(key, frame_idx, frame, results)
+                if slot is not None:
+                    self.slots.release(slot)
+            if key not in ended:
+                return
+            on_done(key, ended.pop(key))
+            keys.popleft()
+            del ready[key]
+
+    def close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for w in self.workers:
+            w.join(timeout=5)
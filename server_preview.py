@@ -0,0 +1,106 @@
+"""
+Detection preview for raspicam_server.py, off the processing loop.
+
+The tracker offer()s frames; a frame is only copied and queued when the
+preview is due (at most `fps` frames per second), the queue keeps only the
+newest frame, and rendering runs in a separate thread.  The output is an
+OpenCV window, or in headless mode an image file that is atomically
+replaced (.jpg/.png) or a low-rate video (.avi/.mp4), written by that
+thread.  OpenCV's window calls are not thread-safe: the window shows the
+newest rendered image when the main loop calls pump().
+"""
+import os, threading, time
+
+
+class Preview(threading.Thread):
+    """
+    Renders queued items with `render(item) -> BGR/RGB uint8 image` at most
+    `fps` times per second into `output` (None: a window named `window`,
+    updated by pump()).
+    """
+
+    def __init__(self, render, fps=2.0, output=None, window='bienen_filtered'):
+        super().__init__(daemon=True)
+        self.render   = render
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.output   = output
+        self.window   = window
+        self.cond     = threading.Condition()
+        self.item     = None          # newest undisplayed item, older ones are dropped
+        self.image    = None          # newest rendered window image not shown yet
+        self.due      = 0.0
+        self.running  = True
+        self.offered  = 0
+        self.shown    = 0
+        self.dropped  = 0
+        self.writer   = None
+
+    def offer(self, make_item):
+        """
+        Queue make_item() if the preview is due; make_item is only called
+        then, so copying the frame costs nothing for frames not shown.
+        """
+        self.offered += 1
+        now = time.monotonic()
+        if now < self.due:
+            return False
+        self.due = now + self.interval
+        item     = make_item()
+        with self.cond:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.cond.notify()
+        return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.item is not None or not self.running)
+                if self.item is None:
+                    break
+                item, self.item = self.item, None
+            self._show(self.render(item))
+            self.shown += 1
+        if self.writer is not None:
+            self.writer.release()
+
+    def latest(self):
+        """Newest rendered window image not shown yet, None if there is none."""
+        with self.cond:
+            image, self.image = self.image, None
+        return image
+
+    def pump(self):
+        """Show the newest rendered image in the window; call from the main thread."""
+        if self.output is not None:
+            return
+        image = self.latest()
+        if image is not None:
+            import cv2
+            cv2.imshow(self.window, image)
+            cv2.waitKey(1)
+
+    def _show(self, image):
+        if self.output is None:
+            with self.cond:
+                self.image = image
+            return
+        import cv2
+        if self.output.lower().endswith(('.avi', '.mp4', '.mkv')):
+            if self.writer is None:
+                fourcc      = cv2.VideoWriter_fourcc(*('mp4v' if self.output.lower().endswith('.mp4') else 'MJPG'))
+                self.writer = cv2.VideoWriter(self.output, fourcc, max(1.0 / self.interval, 1.0) if self.interval else 10.0,
+                                              (image.shape[1], image.shape[0]))
+            self.writer.write(image)
+        else:
+            root, ext = os.path.splitext(self.output)
+            tmp       = root + '.tmp' + ext
+            cv2.imwrite(tmp, image)
+            os.replace(tmp, self.output)
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.join(timeout=5)
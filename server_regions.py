@@ -0,0 +1,227 @@
+"""
+Change-driven crops for the detector on the server.
+
+Most kept frames show a static entrance with a few bees.  Per feeder a
+running background of cell means (cell x cell pixel blocks, like the
+lores background of raspicam.Background) marks the cells that changed
+since the previous kept frames.  Those cells, plus the cells under the
+open events and candidates of the feeder (a bee that sits still fades
+into the background but is still tracked), are dilated by `pad` pixels
+(the detector needs context around a tag) and cut into disjoint
+rectangles along empty rows and columns.  The detector then runs on
+those crops only.  Crop sizes are rounded up to multiples of `align`,
+so crops of several frames often share a shape and are batched by
+server_pipeline.detect_mosaic.  Detections are mapped back to
+full-frame coordinates.  A detection only counts for the crop whose
+unrounded rectangle contains it, so overlapping rounding margins do not
+detect a bee twice.
+
+Full frames are detected when the crops would cover more than `dense` of
+the frame, on the first frame of a feeder, and every `full_every`-th
+frame, which picks up bees that entered while the background did not
+see them.  Frames without any changed cell skip the detector.
+"""
+import numpy as np
+
+
+def dilate(mask, n):
+    """Grow the True cells of `mask` by `n` cells in every direction (square structuring element)."""
+    out = mask.copy()
+    for axis in (0, 1):
+        src = out.copy()
+        for k in range(1, n + 1):
+            if axis == 0:
+                out[k:] |= src[:-k]
+                out[:-k] |= src[k:]
+            else:
+                out[:, k:] |= src[:, :-k]
+                out[:, :-k] |= src[:, k:]
+    return out
+
+
+def boxes(mask):
+    """
+    Disjoint rectangles (r0, r1, c0, c1) covering the True cells of `mask`:
+    the bounding box of the cells, cut recursively along empty rows, then
+    empty columns.
+    """
+    out, todo = [], [(0, mask.shape[0], 0, mask.shape[1])]
+    while todo:
+        r0, r1, c0, c1 = todo.pop()
+        sub  = mask[r0:r1, c0:c1]
+        rows = np.flatnonzero(sub.any(axis=1))
+        if not len(rows):
+            continue
+        cols = np.flatnonzero(sub.any(axis=0))
+        r0, r1, c0, c1 = r0 + rows[0], r0 + rows[-1] + 1, c0 + cols[0], c0 + cols[-1] + 1
+        rcut = np.flatnonzero(np.diff(rows) > 1)
+        ccut = np.flatnonzero(np.diff(cols) > 1)
+        if len(rcut):
+            edges = [r0] + [r0 - rows[0] + rows[i + 1] for i in rcut] + [r1]
+            todo += [(a, b, c0, c1) for a, b in zip(edges[:-1], edges[1:])]
+        elif len(ccut):
+            edges = [c0] + [c0 - cols[0] + cols[i + 1] for i in ccut] + [c1]
+            todo += [(r0, r1, a, b) for a, b in zip(edges[:-1], edges[1:])]
+        else:
+            out.append((int(r0), int(r1), int(c0), int(c1)))
+    return out
+
+
+def _span(lo, hi, align, limit):
+    """[lo, hi) grown to a multiple of `align` (at most `limit`), kept inside [0, limit)."""
+    want = min(limit, -(-(hi - lo) // align) * align)
+    lo   = max(0, min(lo - (want - (hi - lo)) // 2, limit - want))
+    return lo, lo + want
+
+
+class CellBackground:
+    """Running mean of cell x cell blocks of one feeder's frames; changed() marks the cells that differ."""
+
+    def __init__(self, cell, alpha, diff_th):
+        self.cell    = cell
+        self.alpha   = np.float32(alpha)
+        self.diff_th = diff_th
+        self.bg      = None
+
+    def means(self, frame):
+        c    = self.cell
+        h, w = frame.shape[0] // c * c, frame.shape[1] // c * c
+        return frame[:h, :w].reshape(h // c, c, w // c, c).mean(axis=(1, 3), dtype=np.float32)
+
+    def changed(self, frame):
+        """Cell mask of |background - frame| > diff_th, then blend the frame in; None on the first frame."""
+        cur = self.means(frame)
+        if self.bg is None or self.bg.shape != cur.shape:
+            self.bg = cur
+            return None
+        mask     = np.abs(self.bg - cur) > self.diff_th
+        self.bg *= self.alpha
+        self.bg += (1 - self.alpha) * cur
+        return mask
+
+
+class RegionDetector:
+    """
+    Runs a detector (detect(images) -> results per image) on the changed
+    regions of each frame; see the module docstring.  Counts frames
+    detected in full, in crops, or skipped, and the detector pixels
+    against the full-frame pixels.
+    """
+
+    def __init__(self, cell=16, alpha=0.75, diff_th=8.0, pad=64, align=64, dense=0.5, full_every=50):
+        self.cell        = cell
+        self.alpha       = alpha
+        self.diff_th     = diff_th
+        self.pad         = pad
+        self.align       = align
+        self.dense       = dense
+        self.full_every  = full_every
+        self.backgrounds = {}        # feeder -> CellBackground
+        self.since_full  = {}        # feeder -> frames since its last full frame
+        self.frames      = 0
+        self.full        = 0
+        self.cropped     = 0
+        self.skipped     = 0
+        self.pixels      = 0         # pixels sent to the detector
+        self.total       = 0         # pixels of all frames
+
+    def regions(self, feeder, frame, keep=()):
+        """
+        None to detect the whole frame, else a list of (core, crop)
+        rectangles (y0, y1, x0, x1) in pixels; [] if nothing changed.
+        `keep` are (row, col) positions that are always covered.
+        """
+        bg   = self.backgrounds.setdefault(feeder, CellBackground(self.cell, self.alpha, self.diff_th))
+        mask = bg.changed(frame)
+        n    = self.since_full.get(feeder, 0) + 1
+        if mask is None or (self.full_every and n >= self.full_every):
+            self.since_full[feeder] = 0
+            return None
+        self.since_full[feeder] = n
+        c = self.cell
+        for row, col in keep:
+            r, k = int(row) // c, int(col) // c
+            if 0 <= r < mask.shape[0] and 0 <= k < mask.shape[1]:
+                mask[r, k] = True
+        if not mask.any():
+            return []
+        h, w = frame.shape
+        out  = []
+        for r0, r1, c0, c1 in boxes(dilate(mask, -(-self.pad // c))):
+            core = (r0 * c, min(h, r1 * c), c0 * c, min(w, c1 * c))
+            out.append((core, _span(core[0], core[1], self.align, h) + _span(core[2], core[3], self.align, w)))
+        if sum((y1 - y0) * (x1 - x0) for _, (y0, y1, x0, x1) in out) > self.dense * h * w:
+            self.since_full[feeder] = 0
+            return None
+        return out
+
+    def detect(self, detect, frames, feeders, keep, keys, empty):
+        """
+        Results per frame of `frames` (frame i from feeders[i], keep[i] the
+        positions always covered) with positions in full-frame coordinates.
+        `keys` are the result keys holding one row per detection, positions
+        first; other keys are passed through.  A copy of `empty` stands in
+        for frames without changes.
+        """
+        positions_key = keys[0]
+        images, owners = [], []
+        for i, frame in enumerate(frames):
+            first = len(images)
+            plan  = self.regions(feeders[i], frame, keep[i])
+            self.frames += 1
+            self.total  += frame.size
+            if plan is None:
+                self.full += 1
+                images.append(frame)
+                owners.append((i, None))
+            elif not plan:
+                self.skipped += 1
+            else:
+                self.cropped += 1
+                for core, (y0, y1, x0, x1) in plan:
+                    images.append(np.ascontiguousarray(frame[y0:y1, x0:x1]))
+                    owners.append((i, (core, (y0, x0))))
+            self.pixels += sum(img.size for img in images[first:])
+
+        found = detect(images) if images else []
+        parts = [[] for _ in frames]
+        for (i, region), results in zip(owners, found):
+            if region is None:
+                parts[i].append(results)
+                continue
+            (cy0, cy1, cx0, cx1), (y0, x0) = region
+            pos = np.asarray(results[positions_key], np.float64).reshape(-1, 2) + (y0, x0)
+            sel = (pos[:, 0] >= cy0) & (pos[:, 0] < cy1) & (pos[:, 1] >= cx0) & (pos[:, 1] < cx1)
+            part = dict(results)
+            for k in keys:
+                part[k] = np.asarray(results[k])[sel]
+            part[positions_key] = pos[sel]
+            parts[i].append(part)
+
+        out = []
+        for i in range(len(frames)):
+            if not parts[i]:
+                out.append(dict(empty))
+            elif len(parts[i]) == 1:
+                out.append(parts[i][0])
+            else:
+                merged = {k: np.concatenate([np.asarray(p[k]) for p in parts[i]]) for k in keys}
+                out.append({**parts[i][0], **merged})
+        return out
+
+    def as_dict(self):
+        return {'frames': self.frames, 'full': self.full, 'cropped': self.cropped, 'skipped': self.skipped,
+                'pixel_share': self.pixels / self.total if self.total else 1.0}
+
+
+def make_regions(general):
+    """RegionDetector from the [General] section of server.cfg, None unless region_detection = 1."""
+    if general.get('region_detection', '0') != '1':
+        return None
+    return RegionDetector(cell       = int(general.get('region_cell', '16')),
+                          alpha      = float(general.get('region_alpha', '0.75')),
+                          diff_th    = float(general.get('region_threshold', '8')),
+                          pad        = int(general.get('region_pad', '64')),
+                          align      = int(general.get('region_align', '64')),
+                          dense      = float(general.get('region_dense', '0.5')),
+                          full_every = int(general.get('region_full_every', '50')))
@@ -0,0 +1,498 @@
+"""
+The stages of raspicam_server.py as an importable Server: transfer
+(pull_feeders), decode and detect (server_pipeline.StagedProcessor),
+track (track_frame) and persist (checkpoint/archive_video into the result
+and state stores).  raspicam_server.py runs it with the bb pipeline as
+detector; bench_server.py with synthetic videos, a stub detector and a
+local transport.
+
+The detector is any detect(frames) -> one results dict per frame; the
+result dicts are keyed by `keys` (a ResultKeys of the bb pipeline.objects
+classes in the server).  Time spent per stage is kept in `stages`.
+"""
+import numpy as np
+import time
+from datetime import datetime, timedelta
+import os
+import threading
+from collections import deque, namedtuple
+
+import frame_times
+import ingest as ingest_queue
+import motion_index
+import result_store
+import server_pipeline
+import server_regions
+import server_state
+import tracker
+import transfer
+from metrics import StageTimer
+
+ResultKeys=namedtuple('ResultKeys','positions orientations saliencies ids')
+
+STAGES=('transfer','decode','detect','track','persist')
+
+# calculate average distance from 0.5 of the elements of a bee's ID (normalized to a maximum of 1.0)
+def average_confidence(ID):
+    return (sum([abs(0.5-x) for x in ID])/len(ID))*2
+
+# round detected bee ID with values between 0 and 1 to either 0 or 1
+def id_to_binary(ID):
+    ID_bin=[]
+    for digit in ID:
+        ID_bin.append(np.round(digit))
+    return ID_bin
+
+# pipeline output for frames that are skipped because the camera saw no activity around them
+def empty_results(keys):
+    return {keys.positions:np.zeros((0,2)),keys.orientations:np.zeros((0,3)),keys.saliencies:np.zeros((0,1)),keys.ids:np.zeros((0,12))}
+
+# Representation of a single detected Bee.
+# The ID consensus is kept as running per-bit vote counts instead of the list of all observed IDs:
+# votes holds the (weighted) votes for 1 per bit, weights the total vote weight per bit.
+class Event:
+    __slots__=('votes','weights','history','pos','age','event_id','valid','detections','first_detection','image')
+    # weight every bit's vote by its confidence |p-0.5|*2 instead of counting all votes equally (set from server.cfg)
+    weighted=False
+    # number of most recent rounded IDs kept for the csv, None keeps all of them (set from server.cfg)
+    history_length=100
+
+    # parameters
+    # ------------------
+    # ID: Binary code on the bee's tag
+    # Position: x,y-Tuple of Pixel Coordinates as returned by the pipeline
+    # evt_id:  serial number of the Event
+    # time: current utc timestamp
+    def __init__(self, ID, Position,
+                 evt_id, time):
+        self.votes=np.zeros(len(ID))
+        self.weights=np.zeros(len(ID))
+        self.history=deque(maxlen=self.history_length)
+        self.add_id(ID)
+        self.pos=Position
+        self.age=0
+        self.event_id=evt_id
+        self.valid=True
+        self.detections=1
+        self.first_detection = time
+        self.image=None
+
+    # add the votes of one observed ID, the rounded ID is kept in the history as a bit mask
+    def add_id(self, ID):
+        ID=np.asarray(ID,dtype=np.float64)
+        bits=np.round(ID)
+        weight=np.abs(ID-0.5)*2 if self.weighted else 1.0
+        self.votes+=bits*weight
+        self.weights+=weight
+        self.history.append(int(np.dot(bits,1<<np.arange(len(bits)))))
+
+    # unused
+    def equals(self, ID):
+        return id_to_binary(ID)==self.get_median_id()
+
+    #update Event with new ID and Position
+    def update(self, ID, Position):
+        self.age=0
+        self.add_id(ID)
+        self.pos=Position
+        self.valid=True
+        self.detections+=1
+
+    # returns current Pixel coordiinates as x,y-Tuple
+    def get_position(self):
+        return (int(self.pos[1]),int(self.pos[0]))
+
+    # Set event as invalid if there was no matching detection in the current frame
+    def invalidate(self):
+        self.valid=False
+
+    # TODO: make age limit configurable, possibly do this check in the main code (different age limits for candidates and active events)
+    def is_active(self):
+        return self.age < 5
+
+    # returns serial id for event
+    def get_event_id(self):
+        return self.event_id
+
+    # returns bit-by-bit majority vote of all associated binary ids to ignore false detections,
+    # 0.5 for a tie like the median of the full id list
+    def get_median_id(self):
+        share=self.votes/np.maximum(self.weights,1e-12)
+        return np.where(share>0.5,1.0,np.where(share<0.5,0.0,0.5)).tolist()
+
+    # rounded ids in the history as lists of 0.0/1.0, oldest first
+    def get_ids(self):
+        n=len(self.votes)
+        return [[float(mask>>bit&1) for bit in range(n)] for mask in self.history]
+
+    #returns euclidian distance between the event's Position and the Position given as argument
+    def distance(self, position):
+        return np.sqrt((self.pos[0]-position[0])**2+(self.pos[1]-position[1])**2)
+
+    # save information and image of this event: adds its record to `results`, which is written to the result store as a batch
+    def save(self,results,time,feeder_id):
+        results.append(result_store.EventRecord(self.event_id, feeder_id, self.get_median_id(), list(self.history), len(self.votes),
+                                                self.first_detection, time, self.detections, self.image))
+
+    # change the image of this event, will crop an area at the current position from the frame given as argument.
+    # the frame buffer is reused for later frames, so the crop is copied
+    def set_image(self,frame):
+        self.image = frame[int(self.pos[0])-50:int(self.pos[0])+50,int(self.pos[1])-50:int(self.pos[1])+50].copy()
+
+class FileLoader:
+    # parameters
+    # ------------------
+    # config: server.cfg
+    # id: camera id, set in config file
+    # address: ip address of raspicam unit, set in config file
+    def __init__(self,config,id,address):
+        self.config=config
+        self.id=id
+        self.old_events=[]
+        self.old_event_candidates=[]
+        self.last_download=None
+        self.last_videotime=0
+        self.last_video=None
+        self.address=address
+        self.transfer=transfer.FeederTransfer(id,transfer.make_transport(self.config['Feeders'],id,address),
+                                              self.config['General']['videodir'],self.config['General']['archive_dir'])
+    # save remaining events if no file was available for download and the last download was too long ago.
+    # returns True if events were saved
+    def saveStaleEvents(self,results):
+        if self.last_download is not None and self.old_events and time.time()-self.last_download>int(self.config['General']['max_time_between_videos']):
+            for event in self.old_events:
+                event.save(results,self.last_videotime,self.id)
+            self.old_events=[]
+            return True
+        return False
+    # store unfinished events from last video for use on a later one
+    def storeEvents(self,events,event_candidates,videotime,video=None):
+        self.old_events=events
+        self.old_event_candidates=event_candidates
+        self.last_videotime=videotime
+        self.last_video=video
+    # return previously stored events
+    def getEvents(self):
+        return (self.old_events,self.old_event_candidates,self.last_videotime)
+
+# (feeder id, recording time) from a video file name <feeder id>_<%Y-%m-%d-%H-%M-%S>.h264 (or .mp4/.mkv), None for other files.
+# sidecars are read with their video, .partial holds unfinished transfers
+def parse_video_name(file):
+    if file.endswith((motion_index.SUFFIX,frame_times.SUFFIX,'.tmp')) or file.startswith('.'):
+        return None
+    fileinfo=file.split('.')[0].split('_')
+    try:
+        return fileinfo[0],datetime.strptime(fileinfo[1],"%Y-%m-%d-%H-%M-%S")
+    except (IndexError,ValueError):
+        return None
+
+class Server:
+    # parameters
+    # ------------------
+    # config: server.cfg
+    # keys: ResultKeys of the detector's result dicts
+    # detect: detect(frames) -> results per frame, may be set after creation (the decode workers
+    #         are forked here, before the detector should be loaded)
+    # preview: server_preview.Preview or None
+    def __init__(self,config,keys,detect=None,preview=None):
+        self.config=config
+        self.keys=keys
+        self.empty=empty_results(keys)
+        self.detect=detect
+        self.preview=preview
+        self.stages={stage:StageTimer() for stage in STAGES}
+        # tracker state of the video currently processed for each feeder, opened on its first frame
+        self.videos={}
+        self.framenum=0
+        self.frames_detected=0
+        # region_detection = 1: the detector only sees the changed regions of a frame (see server_regions)
+        self.regions=server_regions.make_regions(config['General'])
+        self.ingest=None
+        self.running=True
+        Event.weighted=config['General'].get('id_weighting','0')=='1'
+        Event.history_length=int(config['General'].get('id_history','100')) or None
+        self.feeders={}
+        ids=config['Feeders']['feeder_ids'].split(',')
+        addresses=config['Feeders']['feeder_addresses'].split(',')
+        for i in range(len(ids)):
+            self.feeders[ids[i]]=FileLoader(config,ids[i],addresses[i])
+
+        # event ids and the open events of every feeder survive restarts: restore the checkpoints and drop
+        # results of videos that were not finished, they are processed again
+        self.store=result_store.open_results(config['General'])
+        self.state=server_state.StateStore(config['General'].get('state_db','./server_state.db'),int(config['General']['last_event_id']),
+                                           results=self.store.name)
+        self.state.resume_results(self.store)
+        for feeder in self.feeders.keys():
+            last_video,saved=self.state.restore(feeder)
+            if saved is not None:
+                self.feeders[feeder].storeEvents(*saved,last_video)
+
+        self.processor=server_pipeline.StagedProcessor(int(config['General'].get('decode_workers','2')),
+                                                       int(config['General'].get('detect_batch','4')),
+                                                       int(config['General'].get('frame_queue','32')))
+
+    def path(self,file):
+        return self.config['General']['videodir']+"/"+file
+
+    # per-frame activity from the camera's motion index sidecar, None if there is none (process every frame)
+    def load_activity(self,videofile):
+        sidecar=motion_index.sidecar_path(videofile)
+        if self.config['General'].get('use_motion_index','1')!='1' or not os.path.exists(sidecar):
+            return None
+        try:
+            fps,records=motion_index.read(sidecar)
+        except (OSError,ValueError) as e:
+            print("ignoring motion index:",e)
+            return None
+        return motion_index.activity_mask(records,margin=int(self.config['General'].get('motion_margin','10')))
+
+    # unix time of every frame from the camera's timestamp sidecar, None if there is none (times from the file name and fps)
+    def load_times(self,videofile):
+        sidecar=frame_times.sidecar_path(videofile)
+        if not os.path.exists(sidecar):
+            return None
+        try:
+            return frame_times.unix_times(sidecar)[1]
+        except (OSError,ValueError) as e:
+            print("ignoring frame timestamps:",e)
+            return None
+
+    # (fps, number of frames) for decode workers to seek in a video in an indexed container (.mp4/.mkv), None to decode it all
+    def seek_index(self,videofile):
+        sidecar=frame_times.sidecar_path(videofile)
+        if not videofile.lower().endswith(server_pipeline.SEEKABLE) or not os.path.exists(sidecar):
+            return None
+        try:
+            fps,start,offsets=frame_times.read(sidecar)
+        except (OSError,ValueError):
+            return None
+        return fps,len(offsets)
+
+    # start tracking a video: restore the feeder's events if its previous video ended recently enough, save them otherwise.
+    # a video recorded before the feeder's last processed one (arrived late) is tracked on its own and leaves the feeder's events alone
+    def open_video(self,file):
+        feeder_id,videotime=parse_video_name(file)
+        times=self.load_times(self.path(file))
+        if times is not None and len(times):
+            videotime=datetime.fromtimestamp(times[0])
+        events,event_candidates,last_videotime=self.feeders[feeder_id].getEvents()
+        # saved events of a video are collected here and only written to the result store when the video is finished
+        saved=[]
+        late=not last_videotime==0 and videotime<last_videotime
+        if late:
+            print("%s was recorded before the last processed video of feeder %s"%(file,feeder_id))
+            events,event_candidates=[],[]
+        elif not last_videotime==0 and videotime-last_videotime>timedelta(seconds=int(self.config['General']['max_time_between_videos'])):
+            for event in events:
+                event.save(saved,last_videotime,feeder_id)
+            events,event_candidates=[],[]
+        self.videos[file]={'feeder_id':feeder_id,'videotime':videotime,'start':videotime,'times':times,'events':events,
+                           'event_candidates':event_candidates,'skipped':0,'saved':saved,'late':late}
+        return self.videos[file]
+
+    # match the detections of one frame to the events of its feeder, called in frame order per feeder.
+    # small_border is the padded frame, None if the frame was skipped for lack of activity
+    def track_frame(self,file,frame_idx,small_border,results):
+        t0=time.perf_counter()
+        config,keys=self.config,self.keys
+        video=self.videos.get(file) or self.open_video(file)
+        # the frame's sensor time from the timestamp sidecar, else its nominal time after the start of the video
+        times=video['times']
+        if times is not None and frame_idx<len(times):
+            video['videotime']=datetime.fromtimestamp(times[frame_idx])
+        else:
+            video['videotime']=video['start']+timedelta(seconds=frame_idx/int(config['General']['fps']))
+        feeder_id,videotime=video['feeder_id'],video['videotime']
+        events,event_candidates=video['events'],video['event_candidates']
+        self.framenum+=1
+        if small_border is None:
+            video['skipped']+=1
+
+        results_filtered={'Positions':[],'Orientations':[],'Saliencies':[],'IDs':[]}
+        for i in range(len(results[keys.ids])):
+            #Only process detections above a set confidence level
+            if average_confidence(results[keys.ids][i])>float(config['General']['minimum_confidence']):
+                results_filtered['Positions'].append(results[keys.positions][i])
+                results_filtered['Orientations'].append(results[keys.orientations][i])
+                results_filtered['Saliencies'].append(results[keys.saliencies][i])
+                results_filtered['IDs'].append(results[keys.ids][i])
+
+        # match detections one-to-one to events, the remaining ones to event candidates, and start new candidates for the rest
+        positions,ids=results_filtered['Positions'],results_filtered['IDs']
+        event_matches,candidate_matches,unmatched=tracker.associate([event.pos for event in events],[event.pos for event in event_candidates],
+                                                                    positions,int(config['General']['max_distance']))
+        for e,d in event_matches:
+            events[e].update(ids[d],positions[d])
+        for c,d in candidate_matches:
+            event_candidates[c].update(ids[d],positions[d])
+        for d in unmatched:
+            event_candidates.append(Event(ids[d],positions[d],-1,videotime))
+
+        # age all events and candidates that have not been matched in the last frame.
+        # generate events from candidates that have been detected often enough
+        for event in event_candidates:
+            if not event.valid:
+                event.age+=1
+            else:
+                event.invalidate()
+            if event.detections>2:
+                event.event_id=self.state.next_event_id()
+                event.set_image(small_border)
+                events.append(event)
+        for event in events:
+            if not event.valid:
+                event.age+=1
+                if not event.is_active():
+                    event.save(video['saved'],videotime,feeder_id)
+            else:
+                event.invalidate()
+        # remove inactive events
+        video['events']=[event for event in events if event.is_active()]
+        video['event_candidates']=[event for event in event_candidates if event.is_active() and event.detections<=2]
+        events=video['events']
+
+        # Visualize current detections: the preview thread renders the newest offered frame at a capped rate,
+        # the frame is only copied when a preview frame is due. the window is only updated from here, the main thread
+        if self.preview is not None:
+            if small_border is not None:
+                self.preview.offer(lambda: (small_border.copy(),np.asarray(results_filtered['Positions']),np.asarray(results_filtered['Orientations']),
+                                            np.asarray(results_filtered['IDs']),[(event.get_event_id(),event.get_position()) for event in events]))
+            self.preview.pump()
+        self.stages['track'].add(time.perf_counter()-t0)
+
+    # move a video (and its motion index and timestamps) to the archive, or to `directory`
+    def archive_video(self,file,directory=None):
+        archive_dir=directory or self.config['General']['archive_dir']
+        os.rename(self.path(file),archive_dir+"/"+file)
+        for sidecar in (motion_index.sidecar_path(file),frame_times.sidecar_path(file)):
+            if os.path.exists(self.path(sidecar)):
+                os.rename(self.path(sidecar),archive_dir+"/"+sidecar)
+
+    # write the saved events as one batch, then checkpoint the open events of a feeder together with the results marker
+    def checkpoint(self,feeder_id,saved,video=None):
+        self.store.add(saved)
+        feeder=self.feeders[feeder_id]
+        self.state.checkpoint(feeder_id,video or feeder.last_video,feeder.getEvents(),self.store.commit())
+
+    #after Video ends, write its results, store and checkpoint remaining events and move video (and its motion index) to archive
+    def close_video(self,file,error):
+        if file not in self.videos:
+            self.open_video(file)
+        t0=time.perf_counter()
+        video=self.videos.pop(file)
+        if error is not None:
+            # not checkpointed and the feeder's stored events are not replaced, the results of this video are dropped.
+            # the video goes to failed_dir with its sidecars, to be looked at or copied back into videodir
+            failed_dir=self.config['General'].get('failed_dir','failed/')
+            print("decoding %s failed: %s, moved to %s"%(file,error,failed_dir))
+            os.makedirs(failed_dir,exist_ok=True)
+            self.archive_video(file,failed_dir)
+            if self.ingest is not None:
+                self.ingest.done(file)
+            return
+        if video['skipped']:
+            print("skipped %d inactive frames of %s"%(video['skipped'],file))
+        if video['late']:
+            for event in video['events']:
+                event.save(video['saved'],video['videotime'],video['feeder_id'])
+        else:
+            self.feeders[video['feeder_id']].storeEvents(video['events'],video['event_candidates'],video['videotime'],file)
+        self.checkpoint(video['feeder_id'],video['saved'],file)
+        self.archive_video(file)
+        if self.ingest is not None:
+            self.ingest.done(file)
+        self.stages['persist'].add(time.perf_counter()-t0)
+
+    # pull from all feeders concurrently once; fetched videos are renamed into videodir. returns {feeder: [names]}
+    def pull_feeders(self):
+        t0=time.perf_counter()
+        fetched=transfer.pull_all([self.feeders[feeder].transfer for feeder in self.feeders],int(self.config['Feeders'].get('transfer_workers','4')))
+        for feeder in self.feeders.keys():
+            if fetched[feeder]:
+                self.feeders[feeder].last_download=time.time()
+        self.stages['transfer'].add(time.perf_counter()-t0)
+        return fetched
+
+    # pull every poll interval until stopped, where the ingest queue picks the fetched videos up
+    def poll_feeders(self):
+        while self.running:
+            started=time.time()
+            print("Downloading videos from feeders: "+", ".join(self.feeders.keys()))
+            self.pull_feeders()
+            for feeder in self.feeders.keys():
+                print("feeder %s: %s"%(feeder,self.feeders[feeder].transfer.stats))
+            time.sleep(max(0,float(self.config['Feeders'].get('poll_interval','10'))-(time.time()-started)))
+
+    # flush events of feeders that went quiet
+    def save_stale(self):
+        for feeder in self.feeders.keys():
+            saved=[]
+            if self.feeders[feeder].saveStaleEvents(saved):
+                self.checkpoint(feeder,saved)
+
+    # positions of the open events and candidates of a feeder, the regions around them are always detected
+    def open_positions(self,feeder_id):
+        events,event_candidates,_=self.feeders[feeder_id].getEvents()
+        for video in self.videos.values():
+            if video['feeder_id']==feeder_id:
+                events,event_candidates=video['events'],video['event_candidates']
+        return [event.pos for event in events+event_candidates]
+
+    # detector calls timed as the detect stage; keys are the videos of the frames
+    def _detect(self,frames,keys):
+        t0=time.perf_counter()
+        if self.regions is None:
+            results=self.detect(frames)
+        else:
+            feeders=[parse_video_name(key)[0] for key in keys]
+            results=self.regions.detect(self.detect,frames,feeders,[self.open_positions(feeder) for feeder in feeders],
+                                        self.keys,self.empty)
+        self.stages['detect'].add(time.perf_counter()-t0)
+        self.frames_detected+=len(frames)
+        return results
+
+    # decode, detect, track and persist the videos `files` (names in videodir), each feeder's in the given order
+    def process(self,files):
+        jobs=[]
+        for file in files:
+            # finished before a restart, only the archiving did not happen
+            if self.state.finished(file):
+                self.archive_video(file)
+                if self.ingest is not None:
+                    self.ingest.done(file)
+                continue
+            path=self.path(file)
+            jobs.append((parse_video_name(file)[0],file,path,self.load_activity(path),self.seek_index(path)))
+        decoded=self.processor.decode_seconds
+        self.processor.run(jobs,self._detect,self.empty,self.track_frame,self.close_video,int(self.config['General']['frameskip']))
+        # decode runs in the worker processes: worker secs, in parallel to the other stages
+        self.stages['decode'].add(self.processor.decode_seconds-decoded)
+
+    # the server main loop: pull feeders in the background, process videos as the ingest queue hands them out
+    def run(self):
+        self.ingest=ingest_queue.Ingest(self.config['General']['videodir'],parse_video_name,float(self.config['General'].get('ingest_settle','2')),
+                                        float(self.config['General'].get('ingest_rescan','30')),self.config['General'].get('use_inotify','1')=='1')
+        self.ingest.start()
+        threading.Thread(target=self.poll_feeders,daemon=True).start()
+        while(self.running):
+            # block until new videos are complete, flush events of feeders that went quiet in between
+            files=self.ingest.get(timeout=int(self.config['General']['max_time_between_videos']))
+            self.save_stale()
+            if self.preview is not None:
+                self.preview.pump()
+            if not files:
+                continue
+            for feeder,(count,size,oldest) in sorted(self.ingest.backlog().items()):
+                print("backlog feeder %s: %d videos, %.1f MB, oldest recorded %.0f s ago"%(feeder,count,size/1e6,oldest))
+            self.process(files)
+
+    def close(self):
+        self.running=False
+        self.processor.close()
+        if self.ingest is not None:
+            self.ingest.close()
+        if self.preview is not None:
+            self.preview.close()
+        self.state.close()
+        self.store.close()
@@ -0,0 +1,103 @@
+"""
+Durable state of raspicam_server.py in one SQLite file.
+
+Event ids are handed out from blocks reserved in the database, so
+promoting a candidate costs no I/O and a crash only leaves a gap in the
+id sequence, never a reused id.  At every video boundary the server
+stores the open events of the feeder together with the name of the video
+just finished and the marker the result backend returned after writing
+the video's results (see result_store).  After a restart the events are
+restored, the results are truncated back to that marker (dropping
+results of videos that were not finished) and those videos are
+processed again.  Markers only make sense to the backend that returned
+them (a batch number for sqlite, a byte offset for csv), so each backend
+has its own; a backend without one gets its current marker recorded
+before the first video, so a crash before the first checkpoint does not
+leave duplicate rows behind either.
+"""
+import pickle, sqlite3, threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    feeder_id TEXT PRIMARY KEY,
+    video     TEXT,
+    state     BLOB NOT NULL
+);
+"""
+
+
+class StateStore:
+    """
+    Event id allocator and per-feeder tracker checkpoints.  `first_id` is
+    the last event id used before the store existed (last_event_id from
+    server.cfg); ids are reserved `block` at a time.  `results` names the
+    result backend (its `name`) the results markers belong to.
+    """
+
+    def __init__(self, path, first_id=0, block=100, results='results'):
+        self.db     = sqlite3.connect(path, check_same_thread=False)
+        self.block  = block
+        self.lock   = threading.Lock()
+        self.marker = 'results_marker:' + results
+        self.db.executescript(SCHEMA)
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO counters VALUES ('next_event_id', ?)", (first_id + 1,))
+        self.next_id  = 0
+        self.reserved = 0
+
+    def _counter(self, name, default=None):
+        row = self.db.execute("SELECT value FROM counters WHERE name=?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def next_event_id(self):
+        with self.lock:
+            if self.next_id >= self.reserved:
+                with self.db:
+                    self.next_id  = self._counter('next_event_id')
+                    self.reserved = self.next_id + self.block
+                    self.db.execute("UPDATE counters SET value=? WHERE name='next_event_id'", (self.reserved,))
+            self.next_id += 1
+            return self.next_id - 1
+
+    def checkpoint(self, feeder_id, video, state, results_marker):
+        """Store the tracker `state` of a feeder after `video` and the results marker, atomically."""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)",
+                            (feeder_id, video, pickle.dumps(state, pickle.HIGHEST_PROTOCOL)))
+            self.db.execute("INSERT OR REPLACE INTO counters VALUES (?, ?)", (self.marker, results_marker))
+
+    def restore(self, feeder_id):
+        """(last finished video, tracker state) of a feeder, or (None, None)."""
+        with self.lock:
+            row = self.db.execute("SELECT video, state FROM checkpoints WHERE feeder_id=?", (feeder_id,)).fetchone()
+        return (row[0], pickle.loads(row[1])) if row else (None, None)
+
+    def finished(self, video):
+        """True if `video` was fully processed (checkpointed) but maybe not archived yet."""
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM checkpoints WHERE video=?", (video,)).fetchone() is not None
+
+    def results_marker(self):
+        """Results marker of the last checkpoint (or set_results_marker), -1 before the first one."""
+        with self.lock:
+            return self._counter(self.marker, -1)
+
+    def set_results_marker(self, results_marker):
+        """Record the marker results are truncated back to without a checkpoint."""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO counters VALUES (?, ?)", (self.marker, results_marker))
+
+    def resume_results(self, store):
+        """
+        At startup: truncate the result backend `store` back to the last
+        checkpoint, or record its current marker if it has none yet.
+        """
+        marker = self.results_marker()
+        if marker < 0:
+            self.set_results_marker(store.marker())
+        else:
+            store.truncate(marker)
+
+    def close(self):
+        self.db.close()
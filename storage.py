@@ -0,0 +1,325 @@
+"""
+On-device storage of saved segments: disk quota and background upload.
+
+Storage keeps an index of the segments (.h264, or remuxed .mp4/.mkv) in
+the camera's output directory (Videos/<feeder_id>).  Each segment has a
+motion score: the fraction of its frames with motion, from the .motion
+sidecar.  When the segments exceed `quota` bytes, or the disk has less
+than `min_free` bytes free, the lowest scoring (then oldest) segments are
+evicted until usage is back under low_water * quota and free space over
+min_free / low_water.  Eviction is bounded by that deficit: if the disk
+was filled by other files and deleting all our segments would not free
+enough, nothing is evicted for it.  While still over a limit, `full` is
+set.  The recording loop checks that flag and stops
+keeping new segments until there is space again.
+
+With a target, an upload thread sends the segments, highest score first,
+sidecars before video, and deletes them locally once uploaded.  Uploads
+are throttled to `bandwidth` bytes/s.  Failed uploads are retried with
+exponential backoff.  A target is any object with
+put(path, rel, throttle); rel is '<feeder_id>/<name>', like the layout
+under Videos.
+"""
+import os, random, shlex, shutil, subprocess, threading, time
+
+import frame_times
+import motion_index
+
+VIDEO_SUFFIXES = ('.h264', '.mp4', '.mkv')
+
+
+class Throttle:
+    """Token bucket: calling it with n bytes sleeps until they fit into `rate` bytes/s (0: unlimited)."""
+
+    def __init__(self, rate=0, burst=1 << 18):
+        self.rate   = rate
+        self.burst  = burst
+        self.tokens = burst
+        self.last   = time.monotonic()
+
+    def __call__(self, n):
+        if not self.rate:
+            return
+        now         = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate) - n
+        self.last   = now
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+class DirectoryTarget:
+    """Upload into a local directory (tests, USB disks, NFS mounts); files appear atomically."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, path, rel, throttle):
+        dest = os.path.join(self.root, rel)
+        tmp  = dest + '.tmp'
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(path, 'rb') as src, open(tmp, 'wb') as out:
+            for chunk in iter(lambda: src.read(1 << 16), b''):
+                throttle(len(chunk))
+                out.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, dest)
+
+
+class RsyncTarget:
+    """
+    Upload with rsync over ssh to `dest` ('user@host:/dir', key based
+    login), like legacy_cam_module2/backup_videos.sh.  rsync resumes
+    partial files and renames them into place; throttle.rate becomes
+    --bwlimit.
+    """
+
+    def __init__(self, dest, timeout=120):
+        self.dest    = dest.rstrip('/') + '/'
+        self.timeout = timeout
+
+    def put(self, path, rel, throttle):
+        # -R with /./ recreates <feeder_id>/ on the remote side
+        base = path[:len(path) - len(rel)]
+        cmd  = ['rsync', '-tR', '--partial', f'--timeout={self.timeout}',
+                '-e', 'ssh -o BatchMode=yes -o ConnectTimeout=10']
+        if throttle.rate:
+            cmd.append(f'--bwlimit={max(1, int(throttle.rate // 1024))}')
+        out = subprocess.run(cmd + [os.path.join(base, '.', rel), self.dest], capture_output=True, text=True)
+        if out.returncode:
+            raise OSError(f"{shlex.join(cmd)}: exit {out.returncode}: {out.stderr.strip()}")
+
+
+def make_target(spec):
+    """Target from an upload_target setting: '' (none), 'dir:<path>' or 'rsync:<user@host:/dir>'."""
+    if not spec:
+        return None
+    kind, _, dest = spec.partition(':')
+    if kind == 'dir':
+        return DirectoryTarget(dest)
+    if kind == 'rsync':
+        return RsyncTarget(dest)
+    raise ValueError(f"unknown upload_target {spec!r} (dir:<path> or rsync:<user@host:/dir>)")
+
+
+def sidecars(video):
+    return [motion_index.sidecar_path(video), frame_times.sidecar_path(video)]
+
+
+def motion_score(video):
+    """Fraction of the frames of `video` with motion, from its sidecar; None without one."""
+    try:
+        _, records = motion_index.read(motion_index.sidecar_path(video))
+    except (OSError, ValueError):
+        return None
+    if not len(records):
+        return None
+    return float(((records['flags'] & motion_index.FLAG_MOTION) != 0).mean())
+
+
+class Storage(threading.Thread):
+    """
+    Quota and uploads for the segments in `out_dir`.  The finaliser add()s
+    every segment it moves there.  Segments without a score rank like
+    score 1, so they are only evicted by age.  quota / min_free of 0
+    disable those limits.
+    """
+
+    def __init__(self, out_dir, quota=0, min_free=0, low_water=0.9, target=None, bandwidth=0,
+                 retry=10.0, max_retry=600.0, rescan=60.0):
+        super().__init__(name='storage', daemon=True)
+        self.out_dir   = out_dir
+        self.quota     = quota
+        self.min_free  = min_free
+        self.low_water = low_water
+        self.target    = target
+        self.throttle  = Throttle(bandwidth)
+        self.retry     = retry
+        self.max_retry = max_retry
+        self.rescan    = rescan
+        self.cond      = threading.Condition()
+        self.segments  = {}        # video path -> (bytes incl. sidecar, score, mtime)
+        self.failures  = {}        # video path -> (failed attempts, monotonic time of the next try)
+        self.uploading = None
+        self.full      = threading.Event()
+        self.running   = True
+        self.uploaded       = 0
+        self.uploaded_bytes = 0
+        self.upload_errors  = 0
+        self.evicted        = 0
+        self.foreign        = False  # min_free missed because of files that are not ours
+        self.refused_frames = 0    # motion frames not recorded because of `full` (analysis thread)
+        self._scan()
+
+    def _entry(self, video):
+        size = os.path.getsize(video)
+        for sidecar in sidecars(video):
+            try:
+                size += os.path.getsize(sidecar)
+            except OSError:
+                pass
+        return size, motion_score(video), os.path.getmtime(video)
+
+    def _scan(self):
+        """Sync the index with out_dir (segments left by an earlier run, or pulled by the server)."""
+        found = {}
+        for entry in os.scandir(self.out_dir):
+            if entry.name.endswith(VIDEO_SUFFIXES) and entry.is_file():
+                path = entry.path
+                try:
+                    found[path] = self.segments.get(path) or self._entry(path)
+                except OSError:
+                    continue
+        with self.cond:
+            # keep segments add()ed meanwhile, drop the ones uploaded or pulled meanwhile
+            self.segments = {path: entry for path, entry in {**self.segments, **found}.items()
+                             if os.path.exists(path)}
+            for path in set(self.failures) - set(self.segments):
+                del self.failures[path]
+            self._enforce()
+            self.cond.notify_all()
+
+    def add(self, video):
+        """Index a segment that was just moved into out_dir; evicts if over the quota."""
+        try:
+            entry = self._entry(video)
+        except OSError as e:
+            print(f"[storage] {video}: {e}")
+            return
+        with self.cond:
+            self.segments[video] = entry
+            self._enforce()
+            self.cond.notify_all()
+
+    def _remove(self, video):
+        for path in [video] + sidecars(video):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.segments.pop(video, None)
+        self.failures.pop(video, None)
+
+    def _over(self):
+        used = sum(size for size, _, _ in self.segments.values())
+        if self.quota and used > self.quota:
+            return True
+        return bool(self.min_free) and shutil.disk_usage(self.out_dir).free < self.min_free
+
+    def _deficit(self, available):
+        """Bytes to evict to get back under the low water marks; `available` are the evictable bytes."""
+        used, need = sum(size for size, _, _ in self.segments.values()), 0
+        if self.quota and used > self.quota:
+            need = used - self.quota * self.low_water
+        if self.min_free:
+            free    = shutil.disk_usage(self.out_dir).free
+            short   = self.min_free / self.low_water - free if free < self.min_free else 0
+            foreign = short > available       # deleting all our segments would not be enough
+            if foreign != self.foreign:
+                self.foreign = foreign
+                print("[storage] " + ("disk filled by other files, not evicting for min_free" if foreign
+                                      else "free space back within reach of our segments"))
+            if not foreign:
+                need = max(need, short)
+        return need
+
+    def _enforce(self):
+        """Evict lowest score / oldest first down to the low water marks; with cond held."""
+        if self._over():
+            candidates = sorted((1.0 if score is None else score, mtime, size, path)
+                                for path, (size, score, mtime) in self.segments.items() if path != self.uploading)
+            need = self._deficit(sum(size for _, _, size, _ in candidates))
+            for score, _, size, video in candidates:
+                if need <= 0:
+                    break
+                print(f"[storage] evicting {video} (motion score {score:.3f})")
+                self._remove(video)
+                self.evicted += 1
+                need         -= size
+        full = self._over()
+        if full != self.full.is_set():
+            print(f"[storage] {'full, not keeping new segments' if full else 'space available again'}")
+            (self.full.set if full else self.full.clear)()
+
+    def _next(self):
+        """Highest-score segment ready for upload, else the secs to wait; with cond held."""
+        now, best, wait = time.monotonic(), None, self.rescan
+        for path, (_, score, mtime) in self.segments.items():
+            _, next_try = self.failures.get(path, (0, 0.0))
+            if next_try > now:
+                wait = min(wait, next_try - now)
+                continue
+            key = (-(1.0 if score is None else score), mtime)
+            if best is None or key < best[0]:
+                best = (key, path)
+        return (best[1], 0.0) if best else (None, wait)
+
+    def _upload(self, video):
+        rel = os.path.join(os.path.basename(self.out_dir), os.path.basename(video))
+        for sidecar in sidecars(video):
+            if os.path.exists(sidecar):
+                self.target.put(sidecar, os.path.join(os.path.dirname(rel), os.path.basename(sidecar)), self.throttle)
+        self.target.put(video, rel, self.throttle)
+
+    def run(self):
+        next_scan = time.monotonic() + self.rescan
+        while self.running:
+            if time.monotonic() >= next_scan:
+                self._scan()
+                next_scan = time.monotonic() + self.rescan
+            with self.cond:
+                video, wait = self._next() if self.target is not None else (None, self.rescan)
+                if video is None:
+                    self.cond.wait(min(wait, max(0.0, next_scan - time.monotonic())))
+                    continue
+                self.uploading = video
+                size           = self.segments[video][0]
+            try:
+                self._upload(video)
+            except Exception as e:
+                with self.cond:
+                    n            = self.failures.get(video, (0, 0.0))[0]
+                    delay        = min(self.max_retry, self.retry * 2 ** n) * random.uniform(0.5, 1.0)
+                    self.failures[video] = (n + 1, time.monotonic() + delay)
+                    self.upload_errors += 1
+                    self.uploading = None
+                print(f"[storage] upload of {video} failed ({e}), retry in {delay:.1f} s")
+                continue
+            with self.cond:
+                self._remove(video)
+                self.uploading       = None
+                self.uploaded       += 1
+                self.uploaded_bytes += size
+                self._enforce()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.is_alive():
+            self.join(timeout=10)
+
+    def as_dict(self):
+        with self.cond:
+            used, n = sum(size for size, _, _ in self.segments.values()), len(self.segments)
+            backlog = len(self.failures)
+        return {'bytes': used, 'segments': n, 'quota': self.quota, 'free': shutil.disk_usage(self.out_dir).free,
+                'full': self.full.is_set(), 'uploaded': self.uploaded, 'uploaded_bytes': self.uploaded_bytes,
+                'upload_errors': self.upload_errors, 'retrying': backlog, 'evicted': self.evicted,
+                'refused_frames': self.refused_frames}
+
+
+def make_storage(cfg, out_dir):
+    """Storage from the [Storage] section of a camera config, None without one."""
+    if not cfg.has_section('Storage'):
+        return None
+    s = cfg['Storage']
+    return Storage(out_dir,
+                   quota     = int(s.getfloat('quota_mb', fallback=0) * 1e6),
+                   min_free  = int(s.getfloat('min_free_mb', fallback=0) * 1e6),
+                   low_water = s.getfloat('low_water', fallback=0.9),
+                   target    = make_target(s.get('upload_target', fallback='').strip()),
+                   bandwidth = s.getfloat('upload_kbps', fallback=0) * 1000 / 8,
+                   retry     = s.getfloat('retry', fallback=10),
+                   max_retry = s.getfloat('max_retry', fallback=600),
+                   rescan    = s.getfloat('rescan', fallback=60))
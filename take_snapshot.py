@@ -1,79 +1,293 @@
 #!/usr/bin/env python3
+"""
+Snapshots with the camera settings of a raspicam config.
+
+    # one snapshot, optionally with overrides
+    python3 take_snapshot.py feedercam.cfg --zoom-y 0.05 --focus 12.5
+    # sweep: comma separated values are a grid, walked with the camera kept open;
+    # every shot is scored and a ranked report is written next to the images
+    python3 take_snapshot.py feedercam.cfg --zoom-y 0,0.05,0.1,0.15 --focus 10,12.5,15 --out-dir ~/snapshots
+    # ... and write the best lens_focus_position (with its zoom_y / zoom_h) into the config
+    python3 take_snapshot.py feedercam.cfg --zoom-y 0.05 --focus 8:16:1 --apply
+
+In a sweep the camera is only reconfigured when the crop size changes
+(zoom_h); zoom_y and focus are runtime controls.  After each change
+frames are taken until their metadata shows the new crop and lens
+position and stable exposure, instead of fixed sleeps.  The score of a
+shot is the variance of the Laplacian of its luminance inside the
+[Background] roi (sharpness); shots with more than 1% clipped or crushed
+pixels are marked and ranked after the well exposed ones.  Sharpness is
+only compared within one framing (zoom_y, zoom_h): --apply takes the
+best focus of the only framing swept, or else of the config's current
+framing.
+"""
 import time
 import datetime
 import argparse
 import configparser
+import csv
 import os
-from picamera2 import Picamera2
+import re
+import numpy as np
+
+
+def parse_values(text):
+    """'0.05' -> [0.05], '0,0.05,0.1' -> list, 'start:stop:step' -> inclusive range."""
+    if ':' in text:
+        start, stop, step = (float(v) for v in text.split(':'))
+        return [round(float(v), 6) for v in np.arange(start, stop + step / 2, step)]
+    return [float(v) for v in text.split(',')]
+
+
+def crop_rect(sensor_size, zoom_x, zoom_y, zoom_w, zoom_h):
+    """ScalerCrop (x0, y0, w, h) for the zoom fractions, sizes aligned like raspicam.stream_sizes."""
+    sw, sh = sensor_size
+    cam_w  = round(sw * zoom_w / 32) * 32
+    cam_h  = round(sh * zoom_h / 16) * 16
+    return int(zoom_x * sw), int(zoom_y * sh), cam_w, cam_h
+
+
+def luminance(rgb):
+    """Luma of a picamera2 'RGB888' array (B, G, R byte order)."""
+    return rgb[..., 2] * 0.299 + rgb[..., 1] * 0.587 + rgb[..., 0] * 0.114
+
+
+def score(gray, roi=None):
+    """
+    Sharpness and exposure of a luma image: Laplacian variance, mean
+    level and the fractions of clipped (>= 250) and crushed (<= 5) pixels,
+    inside the `roi` mask if given.
+    """
+    g   = gray.astype(np.float32)
+    lap = (g[1:-1, :-2] + g[1:-1, 2:] + g[:-2, 1:-1] + g[2:, 1:-1] - 4 * g[1:-1, 1:-1])
+    if roi is not None:
+        inner = roi[1:-1, 1:-1]
+        lap, g = lap[inner], g[roi]
+    return {'sharpness': float(lap.var()), 'mean': float(g.mean()),
+            'clipped': float((g >= 250).mean()), 'crushed': float((g <= 5).mean())}
+
+
+def rank(shots, max_bad=0.01):
+    """Shots sorted best first: well exposed before badly exposed, then by sharpness."""
+    for s in shots:
+        s['exposure_ok'] = s['clipped'] <= max_bad and s['crushed'] <= max_bad
+    return sorted(shots, key=lambda s: (not s['exposure_ok'], -s['sharpness']))
+
+
+def best_per_framing(shots):
+    """Best of the ranked `shots` for each framing (zoom_y, zoom_h)."""
+    best = {}
+    for s in shots:
+        best.setdefault((s['zoom_y'], s['zoom_h']), s)
+    return best
+
+
+class Settle:
+    """
+    Decides from successive frame metadata when the controls just set took
+    effect: ScalerCrop and LensPosition as requested and exposure time and
+    gain within `tolerance` over `frames` consecutive frames.  libcamera
+    rounds the crop to what the ISP can do, so each ScalerCrop value may be
+    off by `crop_tolerance` pixels.
+    """
+
+    def __init__(self, crop=None, focus=None, frames=3, tolerance=0.02, focus_tolerance=0.05, crop_tolerance=16):
+        self.crop            = tuple(crop) if crop is not None else None
+        self.focus           = focus
+        self.frames          = frames
+        self.tolerance       = tolerance
+        self.focus_tolerance = focus_tolerance
+        self.crop_tolerance  = crop_tolerance
+        self.history         = []
+
+    def __call__(self, meta):
+        if self.crop is not None and 'ScalerCrop' in meta and \
+                any(abs(a - b) > self.crop_tolerance for a, b in zip(meta['ScalerCrop'], self.crop)):
+            self.history = []
+            return False
+        if self.focus is not None and 'LensPosition' in meta and abs(meta['LensPosition'] - self.focus) > self.focus_tolerance:
+            self.history = []
+            return False
+        self.history.append((meta.get('ExposureTime', 0), meta.get('AnalogueGain', 0.0)))
+        recent = self.history[-self.frames:]
+        if len(recent) < self.frames:
+            return False
+        return all(abs(v - recent[-1][i]) <= self.tolerance * max(abs(recent[-1][i]), 1e-9)
+                   for e in recent for i, v in enumerate(e))
+
+
+def apply_best(cfg_path, values):
+    """Set the [Recording] keys in `values` in the config file, keeping its comments and layout."""
+    with open(cfg_path) as f:
+        lines = f.read().split('\n')
+    section, todo = None, dict(values)
+    for i, line in enumerate(lines):
+        m = re.match(r'\s*\[(.+)\]', line)
+        if m:
+            section = m.group(1)
+            continue
+        m = re.match(r'(\s*)([\w]+)(\s*=\s*)(.*)', line)
+        if section == 'Recording' and m and m.group(2) in todo:
+            lines[i] = f"{m.group(1)}{m.group(2)}{m.group(3)}{todo.pop(m.group(2))}"
+    if todo:
+        raise SystemExit(f"{cfg_path}: no [Recording] keys {', '.join(todo)}")
+    tmp = cfg_path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines))
+    os.replace(tmp, cfg_path)
+
+
+def configure(picam2, size):
+    picam2.stop()
+    picam2.configure(picam2.create_still_configuration(main={'size': size, 'format': 'RGB888'}))
+    picam2.start()
+
+
+def settle(picam2, check, timeout):
+    """Take frames until check(metadata) holds or `timeout` secs passed; returns (settled, secs)."""
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        if check(picam2.capture_metadata()):
+            return True, time.monotonic() - t0
+    return False, time.monotonic() - t0
+
+
+def sweep(picam2, cfg, grid, out_dir, timeout=3.0):
+    """Shoot every (zoom_y, zoom_h, focus) of `grid`; returns the ranked shot dicts."""
+    from raspicam import load_roi
+
+    sensor = picam2.sensor_modes[cfg.getint('Recording', 'sensor_mode')]['size']
+    zoom_x = cfg.getfloat('Recording', 'zoom_x')
+    zoom_w = cfg.getfloat('Recording', 'zoom_w')
+    shots, size, roi = [], None, None
+    # grouped by zoom_h, so the camera is reconfigured once per crop size
+    for zoom_y, zoom_h, focus in sorted(grid, key=lambda g: (g[1], g[0], g[2])):
+        crop = crop_rect(sensor, zoom_x, zoom_y, zoom_w, zoom_h)
+        if crop[2:] != size:
+            size = crop[2:]
+            configure(picam2, size)
+            roi  = None
+        picam2.set_controls({'ScalerCrop': crop, 'AfMode': 0, 'LensPosition': focus})
+        settled, secs = settle(picam2, Settle(crop, focus), timeout)
+
+        request = picam2.capture_request()
+        try:
+            name = f"snapshot_zy{zoom_y:.2f}_zh{zoom_h:.2f}_f{focus:.1f}".replace('.', '_')
+            path = os.path.join(out_dir, name + '.jpg')
+            request.save('main', path)
+            gray = luminance(request.make_array('main'))
+        finally:
+            request.release()
+        if roi is None:
+            roi = load_roi(cfg, gray.shape[1], gray.shape[0])
+        shot = dict(zoom_y=zoom_y, zoom_h=zoom_h, focus=focus, file=os.path.basename(path),
+                    settled=settled, settle_s=round(secs, 2), **score(gray, roi))
+        shots.append(shot)
+        print(f"zoom_y={zoom_y:.2f} zoom_h={zoom_h:.2f} focus={focus:5.2f}  sharpness {shot['sharpness']:10.1f}  "
+              f"mean {shot['mean']:5.1f}  settled {'yes' if settled else 'NO '} in {secs:.2f} s")
+    return rank(shots)
+
+
+def write_report(shots, out_dir):
+    """Ranked shots as report.csv plus a readable report.txt; returns the txt path."""
+    fields = ['rank', 'zoom_y', 'zoom_h', 'focus', 'sharpness', 'mean', 'clipped', 'crushed', 'exposure_ok',
+              'settled', 'settle_s', 'file']
+    with open(os.path.join(out_dir, 'report.csv'), 'w', newline='') as f:
+        w = csv.DictWriter(f, fields)
+        w.writeheader()
+        for i, s in enumerate(shots, 1):
+            w.writerow(dict(s, rank=i))
+    path  = os.path.join(out_dir, 'report.txt')
+    lines = [f"{'rank':>4}  {'zoom_y':>6}  {'zoom_h':>6}  {'focus':>6}  {'sharpness':>10}  {'mean':>5}  "
+             f"{'clip%':>5}  {'crush%':>6}  file"]
+    for i, s in enumerate(shots, 1):
+        lines.append(f"{i:>4}  {s['zoom_y']:6.2f}  {s['zoom_h']:6.2f}  {s['focus']:6.2f}  {s['sharpness']:10.1f}  "
+                     f"{s['mean']:5.1f}  {s['clipped'] * 100:5.1f}  {s['crushed'] * 100:6.1f}  {s['file']}"
+                     + ("" if s['exposure_ok'] else "  (exposure)") + ("" if s['settled'] else "  (not settled)"))
+    # framings differ in resolution and content, so also the best focus of each one
+    lines += ['', 'best focus per framing:']
+    for (zy, zh), s in sorted(best_per_framing(shots).items()):
+        lines.append(f"  zoom_y={zy:.2f} zoom_h={zh:.2f}: focus {s['focus']:.2f} (sharpness {s['sharpness']:.1f})")
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
 
 
 def main():
     p = argparse.ArgumentParser(
-        description="Take a single snapshot using picamera2 based on config (with optional overrides)"
+        description="Take a snapshot using picamera2 based on config (with optional overrides), "
+                    "or sweep a grid of them and rank the shots"
     )
     p.add_argument('config', help='Path to INI config file')
-    p.add_argument('--zoom-y', type=float, help='Override zoom_y fraction')
-    p.add_argument('--zoom-h', type=float, help='Override zoom_h fraction')
-    p.add_argument('--focus', type=float, help='Override lens_focus_position')
+    p.add_argument('--zoom-y', type=parse_values, help='Override zoom_y fraction (a,b,c or start:stop:step to sweep)')
+    p.add_argument('--zoom-h', type=parse_values, help='Override zoom_h fraction (list/range to sweep)')
+    p.add_argument('--focus', type=parse_values, help='Override lens_focus_position (list/range to sweep)')
     p.add_argument('--out', help='Output image path (default: ./snapshot_<ts>.jpg)')
+    p.add_argument('--out-dir', help='Sweep output directory (default: ./snapshots_<feeder>_<ts>)')
+    p.add_argument('--settle-timeout', type=float, default=3.0, help='Max secs to wait for controls to settle')
+    p.add_argument('--apply', action='store_true', help='Write the best sweep values into the config')
     args = p.parse_args()
 
     # Read config
     cfg = configparser.ConfigParser()
     cfg.read(args.config)
     feeder = cfg['General'].get('feeder_id', 'feedercam')
-    # Recording params for ROI
-    zoom_x = cfg.getfloat('Recording','zoom_x')
-    zoom_y = args.zoom_y if args.zoom_y is not None else cfg.getfloat('Recording','zoom_y')
-    zoom_w = cfg.getfloat('Recording','zoom_w')
-    zoom_h = args.zoom_h if args.zoom_h is not None else cfg.getfloat('Recording','zoom_h')
-
-    focus_pos = args.focus if args.focus is not None else cfg.getfloat('Recording','lens_focus_position')
+    ts     = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    zoom_ys = args.zoom_y or [cfg.getfloat('Recording', 'zoom_y')]
+    zoom_hs = args.zoom_h or [cfg.getfloat('Recording', 'zoom_h')]
+    focuses = args.focus or [cfg.getfloat('Recording', 'lens_focus_position')]
+    grid    = [(zy, zh, f) for zy in zoom_ys for zh in zoom_hs for f in focuses]
 
-    sensor_mode = cfg.getint('Recording','sensor_mode')
-
-    # Setup camera
+    from picamera2 import Picamera2
     picam2 = Picamera2()
-    mode = picam2.sensor_modes[sensor_mode]
-    sw, sh = mode['size']
-
-    # Compute crop
-    cam_w = round(sw * zoom_w / 32) * 32
-    cam_h = round(sh * zoom_h / 16) * 16
-    x0 = int(zoom_x * sw)
-    y0 = int(zoom_y * sh)
-
-    # Create still config
-    still_config = picam2.create_still_configuration(
-        main={'size': (cam_w, cam_h), 'format': 'RGB888'}
-    )
-    picam2.configure(still_config)
-
-    # Start and warm up
-    picam2.start()
-    time.sleep(2)
+    try:
+        if len(grid) > 1 or args.apply:
+            out_dir = args.out_dir or f"snapshots_{feeder}_{ts}"
+            os.makedirs(out_dir, exist_ok=True)
+            t0     = time.monotonic()
+            shots  = sweep(picam2, cfg, grid, out_dir, args.settle_timeout)
+            report = write_report(shots, out_dir)
+            print(f"{len(shots)} shots in {time.monotonic() - t0:.1f} s, ranking in {report}")
+            # sharpness does not compare across framings: the only framing swept, else the configured one
+            framings = best_per_framing(shots)
+            current  = (cfg.getfloat('Recording', 'zoom_y'), cfg.getfloat('Recording', 'zoom_h'))
+            best     = next(iter(framings.values())) if len(framings) == 1 else framings.get(current)
+            if best is None:
+                print("several framings swept, see the best focus of each in the report")
+                if args.apply:
+                    raise SystemExit("--apply needs one framing (a single --zoom-y and --zoom-h) "
+                                     "or the configured one in the sweep")
+                return
+            print(f"best: zoom_y = {best['zoom_y']}, zoom_h = {best['zoom_h']}, "
+                  f"lens_focus_position = {best['focus']} ({best['file']})")
+            if args.apply:
+                apply_best(args.config, {'zoom_y': best['zoom_y'], 'zoom_h': best['zoom_h'],
+                                         'lens_focus_position': best['focus']})
+                print(f"written to {args.config}")
+            return
 
-    # Apply crop & focus
-    picam2.set_controls({
-        'ScalerCrop': (x0, y0, cam_w, cam_h),
-        'AfMode': 0,  # manual focus
-        'LensPosition': focus_pos
-    })
-    time.sleep(0.5)  # let focus settle
+        zoom_y, zoom_h, focus_pos = grid[0]
+        sensor = picam2.sensor_modes[cfg.getint('Recording', 'sensor_mode')]['size']
+        crop   = crop_rect(sensor, cfg.getfloat('Recording', 'zoom_x'), zoom_y,
+                           cfg.getfloat('Recording', 'zoom_w'), zoom_h)
+        configure(picam2, crop[2:])
 
-    # Output path
-    ts = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
-    out_path = args.out or f"snapshot_{feeder}_{ts}.jpg"
-    out_dir = os.path.dirname(out_path)
-    if out_dir and not os.path.exists(out_dir):
-        os.makedirs(out_dir, exist_ok=True)
+        # Apply crop & focus, then wait until the frames show them
+        picam2.set_controls({'ScalerCrop': crop, 'AfMode': 0, 'LensPosition': focus_pos})
+        settle(picam2, Settle(crop, focus_pos), args.settle_timeout)
 
-    # Capture
-    picam2.capture_file(out_path)
-    print(f"Saved snapshot to {out_path}")
+        # Output path
+        out_path = args.out or f"snapshot_{feeder}_{ts}.jpg"
+        out_dir  = os.path.dirname(out_path)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir, exist_ok=True)
 
-    picam2.close()
+        # Capture
+        picam2.capture_file(out_path)
+        print(f"Saved snapshot to {out_path}")
+    finally:
+        picam2.close()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,89 @@
+import configparser, os, threading, time
+
+import raspicam
+import replay
+from bench_background import synthetic_frames
+from camera_pool import WorkerPool
+
+SENSOR = (2304, 1296)
+
+
+def camera_cfg(name, feeder):
+    """Camera config `name` with one-second segments, so a short replay finalises several."""
+    cfg = configparser.ConfigParser()
+    cfg.read(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), name))
+    cfg['General']['feeder_id']      = feeder
+    cfg['Recording']['video_length'] = '1'
+    return cfg
+
+
+def lores(cfg, n):
+    _, _, (w, h) = raspicam.stream_sizes(cfg, SENSOR)
+    return synthetic_frames(w, h, n), (w, h)
+
+
+def test_two_cameras_share_the_pool(tmp_path, monkeypatch):
+    # every finalise job takes a while and counts how many run at once
+    lock, running, peak = threading.Lock(), [0], [0]
+    finalise = raspicam.Finaliser.finalise
+
+    def slow_finalise(self, *job):
+        with lock:
+            running[0] += 1
+            peak[0]     = max(peak[0], running[0])
+        try:
+            time.sleep(0.02)
+            return finalise(self, *job)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    monkeypatch.setattr(raspicam.Finaliser, 'finalise', slow_finalise)
+    runs = []
+    for name, feeder in (('exitcam.cfg', 'camA'), ('feedercam.cfg', 'camB')):
+        cfg          = camera_cfg(name, feeder)
+        frames, size = lores(cfg, 60)
+        runs.append((cfg, frames, size))
+    cameras, stats, _ = replay.replay_shared(runs, str(tmp_path / 'Videos'), workers=3)
+
+    assert stats['failed'] == 0
+    assert 0 < peak[0] <= 2                 # workers - 1 finalise at most, one is left for analysis
+    for pipeline, source in cameras:
+        assert source.count == 60
+        assert pipeline.metrics.analysed == 60
+        assert pipeline.health() == 'ok'
+        assert pipeline.metrics.saved + pipeline.metrics.deleted >= 5
+
+
+def test_failed_camera_leaves_the_other_running(tmp_path):
+    pool = WorkerPool(2)
+    try:
+        bad_cfg, good_cfg = camera_cfg('exitcam.cfg', 'bad'), camera_cfg('feedercam.cfg', 'good')
+        bad_frames, bad_size   = lores(bad_cfg, 4)       # fewer than the ring holds: its source never blocks
+        good_frames, good_size = lores(good_cfg, 40)
+        bad, bad_enc, bad_src  = replay.fake_camera(bad_cfg, bad_frames, bad_size, str(tmp_path / 'Videos'), pool=pool)
+        good, good_enc, good_src = replay.fake_camera(good_cfg, good_frames, good_size, str(tmp_path / 'Videos'),
+                                                      pool=pool)
+
+        def broken(img, now=None):
+            raise RuntimeError("analysis failed")
+
+        bad.bg.update_bg = broken
+        for encoder in (bad_enc, good_enc):
+            encoder.start()
+        bad.start(bad_src)
+        good.start()
+        good_src(good.ring, good.stop, good.metrics)
+        for t in bad.threads:
+            t.join()
+        pool.wait_idle(good, timeout=10)
+
+        assert bad in pool.failed
+        assert bad.health() == 'failed'
+        assert good.health() == 'ok'
+        assert good.metrics.analysed == 40
+        bad.shutdown(bad_enc.stop)
+        good.shutdown(good_enc.stop)
+        assert good.metrics.saved + good.metrics.deleted >= 4
+    finally:
+        pool.close()
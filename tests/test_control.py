@@ -0,0 +1,43 @@
+import os, types
+
+import numpy as np
+
+import control
+
+
+class FakeCamera:
+    controls = {}
+
+    def grab(self, timeout=2.0):
+        return np.full((4, 6), 7, np.uint8), {'SensorTimestamp': 1}
+
+
+def serve(tmp_path, snapshot_dir):
+    pipeline = types.SimpleNamespace(feeder='f0')
+    server   = control.ControlServer(str(tmp_path / 'control.sock'), pipeline, FakeCamera(), snapshot_dir)
+    server.start()
+    return server
+
+
+def test_snapshot_only_into_snapshot_dir(tmp_path):
+    snaps  = str(tmp_path / 'snaps')
+    server = serve(tmp_path, snaps)
+    try:
+        reply = control.request(server.path, {'cmd': 'snapshot', 'name': 'a.npy'})
+        assert reply['ok'] and reply['path'] == os.path.join(snaps, 'a.npy')
+        assert (np.load(reply['path']) == 7).all()
+        for name in ('../a.npy', str(tmp_path / 'b.npy'), 'sub/c.npy', '..', ''):
+            reply = control.request(server.path, {'cmd': 'snapshot', 'name': name})
+            assert not reply['ok'] and 'plain file name' in reply['error']
+        assert os.listdir(snaps) == ['a.npy'] and not os.path.exists(tmp_path / 'b.npy')
+    finally:
+        server.close()
+
+
+def test_no_snapshots_without_snapshot_dir(tmp_path):
+    server = serve(tmp_path, None)
+    try:
+        reply = control.request(server.path, {'cmd': 'snapshot', 'name': 'a.npy'})
+        assert not reply['ok'] and 'snapshot_dir' in reply['error']
+    finally:
+        server.close()
@@ -0,0 +1,63 @@
+import numpy as np
+
+import motion_index
+from motion_index import MotionLog
+
+FRAME_US = 100_000
+SENSOR_0 = 5_000_000_000        # sensor time (us) of the first encoded frame
+
+
+def logged(n, epoch=lambda: SENSOR_0):
+    """MotionLog with `n` frames at sensor time, motion on every third one."""
+    log = MotionLog(100, epoch)
+    for i in range(n):
+        log.add(SENSOR_0 + i * FRAME_US, i / 100, motion=i % 3 == 0, active=True)
+    return log
+
+
+def stamps(first, last):
+    """Encoder timestamps of the frames first..last, relative to the first encoded frame."""
+    return [i * FRAME_US for i in range(first, last + 1)]
+
+
+def test_cut_takes_encoder_relative_span():
+    # a segment holding encoder frames 10..19
+    records = logged(30).cut(stamps(10, 19), FRAME_US, timeout=0)
+    assert records['frame'].tolist() == list(range(10))
+    assert records['ts'].tolist() == [i * FRAME_US for i in range(10, 20)]
+    assert np.allclose(records['ratio'], np.arange(10, 20) / 100)
+    motion = (records['flags'] & motion_index.FLAG_MOTION) != 0
+    assert motion.tolist() == [i % 3 == 0 for i in range(10, 20)]
+
+
+def test_cut_numbers_frames_by_position_in_the_file():
+    # the encoder dropped frames 13 and 14: the file holds 10..12, 15..19 as its frames 0..7
+    written = stamps(10, 12) + stamps(15, 19)
+    records = logged(30).cut(written, FRAME_US, timeout=0)
+    assert records['frame'].tolist() == list(range(8))
+    assert records['ts'].tolist() == written
+    assert np.allclose(records['ratio'], np.array([10, 11, 12, 15, 16, 17, 18, 19]) / 100)
+    mask = motion_index.activity_mask(records, margin=0)
+    assert mask.tolist() == [i % 3 == 0 for i in (10, 11, 12, 15, 16, 17, 18, 19)]
+
+
+def test_cut_before_the_encoder_started_is_empty():
+    assert len(logged(30, epoch=lambda: None).cut(stamps(0, 9), FRAME_US, timeout=0)) == 0
+
+
+def test_cut_without_epoch_uses_one_clock():
+    log = MotionLog(100)
+    for i in range(5):
+        log.add(i * FRAME_US, 0.0, False, False, skipped=True)
+    records = log.cut(stamps(1, 3), FRAME_US, timeout=0)
+    assert records['frame'].tolist() == [0, 1, 2]
+    assert (records['flags'] == motion_index.FLAG_SKIPPED).all()
+
+
+def test_sidecar_round_trip(tmp_path):
+    records = logged(30).cut(stamps(0, 29), FRAME_US, timeout=0)
+    path    = str(tmp_path / 'seg.motion')
+    motion_index.write(path, records, 10)
+    fps, back = motion_index.read(path)
+    assert fps == 10
+    assert np.array_equal(back, records)
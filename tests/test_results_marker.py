@@ -0,0 +1,90 @@
+import csv
+
+import pytest
+
+import result_store
+import server_state
+
+
+def record(event_id, feeder_id='00'):
+    return result_store.EventRecord(event_id, feeder_id, [1.0] * 12, [0b101], 12, 1_700_000_000.0 + event_id,
+                                    1_700_000_001.0 + event_id, 3, None)
+
+
+def sqlite_backend(tmp_path):
+    return result_store.ResultStore(str(tmp_path / 'results.db'))
+
+
+def csv_backend(tmp_path):
+    return result_store.CSVResults(str(tmp_path / 'detections.csv'))
+
+
+def event_ids(store):
+    if isinstance(store, result_store.CSVResults):
+        store.file.flush()
+        with open(store.file.name, newline='') as f:
+            return [int(row[0]) for row in csv.reader(f)]
+    return sorted(row[0] for row in store.db.execute("SELECT event_id FROM events"))
+
+
+def restart(tmp_path, backend, store, state):
+    """Close both stores and reopen them like Server.__init__ does."""
+    store.close()
+    state.close()
+    store = backend(tmp_path)
+    state = server_state.StateStore(str(tmp_path / 'state.db'), results=store.name)
+    state.resume_results(store)
+    return store, state
+
+
+@pytest.mark.parametrize('backend', [sqlite_backend, csv_backend])
+def test_unfinished_video_is_truncated(tmp_path, backend):
+    store = backend(tmp_path)
+    state = server_state.StateStore(str(tmp_path / 'state.db'), results=store.name)
+    state.resume_results(store)
+    store.add([record(1), record(2)])
+    state.checkpoint('00', 'video_1', ([], []), store.commit())
+    # crash after writing the next video's results, before its checkpoint
+    store.add([record(3)])
+    store.commit()
+    store, state = restart(tmp_path, backend, store, state)
+    assert event_ids(store) == [1, 2]
+    # the video is processed again and finished this time
+    store.add([record(3)])
+    state.checkpoint('00', 'video_2', ([], []), store.commit())
+    store, state = restart(tmp_path, backend, store, state)
+    assert event_ids(store) == [1, 2, 3]
+    store.close()
+
+
+@pytest.mark.parametrize('backend', [sqlite_backend, csv_backend])
+def test_crash_before_first_checkpoint(tmp_path, backend):
+    store = backend(tmp_path)
+    state = server_state.StateStore(str(tmp_path / 'state.db'), results=store.name)
+    state.resume_results(store)
+    store.add([record(1)])
+    store.commit()
+    store, state = restart(tmp_path, backend, store, state)
+    assert event_ids(store) == []
+    store.close()
+
+
+def test_markers_are_kept_per_backend(tmp_path):
+    store = sqlite_backend(tmp_path)
+    state = server_state.StateStore(str(tmp_path / 'state.db'), results=store.name)
+    state.resume_results(store)
+    for batch in range(1, 6):
+        store.add([record(batch)])
+        state.checkpoint('00', f'video_{batch}', ([], []), store.commit())
+    assert state.results_marker() == 5
+    # switching to csv: the sqlite batch number must not be taken as a byte offset
+    store, state = restart(tmp_path, csv_backend, store, state)
+    store.add([record(10), record(11)])
+    state.checkpoint('00', 'video_6', ([], []), store.commit())
+    store, state = restart(tmp_path, csv_backend, store, state)
+    assert event_ids(store) == [10, 11]
+    # and back: the sqlite marker is where it was
+    store, state = restart(tmp_path, sqlite_backend, store, state)
+    assert state.results_marker() == 5
+    assert event_ids(store) == [1, 2, 3, 4, 5]
+    store.close()
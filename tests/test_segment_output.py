@@ -0,0 +1,35 @@
+import pytest
+
+import replay
+from segment_output import SegmentOutput
+
+
+def segment_output(closed):
+    return SegmentOutput(5, lambda *args: closed.append(args), split_every=10, frame_us=100_000)
+
+
+def test_fake_encoder_takes_segment_output(tmp_path):
+    closed  = []
+    output  = segment_output(closed)
+    encoder = replay.FakeEncoder(output, 10)
+    encoder.start()
+    output.open(lambda start: str(tmp_path / f"seg_{len(closed)}.h264"))
+    for i in range(25):
+        encoder.encode(1000.0 + i / 10)
+    encoder.stop()
+    # split on the keyframes every 10 frames, stamped relative to the first frame
+    assert [span for _, _, span, _ in closed] == [(0, 900_000), (1_000_000, 1_900_000), (2_000_000, 2_400_000)]
+
+
+def test_fake_encoder_rejects_other_outputs():
+    with pytest.raises(RuntimeError, match="Must pass Output"):
+        replay.FakeEncoder(object(), 10)
+
+
+def test_picamera2_encoder_takes_segment_output(tmp_path):
+    encoders = pytest.importorskip('picamera2.encoders')
+    encoder  = encoders.Encoder()
+    output   = segment_output([])
+    encoder.output = output
+    assert output in (encoder.output if isinstance(encoder.output, list) else [encoder.output])
+    assert not output.needs_add_stream
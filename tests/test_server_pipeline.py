@@ -0,0 +1,79 @@
+import os, time
+
+import numpy as np
+
+import server_pipeline
+from server_stages import ResultKeys
+
+KEYS = ResultKeys('Positions', 'Orientations', 'Saliencies', 'IDs')
+
+
+class BrightSpots:
+    """pipeline([image]) -> one detection per pixel above 0, like a detector that sees single pixels."""
+
+    def __init__(self):
+        self.images = []
+
+    def __call__(self, images):
+        image, = images
+        self.images.append(image)
+        pos = np.argwhere(image > 0).astype(np.float64)
+        n   = len(pos)
+        return {KEYS.positions: pos, KEYS.orientations: np.zeros((n, 3)), KEYS.saliencies: np.ones((n, 1)),
+                KEYS.ids: np.full((n, 12), 0.9), 'frame_size': image.shape}
+
+
+def frame(*spots, shape=(40, 30)):
+    img = np.zeros(shape, np.uint8)
+    for y, x in spots:
+        img[y, x] = 255
+    return img
+
+
+def test_mosaic_splits_detections_per_frame():
+    detector = BrightSpots()
+    frames   = [frame((0, 1)), frame((39, 2), (5, 5)), frame(shape=(20, 30)), frame((10, 29))]
+    out      = server_pipeline.detect_mosaic(detector, frames, KEYS, seam=16)
+    assert len(detector.images) == 2                  # the three 40x30 frames in one call, the odd one alone
+    assert detector.images[0].shape == (3 * 40 + 2 * 16, 30)
+    assert [r[KEYS.positions].tolist() for r in out] == [[[0, 1]], [[5, 5], [39, 2]], [], [[10, 29]]]
+    for r in out:
+        assert len(r[KEYS.ids]) == len(r[KEYS.orientations]) == len(r[KEYS.positions])
+    assert out[0]['frame_size'] == (152, 30)          # keys without a row per detection are passed through
+
+
+def test_mosaic_drops_detections_in_the_seam():
+    def seam_hit(images):
+        results = BrightSpots()(images)
+        results[KEYS.positions] = np.vstack([results[KEYS.positions], [[45.0, 3.0]]])
+        for k in KEYS[1:]:
+            results[k] = np.vstack([results[k], results[k][:1]])
+        return results
+
+    out = server_pipeline.detect_mosaic(seam_hit, [frame((1, 1)), frame((2, 2))], KEYS, seam=16)
+    assert [r[KEYS.positions].tolist() for r in out] == [[[1, 1]], [[2, 2]]]
+
+
+def test_one_feeder_uses_every_worker_in_order(tmp_path, monkeypatch):
+    def decode(key, path, frameskip, activity, out_q, slots, seek=None):
+        open(os.path.join(str(tmp_path), key), 'w').write(str(os.getpid()))
+        for i in range(10):
+            # the first video is slow: frames of the later ones wait behind it
+            time.sleep(0.03 if key == 'v0' else 0.0)
+            server_pipeline._put_frame(key, i, np.full((4, 4), i, np.uint8), (4 + 2 * server_pipeline.BORDER,) * 2,
+                                       out_q, slots)
+        return 0.0
+
+    monkeypatch.setattr(server_pipeline, 'decode_video', decode)
+    processor = server_pipeline.StagedProcessor(workers=3, batch=1, queue_size=2, max_size=(4, 4))
+    try:
+        seen, done = [], []
+        processor.run([('00', f'v{n}', None, None, None) for n in range(3)], lambda frames, keys: [{}] * len(frames),
+                      {}, lambda key, i, frame, results: seen.append((key, i, int(frame[51, 51]))),
+                      lambda key, error: done.append((key, error)), 0)
+    finally:
+        processor.close()
+    assert done == [('v0', None), ('v1', None), ('v2', None)]
+    assert seen == [(f'v{n}', i, i) for n in range(3) for i in range(10)]
+    pids = {open(os.path.join(str(tmp_path), f'v{n}')).read() for n in range(3)}
+    assert len(pids) == 3
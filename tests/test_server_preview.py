@@ -0,0 +1,24 @@
+import sys, threading, time, types
+
+import server_preview
+
+
+def test_window_is_only_shown_from_the_pumping_thread(monkeypatch):
+    calls = []
+    fake  = types.SimpleNamespace(imshow=lambda window, image: calls.append((threading.current_thread(), image)),
+                                  waitKey=lambda delay: -1)
+    monkeypatch.setitem(sys.modules, 'cv2', fake)
+    preview = server_preview.Preview(lambda item: item * 2, fps=0)
+    preview.start()
+    try:
+        assert preview.offer(lambda: 21)
+        deadline = time.monotonic() + 5
+        while preview.shown == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert calls == []                      # rendered by the preview thread, not shown yet
+        preview.pump()
+        assert calls == [(threading.main_thread(), 42)]
+        preview.pump()                          # nothing new rendered: the window is left alone
+        assert len(calls) == 1
+    finally:
+        preview.close()
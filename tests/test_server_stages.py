@@ -0,0 +1,25 @@
+import argparse, os
+
+import bench_server
+from server_stages import Server
+
+
+def make_server(tmp_path):
+    args = argparse.Namespace(fps=10, frameskip=0, workers=1, batch=4, queue=8, regions=False)
+    return Server(bench_server.make_config(str(tmp_path), ['00'], args), bench_server.KEYS)
+
+
+def test_failed_video_is_moved_aside_not_checkpointed(tmp_path):
+    server = make_server(tmp_path)
+    try:
+        name = '00_2024-06-01-12-00-00.h264'
+        for f in (name, '00_2024-06-01-12-00-00.motion'):
+            open(os.path.join(server.config['General']['videodir'], f), 'wb').close()
+        server.close_video(name, 'corrupt stream')
+        failed = str(tmp_path / 'failed')
+        assert sorted(os.listdir(failed)) == ['00_2024-06-01-12-00-00.h264', '00_2024-06-01-12-00-00.motion']
+        assert os.listdir(server.config['General']['archive_dir']) == []
+        assert not server.state.finished(name)
+        assert server.feeders['00'].last_video is None
+    finally:
+        server.close()
@@ -0,0 +1,61 @@
+import itertools
+import numpy as np
+
+import tracker
+
+
+def brute_force_assignment(cost):
+    """Cheapest total cost over every one-to-one assignment of the rows (rows <= cols)."""
+    n, m = cost.shape
+    return min(cost[np.arange(n), list(cols)].sum() for cols in itertools.permutations(range(m), n))
+
+
+def brute_force_match(tracks, detections, max_distance):
+    """(pairs, total distance) of the best gated matching: most pairs first, then least distance."""
+    dist = np.linalg.norm(tracks[:, None] - detections[None], axis=2)
+    n, m = dist.shape
+    for k in range(min(n, m), 0, -1):
+        best = None
+        for rows in itertools.combinations(range(n), k):
+            for cols in itertools.permutations(range(m), k):
+                d = dist[list(rows), list(cols)]
+                if (d <= max_distance).all() and (best is None or d.sum() < best):
+                    best = d.sum()
+        if best is not None:
+            return k, best
+    return 0, 0.0
+
+
+def test_solve_matches_brute_force():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        n    = rng.integers(1, 6)
+        cost = rng.uniform(0, 100, (n, rng.integers(n, 7)))
+        col  = tracker.solve(cost)
+        assert len(set(col.tolist())) == n
+        assert np.isclose(cost[np.arange(n), col].sum(), brute_force_assignment(cost))
+
+
+def test_match_matches_brute_force():
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        tracks     = rng.uniform(0, 80, (rng.integers(1, 6), 2))
+        detections = rng.uniform(0, 80, (rng.integers(1, 6), 2))
+        ti, di     = tracker.match(tracks, detections, 25.0)
+        assert len(set(ti.tolist())) == len(ti) and len(set(di.tolist())) == len(di)
+        dist       = np.linalg.norm(tracks[ti] - detections[di], axis=1)
+        assert (dist <= 25.0).all()
+        pairs, total = brute_force_match(tracks, detections, 25.0)
+        assert len(ti) == pairs
+        assert np.isclose(dist.sum(), total)
+
+
+def test_match_int_max_distance_keeps_fractional_distances():
+    # small distances whose integer parts often tie: an int cost matrix picks the wrong pairs
+    rng = np.random.default_rng(2)
+    for _ in range(100):
+        tracks     = rng.uniform(0, 10, (4, 2))
+        detections = rng.uniform(0, 10, (4, 2))
+        ti, di     = tracker.match(tracks, detections, 20)
+        fi, fd     = tracker.match(tracks, detections, 20.0)
+        assert sorted(zip(ti.tolist(), di.tolist())) == sorted(zip(fi.tolist(), fd.tolist()))
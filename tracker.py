@@ -0,0 +1,167 @@
+"""
+Detection-to-event assignment for raspicam_server.py.
+
+Each frame the detections are matched one-to-one to the open events, and
+the detections left over to the event candidates, minimising the summed
+distance of the matched pairs; pairs further apart than max_distance are
+never matched.  Only pairs within max_distance are looked at: from a
+NumPy distance matrix for small frames, from a uniform grid with
+max_distance cells for crowded ones.  The gated pairs fall apart into
+small connected groups (bees near each other), and only those groups
+with a real choice go through the assignment solver.
+"""
+import numpy as np
+
+DENSE_LIMIT = 4096      # above this many track x detection pairs use the grid index
+EMPTY       = np.zeros(0, np.intp)
+
+
+def dense_pairs(tracks, detections, max_distance):
+    """(track idx, detection idx, distance) of all pairs within max_distance."""
+    dist   = np.sqrt(((tracks[:, None, :] - detections[None, :, :]) ** 2).sum(axis=2))
+    ti, di = np.nonzero(dist <= max_distance)
+    return ti, di, dist[ti, di]
+
+
+def grid_pairs(tracks, detections, max_distance):
+    """Same as dense_pairs, with candidates from the 3x3 grid cells around each detection."""
+    def cells(points):
+        return np.floor(points / max_distance).astype(np.int64) + 1
+
+    def key(c):
+        return (c[:, 0] << 32) + c[:, 1]
+
+    t_key = key(cells(tracks))
+    order = np.argsort(t_key, kind='stable')
+    t_key = t_key[order]
+    d_cel = cells(detections)
+    ti, di = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            k      = key(d_cel + (dx, dy))
+            lo, hi = np.searchsorted(t_key, k, 'left'), np.searchsorted(t_key, k, 'right')
+            n      = hi - lo
+            if not n.any():
+                continue
+            det    = np.repeat(np.arange(len(detections)), n)
+            starts = np.repeat(lo - np.cumsum(n) + n, n)
+            ti.append(order[starts + np.arange(n.sum())])
+            di.append(det)
+    if not ti:
+        return EMPTY, EMPTY, np.zeros(0)
+    ti, di = np.concatenate(ti), np.concatenate(di)
+    dist   = np.sqrt(((tracks[ti] - detections[di]) ** 2).sum(axis=1))
+    keep   = dist <= max_distance
+    return ti[keep], di[keep], dist[keep]
+
+
+def components(ti, di, n_tracks):
+    """Connected component label per pair of the bipartite track/detection graph."""
+    node  = np.concatenate([ti, n_tracks + di])
+    uniq, inv = np.unique(node, return_inverse=True)
+    label = np.arange(len(uniq))
+    a, b  = inv[:len(ti)], inv[len(ti):]
+    while True:
+        m   = np.minimum(label[a], label[b])
+        new = label.copy()
+        np.minimum.at(new, a, m)
+        np.minimum.at(new, b, m)
+        new = new[new]
+        if np.array_equal(new, label):
+            return label[a]
+        label = new
+
+
+def solve(cost):
+    """
+    Minimum cost one-to-one assignment (shortest augmenting paths, vectorised
+    over columns) for a rows <= cols matrix; returns the column of each row.
+    """
+    n, m = cost.shape
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    p    = np.zeros(m + 1, np.intp)      # row (1-based) assigned to column j, 0 = free
+    way  = np.zeros(m + 1, np.intp)
+    for i in range(1, n + 1):
+        p[0], j0 = i, 0
+        minv     = np.full(m + 1, np.inf)
+        used     = np.zeros(m + 1, np.bool_)
+        while True:
+            used[j0] = True
+            i0       = p[j0]
+            cur      = cost[i0 - 1] - u[i0] - v[1:]
+            better   = ~used[1:] & (cur < minv[1:])
+            minv[1:][better] = cur[better]
+            way[1:][better]  = j0
+            free     = np.where(used[1:], np.inf, minv[1:])
+            j1       = int(np.argmin(free)) + 1
+            delta    = free[j1 - 1]
+            u[p[used]] += delta
+            v[used]    -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1    = way[j0]
+            p[j0] = p[j1]
+            j0    = j1
+    col        = np.empty(n, np.intp)
+    col[p[1:][p[1:] > 0] - 1] = np.nonzero(p[1:] > 0)[0]
+    return col
+
+
+def match(tracks, detections, max_distance, dense_limit=DENSE_LIMIT):
+    """
+    Optimal one-to-one matching of `detections` (n, 2) to `tracks` (m, 2)
+    gated at max_distance; returns (track idx, detection idx) arrays.
+    """
+    tracks, detections = np.asarray(tracks, np.float64).reshape(-1, 2), np.asarray(detections, np.float64).reshape(-1, 2)
+    if not len(tracks) or not len(detections):
+        return EMPTY, EMPTY
+    max_distance = float(max_distance)
+    pairs  = dense_pairs if len(tracks) * len(detections) <= dense_limit else grid_pairs
+    ti, di, dist = pairs(tracks, detections, max_distance)
+    if not len(ti):
+        return EMPTY, EMPTY
+    label  = components(ti, di, len(tracks))
+    order  = np.argsort(label, kind='stable')
+    ti, di, dist = ti[order], di[order], dist[order]
+    _, start, count = np.unique(label[order], return_index=True, return_counts=True)
+    # groups with a single gated pair need no solver
+    out_t, out_d = [ti[start[count == 1]]], [di[start[count == 1]]]
+    for lo, n in zip(start[count > 1].tolist(), count[count > 1].tolist()):
+        t, d, c = ti[lo:lo + n], di[lo:lo + n], dist[lo:lo + n]
+        if (t == t[0]).all() or (d == d[0]).all():      # one track or one detection: nearest pair
+            best = np.argmin(c)
+            out_t.append(t[best:best + 1])
+            out_d.append(d[best:best + 1])
+            continue
+        rows, r_ix = np.unique(t, return_inverse=True)
+        cols, c_ix = np.unique(d, return_inverse=True)
+        # gated pairs cost more than any set of real pairs, so real pairs are maximised first
+        big        = max_distance * (min(len(rows), len(cols)) + 1) + 1
+        cost       = np.full((len(rows), len(cols)), big, np.float64)
+        cost[r_ix, c_ix] = c
+        if len(rows) <= len(cols):
+            r, k = np.arange(len(rows)), solve(cost)
+        else:
+            k, r = np.arange(len(cols)), solve(cost.T)
+        ok = cost[r, k] < big
+        out_t.append(rows[r[ok]])
+        out_d.append(cols[k[ok]])
+    return np.concatenate(out_t), np.concatenate(out_d)
+
+
+def associate(event_positions, candidate_positions, detections, max_distance):
+    """
+    Match detections to events first and the remaining ones to event
+    candidates.  Returns (event matches, candidate matches, unmatched
+    detection indices); matches are lists of (index, detection index).
+    """
+    detections = np.asarray(detections, np.float64).reshape(-1, 2)
+    ev, ed     = match(event_positions, detections, max_distance)
+    rest       = np.setdiff1d(np.arange(len(detections)), ed)
+    cv, cd     = match(candidate_positions, detections[rest], max_distance)
+    cd         = rest[cd]
+    new        = np.setdiff1d(rest, cd)
+    return list(zip(ev.tolist(), ed.tolist())), list(zip(cv.tolist(), cd.tolist())), new.tolist()
@@ -0,0 +1,215 @@
+"""
+Video transfer from the feeder cameras to the server.
+
+A transport lists the completed files of one feeder, fetches a file into
+a local partial file (resuming from its current size), returns checksums
+and deletes a batch of remote files.  FeederTransfer.pull() fetches
+everything new, verifies each file against the remote MD5, moves it into
+videodir and then removes all verified files from the feeder with a single
+delete call.  pull_all() runs the feeders concurrently.
+
+Cameras move segments (and write their .motion / .times sidecars) into the remote
+directory with an atomic rename when they are complete, so everything
+listed there except *.tmp files is complete.
+"""
+import hashlib, os, shlex, shutil, subprocess, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+SIDECARS = ('.motion', '.times')
+SUFFIXES = ('.h264', '.mp4', '.mkv') + SIDECARS
+
+
+def md5sum(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class LocalTransport:
+    """Transport for a feeder directory on the local file system (tests, NFS mounts)."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def list(self):
+        files = {}
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(SUFFIXES):
+                    rel = os.path.relpath(os.path.join(dirpath, name), self.root)
+                    files[rel] = os.path.getsize(os.path.join(dirpath, name))
+        return files
+
+    def fetch(self, rel, dest, offset):
+        with open(os.path.join(self.root, rel), 'rb') as src, open(dest, 'ab') as out:
+            src.seek(offset)
+            shutil.copyfileobj(src, out, 1 << 20)
+
+    def checksums(self, rels):
+        return {rel: md5sum(os.path.join(self.root, rel)) for rel in rels}
+
+    def delete(self, rels):
+        for rel in rels:
+            os.remove(os.path.join(self.root, rel))
+
+
+class SSHTransport:
+    """
+    Transport over ssh/rsync with one persistent ssh master connection per
+    feeder (ControlMaster), so a poll costs no new handshakes.  Fetches use
+    rsync --partial --append-verify to resume interrupted transfers.
+    """
+
+    def __init__(self, address, username, remotedir, password=None, persist=600):
+        self.host      = f"{username}@{address}"
+        self.remotedir = remotedir
+        control        = f"/tmp/bb_raspicam_{username}_{address}.ssh"
+        self.ssh       = ['ssh', '-o', 'ControlMaster=auto', '-o', f'ControlPath={control}',
+                          '-o', f'ControlPersist={persist}', '-o', 'StrictHostKeyChecking=accept-new']
+        self.prefix    = ['sshpass', '-p', password] if password else []
+
+    def _remote(self, command):
+        out = subprocess.run(self.prefix + self.ssh + [self.host, command],
+                             check=True, capture_output=True, text=True)
+        return out.stdout
+
+    def list(self):
+        names = ' -o '.join(f"-name '*{s}'" for s in SUFFIXES)
+        out   = self._remote(f"cd {shlex.quote(self.remotedir)} && "
+                             f"find . -type f \\( {names} \\) -printf '%P\\t%s\\n'")
+        files = {}
+        for line in out.splitlines():
+            rel, size = line.rsplit('\t', 1)
+            files[rel] = int(size)
+        return files
+
+    def fetch(self, rel, dest, offset):
+        src = f"{self.host}:{os.path.join(self.remotedir, rel)}"
+        subprocess.run(self.prefix + ['rsync', '-e', ' '.join(map(shlex.quote, self.ssh)),
+                                      '--partial', '--append-verify', '-q', src, dest], check=True)
+
+    def checksums(self, rels):
+        if not rels:
+            return {}
+        out  = self._remote(f"cd {shlex.quote(self.remotedir)} && md5sum -- "
+                            + ' '.join(shlex.quote(r) for r in rels))
+        sums = {}
+        for line in out.splitlines():
+            digest, rel = line.split(None, 1)
+            sums[rel.lstrip('*')] = digest
+        return sums
+
+    def delete(self, rels):
+        if rels:
+            self._remote(f"cd {shlex.quote(self.remotedir)} && rm -f -- " + ' '.join(shlex.quote(r) for r in rels))
+
+
+class TransferStats:
+    def __init__(self):
+        self.files    = 0
+        self.bytes    = 0
+        self.seconds  = 0.0
+        self.failures = 0
+        self.polls    = 0
+
+    def rate(self):
+        """Average throughput in MB/s over all fetches."""
+        return self.bytes / self.seconds / 1e6 if self.seconds else 0.0
+
+    def __str__(self):
+        return (f"{self.files} files, {self.bytes / 1e6:.1f} MB, {self.rate():.2f} MB/s, "
+                f"{self.failures} failures, {self.polls} polls")
+
+
+class FeederTransfer:
+    """Pulls the completed files of one feeder into `videodir`."""
+
+    def __init__(self, feeder_id, transport, videodir, archive_dir=None):
+        self.feeder_id   = feeder_id
+        self.transport   = transport
+        self.videodir    = videodir
+        self.archive_dir = archive_dir
+        self.partial_dir = os.path.join(videodir, '.partial')
+        self.stats       = TransferStats()
+        self.lock        = threading.Lock()     # one pull per feeder at a time
+        os.makedirs(self.partial_dir, exist_ok=True)
+
+    def _local(self, name):
+        """Path of an already transferred copy of `name`, or None."""
+        for d in filter(None, (self.videodir, self.archive_dir)):
+            if os.path.exists(os.path.join(d, name)):
+                return os.path.join(d, name)
+        return None
+
+    def pull(self):
+        """Fetch, verify and remotely delete all new files; returns the names now in videodir."""
+        with self.lock:
+            self.stats.polls += 1
+            remote = self.transport.list()
+            # sidecars first, so a video never shows up in videodir before its motion index and timestamps
+            order  = sorted(remote, key=lambda r: (not r.endswith(SIDECARS), r))
+
+            fetched, done = [], {}
+            for rel in order:
+                name = os.path.basename(rel)
+                if self._local(name):             # fetched before, remote delete did not happen
+                    done[rel] = self._local(name)
+                    continue
+                part   = os.path.join(self.partial_dir, name + '.part')
+                offset = os.path.getsize(part) if os.path.exists(part) else 0
+                if offset > remote[rel]:          # remote file was replaced, start over
+                    os.remove(part)
+                    offset = 0
+                t0 = time.monotonic()
+                try:
+                    self.transport.fetch(rel, part, offset)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    self.stats.failures += 1
+                    print(f"[transfer {self.feeder_id}] {rel}: {e}")
+                    continue
+                self.stats.seconds += time.monotonic() - t0
+                self.stats.bytes   += remote[rel] - offset
+                done[rel] = part
+
+            # one checksum call and one delete call for the whole batch
+            sums, verified = self.transport.checksums(list(done)), []
+            for rel, path in done.items():
+                name = os.path.basename(rel)
+                if sums.get(rel) != md5sum(path):
+                    self.stats.failures += 1
+                    print(f"[transfer {self.feeder_id}] {rel}: checksum mismatch, fetching again next poll")
+                    if path.endswith('.part'):
+                        os.remove(path)
+                    continue
+                if path.endswith('.part'):
+                    os.replace(path, os.path.join(self.videodir, name))
+                    self.stats.files += 1
+                    fetched.append(name)
+                verified.append(rel)
+            self.transport.delete(verified)
+            return fetched
+
+
+def make_transport(feeders_cfg, feeder_id, address):
+    """Transport for one feeder from the [Feeders] section of server.cfg."""
+    remotedir = feeders_cfg['remotedir']
+    if feeders_cfg.get('transport', 'ssh') == 'local':
+        return LocalTransport(remotedir.format(id=feeder_id))
+    return SSHTransport(address.strip(), feeders_cfg['username'], remotedir,
+                        password=feeders_cfg.get('password'))
+
+
+def pull_all(transfers, workers=None):
+    """Pull all FeederTransfers concurrently; returns {feeder_id: [fetched names]}."""
+    with ThreadPoolExecutor(max_workers=workers or len(transfers) or 1) as pool:
+        futures = {t.feeder_id: pool.submit(t.pull) for t in transfers}
+    result = {}
+    for feeder_id, fut in futures.items():
+        try:
+            result[feeder_id] = fut.result()
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"[transfer {feeder_id}] poll failed: {e}")
+            result[feeder_id] = []
+    return result